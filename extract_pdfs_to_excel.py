@@ -1,11 +1,42 @@
 import os, sys, platform, subprocess, tkinter.messagebox as mb
 
-# 1. Evitar ventana negra al ejecutar Tesseract (Windows)
-if platform.system() == "Windows":
-    _orig = subprocess.Popen
-    # use creationflags=CREATE_NO_WINDOW para evitar consola
-    CREATE_NO_WINDOW = 0x08000000
-    subprocess.Popen = lambda *a, **k: _orig(*a, **{**k, "creationflags": k.get("creationflags", CREATE_NO_WINDOW)})
+# 1. Evitar ventana negra al ejecutar Tesseract (Windows) y registrar cada subproceso
+#    (poppler/tesseract) con el hilo que lo lanzó, para poder matarlo al cancelar o si se
+#    cuelga (ver kill_subprocesses). Va antes de importar pdf2image/pytesseract.
+import threading, weakref
+_orig = subprocess.Popen
+CREATE_NO_WINDOW = 0x08000000
+_LIVE_PROCS = weakref.WeakKeyDictionary()   # Popen -> hilo que lo lanzó
+_LIVE_PROCS_LOCK = threading.Lock()
+_SUBPROCESS_ENV = threading.local()   # variables extra para los subprocesos de cada hilo (ver ocr_thread_limit)
+
+class _TrackedPopen(_orig):
+    def __init__(self, *a, **k):
+        if platform.system() == "Windows":
+            # use creationflags=CREATE_NO_WINDOW para evitar consola
+            k["creationflags"] = k.get("creationflags", CREATE_NO_WINDOW)
+        extra = getattr(_SUBPROCESS_ENV, "vars", None)
+        if extra and k.get("env") is None:
+            k["env"] = {**os.environ, **extra}
+        super().__init__(*a, **k)
+        with _LIVE_PROCS_LOCK:
+            _LIVE_PROCS[self] = threading.current_thread()
+
+subprocess.Popen = _TrackedPopen
+
+def kill_subprocesses(threads=None):
+    """Mata los subprocesos vivos lanzados desde threads (todos si None). Devuelve cuántos."""
+    with _LIVE_PROCS_LOCK:
+        procs = [p for p, t in _LIVE_PROCS.items() if threads is None or t in threads]
+    killed = 0
+    for p in procs:
+        if p.poll() is None:
+            try:
+                p.kill()
+                killed += 1
+            except OSError:
+                pass
+    return killed
 
 # ---------- Determinar carpeta base (donde está el .exe o el .py) ----------
 def get_base_dir():
@@ -71,28 +102,49 @@ Incluye ventanas Toplevel personalizadas para:
  - seleccionar carpeta y nombre de archivo para guardar el Excel
 """
 
-import os
 import re
-import threading
 import queue
-import platform
+import time
+import shutil
+import tempfile
+import json
+import hashlib
+import zlib
+import io
+import sqlite3
+import fnmatch
+import itertools
+import zipfile
+import struct
+from array import array
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from tkinter import Tk, StringVar, IntVar, BooleanVar, Toplevel, filedialog, messagebox, ttk, scrolledtext, Label, Button, Entry, Checkbutton
 import tkinter as tk
-from datetime import datetime
-from pdf2image import convert_from_path
-import pytesseract
+from datetime import datetime, timedelta
+from pdf2image import convert_from_path, convert_from_bytes
 from PIL import Image, ImageFilter, ImageOps
 import pandas as pd
+import numpy as np
 
 # ---------- Default CONFIG ----------
 DEFAULT_DPI = 600
 DEFAULT_LANG = "spa"
+MAX_WORKERS = 8   # tope del selector Workers de la GUI (y del ajuste automático)
+DEFAULT_WORKERS = max(1, min(MAX_WORKERS, (os.cpu_count() or 2) - 1))  # tareas OCR simultáneas
+BARCODE_DPI = 300         # resolución del render rápido para decodificar el código de barras
+PARSE_TIME_BUDGET = 0.25   # segundos máximos de parseo por documento antes de marcarlo como atípico
+DEFAULT_OCR_THREADS = 1    # hilos OpenMP por proceso tesseract (OMP_THREAD_LIMIT)
+RENDER_TIMEOUT_S = 120     # segundos máximos de poppler por página antes de matarlo
+OCR_TIMEOUT_S = 180        # segundos máximos de tesseract por página
+PREPROCESS_TIMEOUT_S = 60  # segundos máximos de preprocesado por página (proceso hijo)
+DOC_TIMEOUT_S = 900        # segundos máximos por documento (todas sus páginas)
 # ------------------------------------
 # Ruta relativa al ejecutable portable
-import subprocess
-import pytesseract
-import os
-import platform
 
 # Ruta al tesseract portable
 
@@ -207,6 +259,174 @@ def image_preprocess(img: Image.Image, upscale_if_small=True) -> Image.Image:
     return img
 
 
+# ---------- Páginas en blanco ----------
+# Los escaneos dúplex traen muchos reversos vacíos; se detectan sobre una miniatura
+# (tinta = píxeles bastante más oscuros que el fondo) y no pasan por preprocesado ni OCR.
+# La miniatura toma el mínimo de cada bloque (no el promedio) para no borrar el texto fino.
+BLANK_THUMB_WIDTH = 200     # ancho de la miniatura para el detector
+BLANK_INK_DELTA = 60        # niveles de gris por debajo del fondo para contar como tinta
+BLANK_INK_RATIO = 0.001     # fracción máxima de tinta para considerar la página en blanco
+BLANK_MARGIN = 0.05         # fracción de borde ignorada (sombras y perforaciones del escáner)
+
+def is_blank_page(img: Image.Image) -> bool:
+    """True si la página no tiene tinta apreciable (mira una miniatura en grises)."""
+    a = np.asarray(img.convert("L") if img.mode != "L" else img)
+    h, w = a.shape
+    mh, mw = int(h * BLANK_MARGIN), int(w * BLANK_MARGIN)
+    a = a[mh:h - mh or None, mw:w - mw or None]
+    f = max(1, a.shape[1] // BLANK_THUMB_WIDTH)
+    h2, w2 = a.shape[0] // f, a.shape[1] // f
+    if not h2 or not w2:
+        return True
+    # primero filas (memoria contigua) y luego columnas: bastante más rápido que min(axis=(1, 3))
+    small = a[:h2 * f, :w2 * f].reshape(h2, f, w2 * f).min(axis=1).reshape(h2, w2, f).min(axis=2).astype(np.int16)
+    background = np.median(small)   # papel gris o amarillento: umbral relativo al fondo
+    return (small < background - BLANK_INK_DELTA).mean() < BLANK_INK_RATIO
+
+
+# ---------- Orientación y enderezado ----------
+# Sobre una copia de baja resolución: el perfil de proyección de la tinta (suma por filas)
+# es más "picudo" cuando las líneas de texto quedan horizontales. Así se estima la
+# inclinación (±SKEW_MAX_DEG) y si la página está girada 90°. El giro de 180° no se ve
+# en el perfil: se resuelve con OSD de tesseract (o comparando la calidad del OCR) solo
+# cuando el primer OCR de la página sale mal. La corrección se guarda por documento.
+ORIENT_WIDTH = 1000        # ancho de la copia para estimar orientación/inclinación
+SKEW_MAX_DEG = 5.0         # inclinación máxima buscada (grados)
+SKEW_MIN_DEG = 0.3         # por debajo no se endereza (no vale la pena remuestrear)
+ORIENT_90_RATIO = 1.3      # perfil por columnas X veces más marcado que por filas -> girada 90°
+OCR_QUALITY_MIN = 0.5      # fracción mínima de tokens "legibles" para dar el OCR por bueno
+
+def _ink_coords(img):
+    """Coordenadas (filas, columnas) de tinta en una copia de ~ORIENT_WIDTH px de ancho."""
+    small = img.convert("L") if img.mode != "L" else img
+    f = max(1, small.width // ORIENT_WIDTH)
+    if f > 1:
+        small = small.reduce(f)
+    a = np.asarray(small)
+    ys, xs = np.nonzero(a < np.median(a) - BLANK_INK_DELTA)
+    step = max(1, len(ys) // 40000)   # con una muestra alcanza
+    return ys[::step].astype(np.float64), xs[::step].astype(np.float64)
+
+def _profile_score(ys, xs, deg):
+    """Qué tan marcado es el perfil de filas con la página girada deg grados."""
+    t = np.deg2rad(deg)
+    r = ys * np.cos(t) + xs * np.sin(t)
+    hist = np.bincount((r - r.min()).astype(np.int64))
+    return float(np.dot(hist, hist))
+
+def _profile_sharpness(coords):
+    """Perfil normalizado (1.0 = tinta repartida parejo): comparable entre filas y columnas."""
+    hist = np.bincount((coords - coords.min()).astype(np.int64))
+    return float(np.dot(hist, hist)) * len(hist) / len(coords) ** 2
+
+def _best_skew(ys, xs):
+    """(inclinación en grados del perfil de filas más marcado, nitidez de ese perfil ya enderezado)."""
+    best = max(np.arange(-SKEW_MAX_DEG, SKEW_MAX_DEG + 0.01, 0.5), key=lambda d: _profile_score(ys, xs, d))
+    best = max(np.arange(best - 0.4, best + 0.41, 0.1), key=lambda d: _profile_score(ys, xs, d))
+    t = np.deg2rad(best)
+    return float(best), _profile_sharpness(ys * np.cos(t) + xs * np.sin(t))
+
+def estimate_page_correction(img):
+    """
+    Giro en grados (antihorario, como Image.rotate) que deja las líneas horizontales:
+    90 si la página está acostada, más la inclinación estimada. 0.0 si no hay tinta suficiente.
+    Las dos orientaciones se comparan ya enderezadas: con la página acostada y además
+    inclinada (88°, 91°) ni filas ni columnas dan un perfil marcado sin enderezar.
+    """
+    ys, xs = _ink_coords(img)
+    if len(ys) < 500:
+        return 0.0
+    base = 0.0
+    best, sharp = _best_skew(ys, xs)
+    # tras girar 90° antihorario: fila' = ancho - x, columna' = y
+    best90, sharp90 = _best_skew(xs.max() - xs, ys)
+    if sharp90 > ORIENT_90_RATIO * sharp:
+        base, best = 90.0, best90
+    skew = -round(best, 1)   # con y hacia abajo el signo es el contrario al de Image.rotate
+    return base + (skew if abs(skew) >= SKEW_MIN_DEG else 0.0)
+
+def apply_page_correction(img, angle):
+    """
+    Gira img (fondo blanco): el múltiplo de 90° más cercano con transpose (sin remuestrear)
+    y el resto, la inclinación, con rotate y expand (no se recortan las esquinas).
+    """
+    turns = round((angle % 360) / 90.0)
+    rest = round((angle % 360) - turns * 90.0, 3)
+    quarter = turns % 4 * 90
+    if quarter:
+        img = img.transpose({90: Image.Transpose.ROTATE_90, 180: Image.Transpose.ROTATE_180,
+                             270: Image.Transpose.ROTATE_270}[quarter])
+    if not rest:
+        return img
+    fill = 255 if img.mode in ("L", "1") else (255,) * len(img.getbands())
+    return img.rotate(rest, resample=Image.BILINEAR, expand=True, fillcolor=fill)
+
+def ocr_quality(text):
+    """Fracción de tokens que parecen palabras o números (el OCR de una página invertida da basura)."""
+    tokens = (text or "").split()
+    if not tokens:
+        return 0.0
+    good = sum(1 for t in tokens
+               if re.fullmatch(r"[A-Za-zÁÉÍÓÚÑÜáéíóúñü]{2,}[.,:;]?|[$]?[0-9][0-9.,/\-]*[:]?", t))
+    return good / len(tokens)
+
+def osd_rotation(img):
+    """Giro (antihorario) que sugiere el OSD de tesseract, o None si no está disponible (falta osd.traineddata)."""
+    try:
+        osd = pytesseract.image_to_osd(img, config="--psm 0", timeout=OCR_TIMEOUT_S)
+    except Exception:
+        return None
+    m = re.search(r"Rotate:\s*(\d+)", osd)
+    # "Rotate" de tesseract es horario
+    return (360 - int(m.group(1))) % 360 if m else None
+
+def find_upright_rotation(img, text, lang, tesseract_config):
+    """
+    Para una página cuyo OCR salió mal: giro extra (0, 90, 180 o 270) que la endereza.
+    Usa OSD si está; si no, compara la calidad del OCR de una copia reducida girada 180°
+    (y 90°/270°, por si la detección de 90° eligió el lado equivocado).
+    """
+    rot = osd_rotation(img)
+    if rot is not None:
+        return rot
+    small = img.convert("L") if img.mode == "1" else img
+    if small.width >= 2000:
+        small = small.reduce(2)
+    best_rot, best_q = 0, ocr_quality(text)
+    for rot in (180, 90, 270):
+        try:
+            q = ocr_quality(pytesseract.image_to_string(apply_page_correction(small, rot), lang=lang,
+                                                        config=tesseract_config, timeout=OCR_TIMEOUT_S))
+        except Exception:
+            continue
+        if q > best_q + 0.1:
+            best_rot, best_q = rot, q
+        if best_q >= OCR_QUALITY_MIN:
+            break
+    return best_rot
+
+def recheck_upright(img, text, lang, tesseract_config):
+    """
+    Si el OCR de img salió mal (ocr_quality < OCR_QUALITY_MIN) busca el giro que la
+    endereza (find_upright_rotation) y repite el OCR. Devuelve (texto, giro extra); el giro
+    es 0 si el texto era bueno o la página girada no da un OCR mejor.
+    """
+    if ocr_quality(text) >= OCR_QUALITY_MIN:
+        return text, 0
+    rot = find_upright_rotation(img, text, lang, tesseract_config)
+    if not rot:
+        return text, 0
+    fixed = pytesseract.image_to_string(apply_page_correction(img, rot), lang=lang,
+                                        config=tesseract_config, timeout=OCR_TIMEOUT_S)
+    if ocr_quality(fixed) <= ocr_quality(text):
+        return text, 0
+    return fixed, rot
+
+def preprocess_page(img, angle=0.0):
+    """Endereza la página (apply_page_correction) y la preprocesa; corre en el proceso hijo."""
+    return image_preprocess(apply_page_correction(img, angle))
+
+
 def clean_barcode(s: str) -> str:
     if not s:
         return None
@@ -231,10 +451,6 @@ def find_first(pattern, text, flags=re.IGNORECASE):
         return m.group(1).strip()
     return None
 
-import re
-
-import re
-
 def clean_barcode(s: str) -> str:
     if not s:
         return None
@@ -247,21 +463,347 @@ def clean_digits(s: str) -> str:
     d = re.sub(r'\D', '', s)
     return d if len(d) >= 1 else None
 
+def is_gs1_line(ln: str) -> bool:
+    """
+    Equivalente lineal de re.fullmatch(r'(\(\d{2,4}\)\d+)+', ln):
+    recorre la línea una sola vez validando bloques "(AI)dígitos".
+    """
+    n = len(ln)
+    if n < 4 or ln[0] != "(":
+        return False
+    i = 0
+    while i < n:
+        if ln[i] != "(":
+            return False
+        j = i + 1
+        while j < n and ln[j].isdigit() and ln[j].isascii():
+            j += 1
+        if not (2 <= j - i - 1 <= 4) or j >= n or ln[j] != ")":
+            return False
+        k = j + 1
+        while k < n and ln[k].isdigit() and ln[k].isascii():
+            k += 1
+        if k == j + 1:
+            return False
+        i = k
+    return True
+
+# ---------- GS1-128: identificadores de aplicación (AI) ----------
+# AI -> (longitud fija, longitud máxima). Fijos: longitud exacta; variables: hasta el máximo
+# (en el código de barras real terminan con FNC1, en la línea legible con el siguiente "(").
+GS1_AI_SPEC = {
+    "00": (18, 18),     # SSCC
+    "01": (14, 14),     # GTIN
+    "415": (13, 13),    # GLN de la empresa que factura
+    "8020": (None, 25), # referencia de pago
+    "96": (None, 90),   # uso interno de la empresa: fecha límite AAAAMMDD
+}
+# 3900..3909: importe a pagar con n decimales, variable hasta 15
+for _n in range(10):
+    GS1_AI_SPEC[f"390{_n}"] = (None, 15)
+
+MESES_ES = ["ENE", "FEB", "MAR", "ABR", "MAY", "JUN", "JUL", "AGO", "SEP", "OCT", "NOV", "DIC"]
+
+def gs1_check_digit_ok(digits: str) -> bool:
+    """Valida el dígito de control GS1 (módulo 10, pesos 3/1 desde la derecha)."""
+    if not digits or not digits.isdigit() or len(digits) < 2:
+        return False
+    body, check = digits[:-1], int(digits[-1])
+    total = sum(int(d) * (3 if i % 2 == 0 else 1) for i, d in enumerate(reversed(body)))
+    return (10 - total % 10) % 10 == check
+
+def parse_gs1(raw: str) -> dict:
+    """
+    Separa una línea legible "(415)...(8020)...(3900)..." en {AI: valor}.
+    Devuelve None si la línea no tiene estructura GS1 o algún AI conocido
+    no respeta su longitud.
+    """
+    if not raw:
+        return None
+    s = re.sub(r"\s+", "", raw)
+    if not is_gs1_line(s):
+        return None
+    ais = {}
+    for block in s[1:].split("("):
+        ai, value = block.split(")", 1)
+        spec = GS1_AI_SPEC.get(ai)
+        if spec:
+            fixed, max_len = spec
+            if (fixed and len(value) != fixed) or len(value) > max_len:
+                return None
+        ais[ai] = value
+    return ais
+
+def normalize_ref(value):
+    """NoRefPago en un solo formato, venga del código (AI 8020, con ceros a la izquierda) o del texto."""
+    digits = re.sub(r"\D", "", str(value or ""))
+    return (digits.lstrip("0") or "0") if digits else None
+
+def amount_units(raw):
+    """Importe leído del texto en unidades, como el AI 390n: '$ 125,300.00' -> '125300' (None si no hay)."""
+    if not raw:
+        return None
+    s = str(raw).strip()
+    s = re.sub(r"[.,]\d{1,2}$", "", s)   # centavos (los grupos de miles siempre tienen 3 dígitos)
+    digits = re.sub(r"\D", "", s)
+    return str(int(digits)) if digits else None
+
+def gs1_fields(raw: str) -> tuple:
+    """
+    Traduce el código de barras a los campos del cupón:
+      - GLNEmpresa (AI 415), NoRefPago (AI 8020), ValorAPagar (AI 390n), ValidoHasta (AI 96)
+    Devuelve (campos, valido). 'valido' es True cuando la estructura es correcta, el GLN
+    pasa el dígito de control y hay referencia e importe; solo entonces se usa como vía rápida.
+    """
+    ais = parse_gs1(raw)
+    if not ais:
+        return {}, False
+
+    fields = {}
+    gln = ais.get("415")
+    if gln:
+        fields["GLNEmpresa"] = gln
+    ref = ais.get("8020")
+    if ref:
+        fields["NoRefPago"] = normalize_ref(ref)
+    for ai, value in ais.items():
+        if ai.startswith("390") and len(ai) == 4 and value:
+            decimals = int(ai[3])
+            fields["ValorAPagar"] = str(int(value[:-decimals] or "0") if decimals else int(value))
+            break
+    fecha = ais.get("96")
+    if fecha and len(fecha) == 8:
+        try:
+            d = datetime.strptime(fecha, "%Y%m%d")
+            fields["ValidoHasta"] = f"{d.day:02d}-{MESES_ES[d.month - 1]}-{d.year}"
+        except ValueError:
+            pass
+
+    valido = bool(gln and gs1_check_digit_ok(gln) and "NoRefPago" in fields and "ValorAPagar" in fields)
+    return fields, valido
+
+# ---------- Decodificador Code-128 directo del raster (sin OCR) ----------
+# Anchos barra/espacio de los 107 símbolos Code-128 (103-105 = Start A/B/C, 106 = Stop)
+CODE128_WIDTHS = [
+    "212222", "222122", "222221", "121223", "121322", "131222", "122213", "122312", "132212", "221213",
+    "221312", "231212", "112232", "122132", "122231", "113222", "123122", "123221", "223211", "221132",
+    "221231", "213212", "223112", "312131", "311222", "321122", "321221", "312212", "322112", "322211",
+    "212123", "212321", "232121", "111323", "131123", "131321", "112313", "132113", "132311", "211313",
+    "231113", "231311", "112133", "112331", "132131", "113123", "113321", "133121", "313121", "211331",
+    "231131", "213113", "213311", "213131", "311123", "311321", "331121", "312113", "312311", "332111",
+    "314111", "221411", "431111", "111224", "111422", "121124", "121421", "141122", "141221", "112214",
+    "112412", "122114", "122411", "142112", "142211", "241211", "221114", "413111", "241112", "134111",
+    "111242", "121142", "121241", "114212", "124112", "124211", "411212", "421112", "421211", "212141",
+    "214121", "412121", "111143", "111341", "131141", "114113", "114311", "411113", "411311", "113141",
+    "114131", "311141", "411131", "211412", "211214", "211232", "2331112",
+]
+_CODE128_LOOKUP = {w: v for v, w in enumerate(CODE128_WIDTHS[:106])}
+_CODE128_STOP = CODE128_WIDTHS[106]
+FNC1 = "\x1d"
+
+def _widths_key(ws, modules):
+    """Normaliza anchos en píxeles a módulos 1-4 ("212222")."""
+    module = sum(ws) / float(modules)
+    return "".join(str(min(4, max(1, int(w / module + 0.5)))) for w in ws)
+
+def _code128_symbol(ws):
+    """Devuelve el valor del símbolo de 6 anchos (en píxeles) o None."""
+    v = _CODE128_LOOKUP.get(_widths_key(ws, 11))
+    if v is not None:
+        return v
+    module = sum(ws) / 11.0
+    # redondeo ambiguo (tinta corrida a baja resolución): patrón más cercano
+    norm = [w / module for w in ws]
+    best, best_err = None, 1.6
+    for v, pat in enumerate(CODE128_WIDTHS[:106]):
+        err = sum(abs(n - int(p)) for n, p in zip(norm, pat))
+        if err < best_err:
+            best, best_err = v, err
+    return best
+
+def _code128_is_stop(ws):
+    return _widths_key(ws, 13) == _CODE128_STOP
+
+def decode_code128_runs(runs):
+    """
+    Busca y decodifica un símbolo Code-128 en una lista de anchos de rachas
+    alternadas (índices pares = barras). Devuelve la lista de valores
+    [start, datos...] con el checksum ya verificado, o None.
+    """
+    n = len(runs)
+    for i in range(0, n - 18, 2):
+        start = _CODE128_LOOKUP.get(_widths_key(runs[i:i + 6], 11))
+        if start not in (103, 104, 105):
+            continue
+        values = [start]
+        j = i + 6
+        while j + 7 <= n:
+            if _code128_is_stop(runs[j:j + 7]):
+                break
+            v = _code128_symbol(runs[j:j + 6])
+            if v is None or v >= 103:
+                values = None
+                break
+            values.append(v)
+            j += 6
+        else:
+            values = None
+        if not values or len(values) < 3:
+            continue
+        *body, check = values
+        if (body[0] + sum(k * v for k, v in enumerate(body[1:], start=1))) % 103 == check:
+            return body
+    return None
+
+def code128_values_to_text(values):
+    """Traduce valores Code-128 (con start) a texto; FNC1 se representa como '\\x1d'."""
+    codeset = {103: "A", 104: "B", 105: "C"}[values[0]]
+    out = []
+    shift = False
+    for v in values[1:]:
+        cs = ("A" if codeset == "B" else "B") if shift else codeset
+        shift = False
+        if v == 102:
+            out.append(FNC1)
+        elif cs == "C":
+            if v < 100:
+                out.append(f"{v:02d}")
+            else:
+                codeset = "B" if v == 100 else "A"
+        elif v == 99:
+            codeset = "C"
+        elif v == 98:
+            shift = True
+        elif (cs == "A" and v == 100) or (cs == "B" and v == 101):
+            codeset = "B" if cs == "A" else "A"
+        elif v >= 96:
+            pass  # FNC2/FNC3/FNC4: sin uso en cupones
+        elif cs == "B" or v < 64:
+            out.append(chr(v + 32))
+        else:
+            out.append(chr(v - 64))
+    return "".join(out)
+
+def gs1_element_string_to_hri(s: str) -> str:
+    """
+    Convierte la cadena GS1 del símbolo (FNC1 inicial + AIs, FNC1 tras los variables)
+    a la forma legible "(415)...(8020)...". Solo AIs conocidos en GS1_AI_SPEC.
+    """
+    if not s or not s.startswith(FNC1):
+        return None
+    s = s[1:]
+    parts = []
+    i = 0
+    while i < len(s):
+        ai = next((k for k in GS1_AI_SPEC if s.startswith(k, i)), None)
+        if not ai:
+            return None
+        i += len(ai)
+        fixed, _max_len = GS1_AI_SPEC[ai]
+        if fixed:
+            value = s[i:i + fixed]
+            i += fixed
+            if i < len(s) and s[i] == FNC1:
+                i += 1
+        else:
+            j = s.find(FNC1, i)
+            j = len(s) if j == -1 else j
+            value = s[i:j]
+            i = j + 1
+        parts.append(f"({ai}){value}")
+    return "".join(parts) or None
+
+def _row_runs(row):
+    """Rachas de un renglón de píxeles (uint8) empezando por la primera barra oscura."""
+    lo, hi = int(row.min()), int(row.max())
+    if hi - lo < 64:
+        return None
+    dark = row < (lo + hi) // 2
+    change = np.flatnonzero(dark[1:] != dark[:-1]) + 1
+    if len(change) < 60:
+        return None
+    widths = np.diff(np.concatenate(([0], change, [len(dark)])))
+    if not dark[0]:
+        widths = widths[1:]
+    return widths.tolist()
+
+def decode_barcode_from_image(img: Image.Image, row_step=4) -> str:
+    """
+    Recorre renglones de la imagen (de abajo hacia arriba, donde suele ir el código)
+    buscando un GS1-128 válido. Prueba también el sentido inverso (página girada 180°).
+    Devuelve la forma legible "(AI)valor..." o None.
+    """
+    arr = np.asarray(img.convert("L"), dtype=np.uint8)
+    for y in range(arr.shape[0] - 1, -1, -row_step):
+        row = arr[y]
+        for r in (row, row[::-1]):
+            runs = _row_runs(r)
+            if not runs:
+                break
+            values = decode_code128_runs(runs)
+            if values:
+                hri = gs1_element_string_to_hri(code128_values_to_text(values))
+                if hri and is_gs1_line(hri):
+                    return hri
+    return None
+
+def decode_barcode_from_pdf(pdf_path, dpi=BARCODE_DPI, max_pages=2, logger=None,
+                            first_page=1, last_page=None) -> str:
+    """
+    Renderiza hasta 'max_pages' páginas (desde first_page, sin pasar de last_page)
+    a baja resolución y decodifica el Code-128.
+    Devuelve la primera línea GS1 legible encontrada o None (nunca lanza).
+    """
+    stop = first_page + max_pages - 1
+    if last_page:
+        stop = min(stop, last_page)
+    try:
+        for page in render_pdf_pages(pdf_path, dpi=dpi, grayscale=True, first_page=first_page, last_page=stop,
+                                     timeout=RENDER_TIMEOUT_S * (stop - first_page + 1)):
+            hri = decode_barcode_from_image(page)
+            if hri:
+                return hri
+    except Exception as e:
+        if logger:
+            logger(f"Decodificación de código de barras fallo para {os.path.basename(pdf_input_name(pdf_path))}: {e}")
+    return None
+
 def extract_fields_from_text(text: str) -> dict:
     """
     Heurística mejorada:
     - Cliente (MAYÚSCULAS)
     - Identificacion, Contrato, DirCliente, NoSolicitud, NoRefPago, TipoCupon,
-      ValidoHasta, ValorAPagar, CodigoBarraRaw, CodigoBarraLimpio
+      ValidoHasta, ValorAPagar, CodigoBarraRaw, CodigoBarraLimpio, GLNEmpresa
+    - Si hay un código GS1-128 válido, NoRefPago/ValorAPagar/ValidoHasta salen de él
+    - DiscrepanciaCodigo: referencia o importe del texto que no coinciden con los del código
     """
     data = {
         "Cliente": None, "Identificacion": None, "Contrato": None, "DirCliente": None,
         "NoSolicitud": None, "NoRefPago": None, "TipoCupon": None, "ValidoHasta": None,
-        "ValorAPagar": None, "CodigoBarraRaw": None, "CodigoBarraLimpio": None
+        "ValorAPagar": None, "CodigoBarraRaw": None, "CodigoBarraLimpio": None,
+        "GLNEmpresa": None, "DiscrepanciaCodigo": None
     }
 
     txt = text.replace("\r", "\n")
 
+    # --- Código de barra primero: solo líneas con formato GS1-128 válido
+    barcode_line = None
+    for ln in reversed(txt.splitlines()):
+        ln = ln.strip()
+        # Patrón GS1-128: (AI)valor repetido, con AI de 2+ dígitos
+        if ln and is_gs1_line(ln):
+            barcode_line = ln
+            break
+    gs1, gs1_ok = gs1_fields(barcode_line)
+    if barcode_line:
+        data["CodigoBarraRaw"] = barcode_line
+        data["CodigoBarraLimpio"] = clean_barcode(barcode_line)
+        data["GLNEmpresa"] = gs1.get("GLNEmpresa")
+    if gs1_ok and gs1.get("ValidoHasta"):
+        # el código de barras válido manda sobre las heurísticas; referencia e importe
+        # se leen igual del texto para la validación cruzada (ver más abajo)
+        data["ValidoHasta"] = gs1["ValidoHasta"]
+
         # --- Cliente: asume que está en MAYÚSCULAS y tras "Cliente:" (mejor extracción multilinea)
         # --- Cliente: extracción multiline mejorada y limpieza
         # --- Cliente: extracción multilínea mejorada y limpieza robusta ---
@@ -398,9 +940,11 @@ def extract_fields_from_text(text: str) -> dict:
     # --- Identificación: etiqueta o número en la misma línea que cliente
     m = re.search(r"Identificaci[oó]n[:\s]*([\d\-\s]{6,20})", txt, flags=re.IGNORECASE)
     if not m:
-        m2 = re.search(r"Cliente[:\s].*?(\d{6,12})", txt)
+        # antes: r"Cliente[:\s].*?(\d{6,12})" -> se recorre solo la línea de "Cliente"
+        m2 = re.search(r"Cliente[:\s]", txt)
         if m2:
-            m = m2
+            line_end = txt.find("\n", m2.end())
+            m = re.search(r"(\d{6,12})", txt[m2.end(): line_end if line_end != -1 else len(txt)])
     if m:
         data["Identificacion"] = re.sub(r"\D", "", m.group(1))
 
@@ -410,21 +954,24 @@ def extract_fields_from_text(text: str) -> dict:
         data["Contrato"] = m.group(1)
 
     # --- DirCliente (intenta etiqueta o patrón 'KR/CL/AV')
-    m = re.search(r"Dir(?:\.|eccion)?(?:\.|:)?\s*Cliente[:\s]*([A-Z0-9ÁÉÍÓÚÑ\-\.,#\s]{3,200})", txt, flags=re.IGNORECASE)
+    # clase acotada a una sola línea (admite un salto tras la etiqueta) para evitar backtracking
+    m = re.search(r"Dir(?:\.|eccion)?(?:\.|:)?[ \t]*Cliente[: \t]*(?:\n[ \t]*)?([A-Z0-9ÁÉÍÓÚÑ\-\.,# \t]{3,200})", txt, flags=re.IGNORECASE)
     if not m:
         m = re.search(r"((?:KR|CL|AV|C[^\n]{1,30}|[A-Z]{2,5}\s*\d{1,3})[^\n]{0,60})", txt, flags=re.IGNORECASE)
     if m:
         data["DirCliente"] = m.group(1).strip().split("\n")[0].strip()
 
     # --- NoRefPago
-    m = re.search(r"No\.?\s*Ref\.?\s*[:\s]*Pago[:\s]*([0-9]{5,30})", txt, flags=re.IGNORECASE)
-    if not m:
-        m = re.search(r"No\.?\s*Ref\.?\s*[:\s]*([0-9]{5,30})", txt, flags=re.IGNORECASE)
-    if m:
-        data["NoRefPago"] = m.group(1)
+    # "\s*[:\s]*" se fusiona en "[:\s]*" (mismo lenguaje, sin cuantificadores solapados)
+    if not data["NoRefPago"]:
+        m = re.search(r"No\.?\s*Ref\.?[:\s]*Pago[:\s]*([0-9]{5,30})", txt, flags=re.IGNORECASE)
+        if not m:
+            m = re.search(r"No\.?\s*Ref\.?[:\s]*([0-9]{5,30})", txt, flags=re.IGNORECASE)
+        if m:
+            data["NoRefPago"] = m.group(1)
 
     # --- TipoCupon
-    m = re.search(r"Tipo\s*(?:de)?\s*Cup[oó]n[:\s]*([A-Z0-9\-]{1,20})", txt, flags=re.IGNORECASE)
+    m = re.search(r"Tipo\s*(?:de\s*)?Cup[oó]n[:\s]*([A-Z0-9\-]{1,20})", txt, flags=re.IGNORECASE)
     if not m:
         m = re.search(r"Tipo(?:\s+de)?[:\s]*([A-Z]{1,6})", txt, flags=re.IGNORECASE)
     if m:
@@ -435,7 +982,8 @@ def extract_fields_from_text(text: str) -> dict:
             data["NoSolicitud"] = None
 
     # --- ValidoHasta (fecha dd-MMM-YYYY, corrige 0 por O en los meses)
-    m = re.search(r"([0-9]{1,2}[-/][A-Z0-9]{3,}[-/][0-9]{4})", txt, flags=re.IGNORECASE)
+    # mes acotado a 12 caracteres ("SEPTIEMBRE" es el más largo)
+    m = None if data["ValidoHasta"] else re.search(r"([0-9]{1,2}[-/][A-Z0-9]{3,12}[-/][0-9]{4})", txt, flags=re.IGNORECASE)
     if m:
         fecha = m.group(1).upper()
         # Corrige confusiones del OCR: 0 → O en el mes
@@ -452,7 +1000,8 @@ def extract_fields_from_text(text: str) -> dict:
     #  2) texto explícito "Valor a pagar" (aunque no tenga $) — extraer números cercanos
     #  3) etiquetas Total / Total Efectivo cercanas
     #  4) secuencia numérica razonable que NO sea una fecha (evitar dd-MMM-YYYY)
-    amount = None
+    amount = data["ValorAPagar"]
+    amount_raw = None   # importe tal como se leyó (pasos 1-3), para compararlo con el del código
 
     # helper: comprueba si la cadena es un formato de fecha (dd-MMM-YYYY o dd/mm/yyyy)
     def is_date_like(s):
@@ -466,8 +1015,9 @@ def extract_fields_from_text(text: str) -> dict:
         return False
 
     # 1) buscar montos con $ (mejor precisión)
-    m = re.search(r"\$\s*([0-9]{1,3}(?:[.,][0-9]{3})*(?:[.,][0-9]{1,2})?)", txt)
+    m = None if amount else re.search(r"\$\s*([0-9]{1,3}(?:[.,][0-9]{3})*(?:[.,][0-9]{1,2})?)", txt)
     if m:
+        amount_raw = m.group(1)
         amount = re.sub(r'[^0-9]', '', m.group(1))
 
     # 2) si no hay $, buscar "Valor a pagar" y extraer el primer número que no sea fecha
@@ -480,6 +1030,7 @@ def extract_fields_from_text(text: str) -> dict:
             if m2:
                 cand = m2.group(1)
                 if not is_date_like(cand):
+                    amount_raw = cand
                     amount = re.sub(r'[^0-9]', '', cand)
 
     # 3) fallback: buscar cerca de 'Total' o 'Total Efectivo'
@@ -490,6 +1041,7 @@ def extract_fields_from_text(text: str) -> dict:
                 window = txt[max(0, pos-40): pos+80]
                 m3 = re.search(r"([0-9]{1,3}(?:[.,][0-9]{3})*(?:[.,][0-9]{1,2})?)", window)
                 if m3 and not is_date_like(m3.group(1)):
+                    amount_raw = m3.group(1)
                     amount = re.sub(r'[^0-9]', '', m3.group(1))
                     break
 
@@ -523,23 +1075,30 @@ def extract_fields_from_text(text: str) -> dict:
         data["ValorAPagar"] = None
 # ------------------ FIN BLOQUE ------------------
 
-    # --- Código de barra: última línea con paréntesis/dígitos largos
-    # --- Código de barra: solo líneas con formato GS1-128 válido
-    lines = [ln.strip() for ln in txt.splitlines() if ln.strip()]
-    barcode_line = None
-    for ln in reversed(lines):
-        # Patrón GS1-128: (AI)valor repetido, con AI de 2+ dígitos
-        if re.fullmatch(r'(\(\d{2,4}\)\d+)+', ln):
-            barcode_line = ln
-            break
-    if barcode_line:
-        data["CodigoBarraRaw"] = barcode_line
-        data["CodigoBarraLimpio"] = clean_barcode(barcode_line)
-     # --- Importe desde AI 3900
-    m3900 = re.search(r'\(3900\)(\d{4,12})', barcode_line)
-    if m3900:
-        # sin decimales (entero)
-        data["ValorAPagar"] = str(int(m3900.group(1)))
+    # Validación cruzada: referencia e importe del texto contra los del código de barras
+    # (el importe del paso 4 es una adivinanza y no se compara). Una diferencia no cambia
+    # qué valor se usa, solo queda anotada para revisar el OCR o el decodificador.
+    mismatches = []
+    text_ref = normalize_ref(data["NoRefPago"])
+    if gs1.get("NoRefPago") and text_ref and text_ref != gs1["NoRefPago"]:
+        mismatches.append(f"NoRefPago: texto {text_ref} ≠ código {gs1['NoRefPago']}")
+    text_amount = amount_units(amount_raw)
+    if gs1.get("ValorAPagar") and text_amount and text_amount != gs1["ValorAPagar"]:
+        mismatches.append(f"ValorAPagar: texto {text_amount} ≠ código {gs1['ValorAPagar']}")
+    data["DiscrepanciaCodigo"] = "; ".join(mismatches) or None
+    if gs1_ok:
+        data["NoRefPago"] = gs1["NoRefPago"]
+        data["ValorAPagar"] = gs1["ValorAPagar"]
+
+    # Código de barras presente pero no válido (dígito de control, campos faltantes):
+    # el importe AI 390n sigue mandando sobre el texto (el "$" del OCR arrastra centavos);
+    # referencia y fecha solo sirven de respaldo si las heurísticas no las encontraron
+    if barcode_line and not gs1_ok:
+        if gs1.get("ValorAPagar"):
+            data["ValorAPagar"] = gs1["ValorAPagar"]
+        for k in ("NoRefPago", "ValidoHasta"):
+            if not data[k] and gs1.get(k):
+                data[k] = gs1[k]
 
     # ---------------- REEMPLAZAR LA SECCIÓN NoSolicitud POR ESTE BLOQUE ----------------
     # ------------------ NoSolicitud (siguiendo tu regla: línea No. Ref -> 1º FAX, 2º NoSolicitud) ------------------
@@ -547,9 +1106,12 @@ def extract_fields_from_text(text: str) -> dict:
     found = None
 
     # Buscar la línea que contiene "No. Ref" (variantes)
-    m_ref_line = re.search(r"^(.*No\.?\s*Ref\.?.*)$", txt, flags=re.IGNORECASE | re.MULTILINE)
+    # se localiza la etiqueta y luego se expande a la línea completa (sin ".*" anclado a "^")
+    m_ref_line = re.search(r"No\.?\s*Ref", txt, flags=re.IGNORECASE)
     if m_ref_line:
-        line = m_ref_line.group(1)
+        line_start = txt.rfind("\n", 0, m_ref_line.start()) + 1
+        line_end = txt.find("\n", m_ref_line.end())
+        line = txt[line_start: line_end if line_end != -1 else len(txt)]
         # extraer todos los números largos (6+ dígitos) de esa línea, en el orden que aparecen
         nums = [mo.group(0) for mo in re.finditer(r"[0-9]{6,15}", line)]
         if len(nums) >= 2:
@@ -567,7 +1129,7 @@ def extract_fields_from_text(text: str) -> dict:
             # Solo hay un número largo en la línea. Intentar buscar contexto cercano
             #  a) si en la misma línea aparece 'FAX' justo antes del número, ese será fax -> buscar número siguiente en ventana del texto
             # (Tomamos ±200 caracteres alrededor de la posición de la línea en el texto)
-            pos = m_ref_line.start(1)
+            pos = line_start
             window = txt[max(0, pos-200): pos+200]
             all_nums_window = [mo.group(0) for mo in re.finditer(r"[0-9]{6,15}", window)]
             # si hay al menos 2 en la ventana, preferimos el que no sea el primero (asumiendo fax primero)
@@ -605,136 +1167,3321 @@ def extract_fields_from_text(text: str) -> dict:
         found = None
 
     data["NoSolicitud"] = re.sub(r"\D", "", found) if found else None
+    data["NoRefPago"] = normalize_ref(data["NoRefPago"])
 
     return data
 
 
+def extract_fields_timed(text: str, budget=PARSE_TIME_BUDGET, logger=None):
+    """
+    Ejecuta extract_fields_from_text midiendo el tiempo de parseo.
+    Devuelve (data, segundos). Si se supera 'budget', se avisa por logger
+    para poder localizar documentos atípicos (OCR con mucha basura).
+    """
+    t0 = time.perf_counter()
+    data = extract_fields_from_text(text)
+    elapsed = time.perf_counter() - t0
+    if budget and elapsed > budget and logger:
+        logger(f"⏱️ Parseo lento: {elapsed*1000:.0f} ms (presupuesto {budget*1000:.0f} ms, {len(text)} caracteres)")
+    return data, elapsed
+
+
+# ---------- Varios cupones por PDF ----------
+# Las exportaciones de facturación llegan como un solo PDF con un cupón por página
+# (a veces más de uno). En modo "por página" cada página (o cada bloque de cupón
+# detectado dentro de ella) produce su propio registro con el número de página.
+KEY_FIELDS = ("NoRefPago", "Cliente", "Contrato", "ValorAPagar")   # sin ninguno no es un cupón
+
+def split_coupons(text: str) -> list:
+    """
+    Parte el texto de una página en bloques de cupón: cada código de barras GS1 cierra
+    un cupón; si no hay más de uno, se corta antes de cada línea "Cliente:" repetida.
+    Con un solo cupón devuelve [text].
+    """
+    lines = (text or "").replace("\r", "\n").splitlines()
+    ends = [i for i, ln in enumerate(lines) if ln.strip() and is_gs1_line(ln.strip())]
+    if len(ends) >= 2:
+        cuts = [e + 1 for e in ends[:-1]]
+    else:
+        starts = [i for i, ln in enumerate(lines) if re.match(r"\s*Cliente\s*:", ln, re.IGNORECASE)]
+        cuts = starts[1:]
+    if not cuts:
+        return [text]
+    bounds = [0] + cuts + [len(lines)]
+    return ["\n".join(lines[a:b]) for a, b in zip(bounds, bounds[1:]) if "".join(lines[a:b]).strip()]
+
+def extract_coupon_records(page_texts: dict, logger=None) -> list:
+    """
+    Un registro por cupón a partir de {página: texto}: campos de extract_fields_timed
+    más "Pagina" y "CuponEnPagina". Páginas o bloques sin ningún campo clave se omiten.
+    """
+    records = []
+    for page in sorted(page_texts):
+        for k, block in enumerate(split_coupons(page_texts[page]), start=1):
+            data, _ = extract_fields_timed(block, logger=logger)
+            if not any(data.get(f) for f in KEY_FIELDS):
+                continue
+            data["Pagina"] = page
+            data["CuponEnPagina"] = k
+            records.append(data)
+    return records
+
+
+def benchmark_parser_worst_case(size=200_000, budget=PARSE_TIME_BUDGET):
+    """
+    Mide extract_fields_from_text sobre entradas patológicas (texto OCR basura)
+    que antes provocaban backtracking. Devuelve lista de (caso, caracteres, segundos, dentro_de_presupuesto).
+    """
+    cases = {
+        "parentesis_gs1": "(415)" + "(12)1" * (size // 5) + "(",
+        "digitos_largos": "(8020)" + "9" * size + "x",
+        "espacios_ref": "No Ref" + " " * size + "x",
+        "espacios_tipo": "Tipo" + " " * size + "Cupo",
+        "direccion": "Dir Cliente:" + " " * size + "@",
+        "cliente_sin_id": ("Cliente: " + "A" * 80 + "\n") * (size // 90),
+        "fechas_rotas": "1-" + "A" * size,
+        "basura_mixta": ("No.Ref Cliente: (12)3 $ 1,000 Total 1-AB " + "#." * 20 + "\n") * (size // 100),
+    }
+    results = []
+    for name, text in cases.items():
+        t0 = time.perf_counter()
+        extract_fields_from_text(text)
+        elapsed = time.perf_counter() - t0
+        results.append((name, len(text), elapsed, elapsed <= budget))
+    return results
+
+
 import pdfplumber  # colocarlo al inicio junto con tus imports
 
 def extract_text_from_pdf(pdf_path, dpi=600, lang='spa', tesseract_config="--psm 6",
                           save_ocr_text=False, ocr_text_dir=None, logger=None,
-                          selectable_text_min_chars=50):
+                          selectable_text_min_chars=50, barcode_first=True,
+                          barcode_dpi=BARCODE_DPI, skip_ocr_on_barcode=False,
+                          try_text_layer=True, first_page=None, last_page=None):
     """
     Extrae texto de un PDF intentando primero obtener texto seleccionable (pdfplumber).
     Si no se detecta texto suficiente (menos de selectable_text_min_chars), hace OCR
     usando pdf2image + pytesseract y devuelve ese texto.
     Parámetros:
-      - pdf_path: ruta al PDF
+      - pdf_path: ruta al PDF, miembro de ZIP ('lote.zip!/cupon.pdf'), bytes o archivo abierto
       - dpi: resolución para convertir páginas a imagen (si OCR requerido)
       - lang: idiomas para tesseract (ej: 'spa')
       - tesseract_config: configuración de tesseract (ej: "--psm 6")
-      - save_ocr_text: si True guarda .txt con el texto OCR
-      - ocr_text_dir: carpeta donde guardar .txt
+      - save_ocr_text: si True guarda el texto OCR en el archivo comprimido (OcrTextArchive)
+      - ocr_text_dir: carpeta del archivo de texto OCR
       - selectable_text_min_chars: mínimo de caracteres para considerar "texto seleccionable útil"
+      - barcode_first: antes del OCR, decodifica el Code-128 sobre un render a barcode_dpi;
+        la línea GS1 obtenida se agrega al final del texto (tiene prioridad sobre la del OCR)
+      - skip_ocr_on_barcode: si el código se decodifica, omite el OCR de página completa
+        (solo se obtienen los campos del código: referencia, importe, fecha, GLN)
+      - try_text_layer: False para ir directo al OCR (el triage ya detectó que no hay texto)
+      - first_page / last_page: rango de páginas (1-based, inclusivo) para tareas parciales
     """
-    # 1) Intentar texto seleccionable con pdfplumber
-    try:
-        text_pages = []
-        with pdfplumber.open(pdf_path) as pdf:
-            for page in pdf.pages:
-                # extrae texto de la página; strip() para eliminar espacios extra
-                t = page.extract_text()
-                if t:
-                    text_pages.append(t)
-        selectable_text = "\n\n".join(text_pages).strip()
+    # buffers y miembros de ZIP se leen una sola vez a memoria (pdfplumber los usa tal cual)
+    name = pdf_input_name(pdf_path)
+    if not is_plain_path(pdf_path):
+        pdf_path = read_pdf_bytes(pdf_path)
+
+    # 1) Intentar texto seleccionable con pdfplumber (se omite si el triage ya vio que es un escaneo)
+    if try_text_layer:
+        selectable_text = extract_selectable_text(pdf_path, selectable_text_min_chars,
+                                                  first_page=first_page, last_page=last_page, logger=logger)
         # si hay texto seleccionable suficiente, devolverlo directamente
-        if selectable_text and len(re.sub(r'\s+', '', selectable_text)) >= selectable_text_min_chars:
+        if selectable_text is not None:
             if logger:
-                logger(f"Usando texto seleccionable de: {os.path.basename(pdf_path)}")
-            # opcional: normalizar saltos de línea múltiples
+                logger(f"Usando texto seleccionable de: {os.path.basename(name)}")
             return selectable_text
-    except Exception as e:
-        # si falla pdfplumber (archivo raro), seguimos a OCR sin interrumpir
-        if logger:
-            logger(f"pdfplumber fallo para {os.path.basename(pdf_path)}: {e}. Se intentará OCR.")
 
-    # 2) Si no hay texto seleccionable suficiente -> usar OCR (imagen)
+    # 2) Código de barras directo del raster (render rápido, sin tesseract)
+    barcode_hri = None
+    if barcode_first:
+        barcode_hri = decode_barcode_from_pdf(pdf_path, dpi=barcode_dpi, logger=logger,
+                                              first_page=first_page or 1, last_page=last_page)
+        if barcode_hri and logger:
+            logger(f"Código de barras decodificado en {os.path.basename(name)}: {barcode_hri}")
+        if barcode_hri and skip_ocr_on_barcode:
+            return barcode_hri
+
+    # 3) Si no hay texto seleccionable suficiente -> usar OCR (imagen)
     # Convertir páginas a imágenes
-    pages = convert_from_path(pdf_path, dpi=dpi)
+    pages = render_pdf_pages(pdf_path, dpi=dpi, first_page=first_page, last_page=last_page, timeout=DOC_TIMEOUT_S)
     texts = []
+    blank = 0
+    angle = None   # corrección de orientación/inclinación, estimada en la primera página con tinta
+    checked = False   # giro de 180° revisado con el primer OCR (como run_batch)
     for _i, page in enumerate(pages):
         # aplicar preprocesado (tu función image_preprocess)
         try:
-            img = image_preprocess(page)
-            text = pytesseract.image_to_string(img, lang=lang, config=tesseract_config)
+            if is_blank_page(page):
+                blank += 1
+                continue
+            if angle is None:
+                angle = estimate_page_correction(page)
+            img = preprocess_page(page, angle)
+            text = pytesseract.image_to_string(img, lang=lang, config=tesseract_config, timeout=OCR_TIMEOUT_S)
+            if not checked:
+                checked = True
+                text, rot = recheck_upright(img, text, lang, tesseract_config)
+                if rot:
+                    angle = (angle + rot) % 360
+                    if logger:
+                        logger(f"🔄 {os.path.basename(name)}: página girada {rot}°, se corrige el documento")
             texts.append(text)
         except Exception as e:
             # si falla en una página, seguir con las demás
             if logger:
-                logger(f"OCR fallo en página {_i+1} de {os.path.basename(pdf_path)}: {e}")
+                logger(f"OCR fallo en página {_i + (first_page or 1)} de {os.path.basename(name)}: {e}")
+    if blank and logger:
+        logger(f"{blank} página(s) en blanco omitidas en {os.path.basename(name)}")
     full_text = "\n\n".join(texts)
+    if barcode_hri:
+        full_text += "\n" + barcode_hri
 
-    # 3) Guardar .txt si se solicita
+    # 4) Guardar .txt si se solicita
     if save_ocr_text and ocr_text_dir:
+        save_ocr_text_file(name, full_text, ocr_text_dir, logger=logger)
+
+    return full_text
+
+
+def save_ocr_text_file(pdf_path, text, ocr_text_dir, logger=None, archive=None):
+    """Agrega el texto OCR de un PDF al archivo comprimido de ocr_text_dir (ver OcrTextArchive)."""
+    try:
+        if archive is not None:
+            archive.add(pdf_path, text)
+            return
+        with OcrTextArchive(ocr_text_dir) as arc:
+            arc.add(pdf_path, text)
+    except Exception as e:
+        if logger:
+            logger(f"No se pudo archivar el texto OCR de {pdf_path}: {e}")
+
+
+# ---------- Archivo de texto OCR ----------
+# Un .txt por PDF son millones de archivos diminutos en el recurso compartido. En su lugar,
+# ocr_text_dir tiene dos archivos: OCR_ARCHIVE_DATA, solo-agregar, con el texto de cada PDF
+# comprimido con zlib uno detrás de otro, y OCR_ARCHIVE_INDEX (SQLite) con ruta, nombre, offset
+# y largo de cada registro más un índice de texto completo FTS5 (sin contenido: el texto vive
+# solo en el archivo). Los importes se indexan también sin separadores ("125,300.00" -> 125300).
+# Cada PDF se identifica por su ruta (o "lote.zip!/miembro"): dos cupon.pdf de carpetas
+# distintas son dos registros. Cada add() es su propia transacción corta, que también ordena
+# las escrituras al archivo de datos si varios procesos comparten la carpeta.
+# export() vuelve a escribir un .txt por PDF si hace falta.
+OCR_ARCHIVE_DATA = "ocr_texto.arc"
+OCR_ARCHIVE_INDEX = "ocr_texto.idx"
+AMOUNT_RE = re.compile(r"\d{1,3}(?:[.,]\d{3})+(?:[.,]\d{2})?(?!\d)")
+
+def _amount_tokens(text):
+    """Importes con separadores de miles como entero: '$ 125,300.00' -> '125300'."""
+    out = []
+    for m in AMOUNT_RE.finditer(text):
+        s = m.group(0)
+        if len(s) > 3 and s[-3] in ".," and s[-3] != s[-7:-6]:
+            s = s[:-3]   # decimales
+        out.append(re.sub(r"\D", "", s))
+    return out
+
+def fts_query(query):
+    """Consulta del operador -> expresión FTS5: todas las palabras (AND), 'pala*' como prefijo."""
+    terms = []
+    for tok in query.split():
+        prefix = tok.endswith("*")
+        tok = tok.rstrip("*")
+        for t in [tok] + _amount_tokens(tok):
+            t = t.strip(".,;:$()")
+            if t:
+                terms.append('"' + t.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(dict.fromkeys(terms))
+
+class OcrTextArchive:
+    """Texto OCR de muchos PDFs en un archivo comprimido con índice (usar con 'with' o close())."""
+
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self._lock = threading.Lock()
+        self._data = open(os.path.join(folder, OCR_ARCHIVE_DATA), "a+b")
+        self._db = sqlite3.connect(os.path.join(folder, OCR_ARCHIVE_INDEX), timeout=60,
+                                   isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=DELETE")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS docs (
+            id INTEGER PRIMARY KEY, name TEXT NOT NULL, path TEXT, offset INTEGER NOT NULL,
+            length INTEGER NOT NULL, chars INTEGER NOT NULL, created TEXT)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS docs_name ON docs (name)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS docs_path ON docs (path)")
         try:
-            os.makedirs(ocr_text_dir, exist_ok=True)
-            fn = os.path.splitext(os.path.basename(pdf_path))[0] + ".txt"
-            with open(os.path.join(ocr_text_dir, fn), "w", encoding="utf-8") as f:
-                f.write(full_text)
-        except Exception as e:
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5("
+                             "name, body, content='', tokenize='unicode61 remove_diacritics 2')")
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False   # SQLite sin FTS5: search() recorre el archivo
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, pdf_path, text):
+        """Agrega el texto de un PDF. Devuelve su id (el último agregado con una ruta es el vigente)."""
+        path = str(pdf_input_name(pdf_path))
+        name = os.path.basename(path)
+        blob = zlib.compress((text or "").encode("utf-8"), 6)
+        body = (text or "") + "\n" + " ".join(_amount_tokens(text or ""))
+        with self._lock:
+            # el lock de escritura de SQLite también cubre el offset del archivo de datos
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._data.seek(0, os.SEEK_END)
+                offset = self._data.tell()
+                self._data.write(blob)
+                self._data.flush()
+                cur = self._db.execute("INSERT INTO docs (name, path, offset, length, chars, created) VALUES (?,?,?,?,?,?)",
+                                       (name, path, offset, len(blob), len(text or ""),
+                                        datetime.now().isoformat(timespec="seconds")))
+                doc_id = cur.lastrowid
+                if self.fts:
+                    self._db.execute("INSERT INTO docs_fts (rowid, name, body) VALUES (?, ?, ?)",
+                                     (doc_id, os.path.splitext(name)[0], body))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return doc_id
+
+    def _read(self, offset, length):
+        self._data.seek(offset)
+        return zlib.decompress(self._data.read(length)).decode("utf-8")
+
+    def get(self, path):
+        """
+        Texto vigente de un PDF por su ruta (None si no está). Con solo el nombre de archivo
+        devuelve el más reciente de los PDFs que se llaman así.
+        """
+        path = str(pdf_input_name(path))
+        with self._lock:
+            row = self._db.execute("SELECT offset, length FROM docs WHERE path = ? ORDER BY id DESC LIMIT 1",
+                                   (path,)).fetchone()
+            if row is None and os.path.basename(path) == path:
+                row = self._db.execute("SELECT offset, length FROM docs WHERE name = ? ORDER BY id DESC LIMIT 1",
+                                       (path,)).fetchone()
+            return self._read(*row) if row else None
+
+    def search(self, query, limit=50):
+        """[(ruta, fragmento)] de los PDFs (versión vigente) cuyo texto tiene todas las palabras de query."""
+        words = [w.strip("*") for w in query.split() if w.strip("*")]
+        with self._lock:
+            if self.fts:
+                expr = fts_query(query)
+                if not expr:
+                    return []
+                rows = self._db.execute(
+                    "SELECT d.path, d.offset, d.length FROM docs_fts f JOIN docs d ON d.id = f.rowid "
+                    "WHERE docs_fts MATCH ? AND d.id = (SELECT MAX(id) FROM docs WHERE path = d.path) "
+                    "ORDER BY f.rank LIMIT ?", (expr, limit)).fetchall()
+                hits = [(name, self._read(offset, length)) for name, offset, length in rows]
+            else:
+                hits = []
+                for name, offset, length in self._db.execute(
+                        "SELECT path, offset, length FROM docs WHERE id IN (SELECT MAX(id) FROM docs GROUP BY path)"):
+                    text = self._read(offset, length)
+                    if all(w.lower() in text.lower() for w in words):
+                        hits.append((name, text))
+                        if len(hits) >= limit:
+                            break
+        return [(name, _snippet(text, words)) for name, text in hits]
+
+    def export(self, dest_dir, names=None, logger=None):
+        """
+        Escribe un .txt en dest_dir por cada PDF (todos o los de names, por ruta o nombre),
+        con las subcarpetas de su ruta a partir de la carpeta común (ver _export_paths).
+        Devuelve cuántos.
+        """
+        wanted = {str(pdf_input_name(n)) for n in names} if names else None
+        with self._lock:
+            rows = self._db.execute("SELECT path, name, offset, length FROM docs WHERE id IN "
+                                    "(SELECT MAX(id) FROM docs GROUP BY path) ORDER BY path").fetchall()
+        rows = [r for r in rows if wanted is None or r[0] in wanted or r[1] in wanted]
+        targets = _export_paths([r[0] for r in rows])
+        count = 0
+        for path, _name, offset, length in rows:
+            with self._lock:
+                text = self._read(offset, length)
+            target = os.path.join(dest_dir, targets[path])
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "w", encoding="utf-8") as f:
+                f.write(text)
+            count += 1
+        if logger:
+            logger(f"📝 {count} archivos .txt exportados a {dest_dir}")
+        return count
+
+    def count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(DISTINCT path) FROM docs").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+            self._data.close()
+
+def _export_paths(paths):
+    """{ruta: ruta relativa del .txt}: desde la carpeta común a todas ('lote.zip!/a.pdf' -> lote.zip/a.txt)."""
+    parts = {p: [s for s in re.split(r"[\\/]+", p.replace(ZIP_MEMBER_SEP, "/"))
+                 if s not in ("", ".", "..") and not s.endswith(":")] for p in paths}
+    common = os.path.commonprefix([v[:-1] for v in parts.values()]) if parts else []
+    return {p: os.path.join(*v[len(common):-1], os.path.splitext(v[-1])[0] + ".txt") for p, v in parts.items()}
+
+def _snippet(text, words, width=60):
+    """Fragmento de una línea alrededor de la primera palabra encontrada."""
+    flat = " ".join(text.split())
+    low = flat.lower()
+    pos = min((p for p in (low.find(w.lower()) for w in words) if p >= 0), default=0)
+    start = max(0, pos - width)
+    return ("…" if start else "") + flat[start:pos + width] + ("…" if pos + width < len(flat) else "")
+
+
+# ---------- Entradas: ZIP y buffers en memoria ----------
+# Además de rutas, el lote acepta miembros de un ZIP ("lote.zip!/carpeta/cupon.pdf",
+# ver expand_inputs), bytes, objetos tipo archivo y tuplas (nombre, bytes | archivo).
+# Se leen sin extraer el ZIP: pdfplumber trabaja sobre el buffer en memoria y poppler,
+# que necesita un archivo, recibe una sola copia temporal local por documento escaneado.
+ZIP_MEMBER_SEP = "!/"
+ZIP_CACHE_SIZE = 4   # ZIPs abiertos a la vez (sus miembros se leen seguidos: no se relee el directorio)
+_OPEN_ZIPS = {}      # ruta del .zip -> ZipFile abierto (el más viejo sale primero)
+_OPEN_ZIPS_LOCK = threading.Lock()
+
+def is_zip_member(src):
+    return isinstance(src, str) and ZIP_MEMBER_SEP in src
+
+def is_plain_path(src):
+    return isinstance(src, (str, os.PathLike)) and not is_zip_member(src)
+
+def pdf_input_name(src):
+    """Nombre para mostrar/registrar de una entrada (ruta, miembro de ZIP o (nombre, datos))."""
+    if isinstance(src, tuple):
+        return src[0]
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return "<memoria>"
+    if hasattr(src, "read"):
+        return getattr(src, "name", "<memoria>")
+    return os.fspath(src)
+
+def result_file_name(src, root=None):
+    """
+    Nombre para la columna _file: la ruta relativa a root con '/' ('2024/03/cupon.pdf';
+    sin root, o fuera de root, solo el nombre) y 'lote.zip!/carpeta/cupon.pdf' si es
+    miembro de un ZIP. Con subcarpetas, dos cupon.pdf de fechas distintas no se confunden.
+    """
+    name = pdf_input_name(src)
+    member = ""
+    if is_zip_member(name):
+        name, member = name.split(ZIP_MEMBER_SEP, 1)
+        member = ZIP_MEMBER_SEP + member
+    rel = None
+    if root:
+        try:
+            rel = os.path.relpath(name, root)
+        except ValueError:   # otra unidad (Windows)
+            rel = None
+    if not rel or rel == os.pardir or rel.startswith(os.pardir + os.sep):
+        rel = os.path.basename(name)
+    return rel.replace(os.sep, "/") + member
+
+def open_zip(archive):
+    """
+    ZipFile abierto de archive, compartido (la lectura de miembros es segura entre hilos).
+    Al salir del caché solo se suelta la referencia: se cierra cuando nadie lo está leyendo.
+    """
+    with _OPEN_ZIPS_LOCK:
+        zf = _OPEN_ZIPS.pop(archive, None) or zipfile.ZipFile(archive)
+        _OPEN_ZIPS[archive] = zf   # al final: el más recién usado
+        while len(_OPEN_ZIPS) > ZIP_CACHE_SIZE:
+            del _OPEN_ZIPS[next(iter(_OPEN_ZIPS))]
+        return zf
+
+def close_zips():
+    """Suelta los ZIPs abiertos (al terminar un lote, para no dejarlos bloqueados)."""
+    with _OPEN_ZIPS_LOCK:
+        _OPEN_ZIPS.clear()
+
+def expand_inputs(paths):
+    """Reemplaza cada .zip por sus PDFs como rutas virtuales 'archivo.zip!/miembro.pdf'."""
+    out = []
+    for p in paths:
+        if isinstance(p, str) and p.lower().endswith(".zip"):
+            try:
+                out.extend(f"{p}{ZIP_MEMBER_SEP}{n}" for n in sorted(open_zip(p).namelist())
+                           if n.lower().endswith(".pdf") and not n.endswith("/"))
+            except (OSError, zipfile.BadZipFile):
+                out.append(p)   # el triage lo manda a cuarentena con su error
+        else:
+            out.append(p)
+    return out
+
+def read_pdf_bytes(src):
+    """Contenido completo de una entrada que no es una ruta simple (o de una ruta, si se pide)."""
+    if isinstance(src, tuple):
+        src = src[1]
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return bytes(src)
+    if hasattr(src, "read"):
+        return src.read()
+    if is_zip_member(src):
+        archive, member = src.split(ZIP_MEMBER_SEP, 1)
+        return open_zip(archive).read(member)
+    with open(src, "rb") as f:
+        return f.read()
+
+def materialize_pdf(src, spool_dir=None):
+    """Ruta local legible por poppler: la misma si ya es un archivo; si no, una copia temporal."""
+    if is_plain_path(src):
+        return os.fspath(src)
+    fd, local = tempfile.mkstemp(suffix=".pdf", dir=spool_dir)
+    with os.fdopen(fd, "wb") as f:
+        f.write(src if isinstance(src, bytes) else read_pdf_bytes(src))
+    return local
+
+def render_pdf_pages(src, **kwargs):
+    """convert_from_path para rutas; convert_from_bytes para buffers y miembros de ZIP."""
+    if is_plain_path(src):
+        return convert_from_path(src, **kwargs)
+    return convert_from_bytes(src if isinstance(src, bytes) else read_pdf_bytes(src), **kwargs)
+
+
+# ---------- Descubrimiento de entradas ----------
+# Recorrido perezoso con os.scandir: los archivos salen a medida que se encuentran, así el
+# lote puede empezar antes de terminar de listar un archivo histórico con miles de carpetas.
+DEFAULT_INCLUDE = ("*.pdf", "*.zip")
+
+def _matches_any(rel, name, patterns):
+    # sin distinguir mayúsculas, contra el nombre o la ruta relativa ('2024/03/*.pdf')
+    rel, name = rel.lower(), name.lower()
+    return any(fnmatch.fnmatchcase(name, p.lower()) or fnmatch.fnmatchcase(rel, p.lower()) for p in patterns)
+
+def _as_timestamp(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return value.timestamp()
+
+def iter_input_files(root, include=DEFAULT_INCLUDE, exclude=(), recursive=False, min_size=0, max_size=None,
+                     modified_after=None, modified_before=None, expand_zips=True, stop_event=None, logger=None):
+    """
+    Generador de entradas bajo root (subcarpetas si recursive, en orden alfabético):
+      - include/exclude: patrones glob; exclude también poda carpetas enteras
+      - min_size/max_size (bytes) y modified_after/modified_before (datetime o epoch)
+      - los .zip salen expandidos en sus PDFs (expand_inputs) si expand_zips
+    Las carpetas ya visitadas (mismo dispositivo e inodo) se saltan: un enlace simbólico
+    que apunta a un ancestro no provoca un recorrido infinito.
+    """
+    after, before = _as_timestamp(modified_after), _as_timestamp(modified_before)
+    filter_stat = bool(min_size or max_size is not None or after is not None or before is not None)
+    seen = set()
+    stack = [root]
+    while stack:
+        if stop_event is not None and stop_event.is_set():
+            return
+        folder = stack.pop()
+        try:
+            st = os.stat(folder)
+            if (st.st_dev, st.st_ino) in seen:
+                if logger:
+                    logger(f"↪️ Carpeta ya recorrida (enlace circular), se omite: {folder}")
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            it = os.scandir(folder)
+        except OSError as e:
             if logger:
-                logger(f"No se pudo guardar OCR .txt para {pdf_path}: {e}")
+                logger(f"⚠️ No se pudo leer la carpeta {folder}: {e}")
+            continue
+        subdirs = []
+        with it:
+            for entry in it:
+                rel = os.path.relpath(entry.path, root).replace(os.sep, "/")
+                if exclude and _matches_any(rel, entry.name, exclude):
+                    continue
+                try:
+                    if entry.is_dir():
+                        if recursive:
+                            subdirs.append(entry.path)
+                        continue
+                    if not entry.is_file() or not _matches_any(rel, entry.name, include):
+                        continue
+                    if filter_stat:
+                        est = entry.stat()
+                        if est.st_size < min_size or (max_size is not None and est.st_size > max_size):
+                            continue
+                        if (after is not None and est.st_mtime < after) or (before is not None and est.st_mtime >= before):
+                            continue
+                except OSError:
+                    continue   # desapareció o sin permisos mientras se listaba
+                if expand_zips and entry.name.lower().endswith(".zip"):
+                    yield from expand_inputs([entry.path])
+                else:
+                    yield entry.path
+        # las carpetas por fecha salen en orden (profundidad primero)
+        stack.extend(sorted(subdirs, reverse=True))
+
+
+# ---------- Triage previo: páginas, capa de texto y plan de trabajo ----------
+ETA_TEXT_PAGE_S = 0.05       # segundos estimados por página con texto seleccionable
+ETA_OCR_PAGE_S_300DPI = 2.0  # segundos estimados por página OCR a 300 DPI (escala con dpi²)
+
+def estimate_page_seconds(has_text, dpi):
+    """Costo estimado de una página: texto seleccionable o render + OCR a 'dpi'."""
+    if has_text:
+        return ETA_TEXT_PAGE_S
+    return ETA_OCR_PAGE_S_300DPI * (dpi / 300.0) ** 2
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600} h {(seconds % 3600) // 60:02d} min"
+    if seconds >= 60:
+        return f"{seconds // 60} min {seconds % 60:02d} s"
+    return f"{seconds} s"
+
+def triage_pdf(pdf_path, sample_pages=2, selectable_text_min_chars=50):
+    """
+    Inspección rápida de un PDF antes de procesarlo:
+      - cabecera %PDF- y marcador %%EOF (archivo truncado)
+      - número de páginas (tabla xref vía pdfplumber, sin extraer texto)
+      - si las primeras 'sample_pages' páginas tienen capa de texto (es una muestra: run_batch
+        igual manda al OCR las páginas sin texto de un documento digital, pero un escaneo cuyo
+        texto aparece recién después de la muestra se procesa entero con OCR)
+    Devuelve dict con path, ok, pages, has_text, size, page_size (puntos), warning, error.
+    Acepta también miembros de ZIP y buffers (ver read_pdf_bytes); a los buffers se les
+    guarda el contenido en 'data' porque no se pueden volver a leer desde 'path'.
+    """
+    info = {"path": pdf_input_name(pdf_path), "ok": False, "pages": 0, "has_text": False,
+            "size": 0, "page_size": None, "warning": None, "error": None}
+    try:
+        if is_plain_path(pdf_path):
+            source = pdf_path
+            info["size"] = os.path.getsize(pdf_path)
+            with open(pdf_path, "rb") as f:
+                head = f.read(1024)
+                f.seek(max(0, info["size"] - 2048))
+                tail = f.read()
+        else:
+            data = read_pdf_bytes(pdf_path)
+            if not is_zip_member(pdf_path):
+                info["data"] = data
+            source = io.BytesIO(data)
+            info["size"] = len(data)
+            head, tail = data[:1024], data[-2048:]
+        if b"%PDF-" not in head:
+            info["error"] = "no es un PDF (falta la cabecera %PDF-)"
+            return info
+        if b"%%EOF" not in tail:
+            info["warning"] = "posiblemente truncado (sin %%EOF)"
+        with pdfplumber.open(source) as pdf:
+            info["pages"] = len(pdf.pages)
+            if pdf.pages:
+                info["page_size"] = (float(pdf.pages[0].width), float(pdf.pages[0].height))
+            chars = sum(len(page.chars) for page in pdf.pages[:sample_pages])
+        if info["pages"] == 0:
+            info["error"] = "PDF sin páginas"
+            return info
+        info["has_text"] = chars >= selectable_text_min_chars
+        info["ok"] = True
+    except Exception as e:
+        info["error"] = f"ilegible: {e}"
+    return info
 
-    return full_text
+def build_work_plan(files, dpi, logger=None, stop_event=None, stream=False, profiler=None):
+    """
+    Ejecuta triage_pdf sobre todos los archivos y arma el plan:
+      - items: PDFs legibles, primero los de texto seleccionable (baratos), luego los escaneados
+      - quarantined: PDFs ilegibles/corruptos (no se procesan, se reportan)
+      - eta: segundos estimados del lote; cada item lleva su propio 'eta'
+    Con stream=True no se triagea nada todavía: plan["stream"] es un generador que triagea
+    'files' (p. ej. iter_input_files) a medida que run_batch lo consume, y los contadores
+    del plan (files, text_files, ocr_files, ocr_pages, eta, quarantined) crecen con él.
+    En ese modo no hay orden global (digitales primero / LPT) ni se guardan los items.
+    """
+    plan = {"items": [], "quarantined": [], "files": 0, "text_files": 0, "ocr_files": 0, "ocr_pages": 0, "eta": 0.0}
+    stream_items = _triage_stream(files, dpi, plan, logger, stop_event, profiler or NULL_PROFILER)
+    if stream:
+        plan["stream"] = stream_items
+        return plan
+    plan["items"] = list(stream_items)
+    # texto seleccionable primero; los escaneados conservan el orden de descubrimiento
+    plan["items"].sort(key=lambda it: not it["has_text"])
+    return plan
+
+def _triage_stream(files, dpi, plan, logger, stop_event, profiler):
+    for n, pdf in enumerate(files, 1):
+        if stop_event is not None and stop_event.is_set():
+            break
+        if not isinstance(pdf, (str, os.PathLike, tuple)):
+            # buffer sin nombre: 'path' es la clave del documento en todo el pipeline
+            pdf = (getattr(pdf, "name", None) or f"memoria_{n}.pdf", pdf)
+        with profiler.span("triage", pdf_input_name(pdf)):
+            info = triage_pdf(pdf)
+        name = os.path.basename(info["path"])
+        plan["files"] += 1
+        if not info["ok"]:
+            info.pop("data", None)
+            plan["quarantined"].append(info)
+            if logger:
+                logger(f"🚫 Cuarentena: {name} ({info['error']})")
+            continue
+        if info["warning"] and logger:
+            logger(f"⚠️ {name}: {info['warning']}")
+        info["eta"] = info["pages"] * estimate_page_seconds(info["has_text"], dpi)
+        if info["has_text"]:
+            plan["text_files"] += 1
+        else:
+            plan["ocr_files"] += 1
+            plan["ocr_pages"] += info["pages"]
+        plan["eta"] += info["eta"]
+        yield info
+
+def describe_plan(plan, workers=1):
+    """Resumen legible del plan para el log."""
+    return (f"🧭 Plan: {plan['text_files']} digitales, {plan['ocr_files']} escaneados "
+            f"({plan['ocr_pages']} páginas OCR), {len(plan['quarantined'])} en cuarentena. "
+            f"Tiempo estimado: {format_duration(plan['eta'] / max(1, workers))} ({workers} workers)")
+
+# ---------- Perfilado por etapa ----------
+# Opcional (profiler=StageProfiler() en run_batch): por cada tramo de trabajo guarda etapa,
+# documento, página, hilo, inicio, duración, CPU del hilo y una muestra de la memoria
+# residente del proceso principal al cerrar el tramo (no es un pico ni incluye los hijos).
+# Ojo: en render, preprocesado y OCR el trabajo pesado corre en otros procesos (poppler,
+# pool, tesseract); ahí el CPU del hilo es casi cero y lo que cuenta es el tiempo de pared,
+# y su memoria no aparece en la columna de RSS.
+PROFILE_STAGES = ("triage", "lectura", "texto", "codigo_barras", "render", "analisis",
+                  "preprocesado", "ocr", "parseo", "excel")
+
+if os.name == "nt":
+    import ctypes
+    from ctypes import wintypes
+
+    class _ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+def current_rss():
+    """Memoria residente actual de este proceso en bytes, sin hijos (0 si el sistema no la expone)."""
+    try:
+        if os.name == "nt":
+            counters = _ProcessMemoryCounters()
+            counters.cb = ctypes.sizeof(counters)
+            ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                     ctypes.byref(counters), counters.cb)
+            return counters.WorkingSetSize
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return 0
+
+class _NullProfiler:
+    def span(self, stage, doc, page=None):
+        return nullcontext()
+
+NULL_PROFILER = _NullProfiler()
+
+class StageProfiler:
+    """
+    Tramos de trabajo del lote: span(etapa, documento, página) como context manager.
+    summary() agrega por documento y da p50/p95/máx por etapa; export_chrome_trace()
+    escribe la línea de tiempo (chrome://tracing o ui.perfetto.dev) con un carril por hilo.
+    """
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.events = []   # (etapa, doc, página, hilo, inicio s, duración s, cpu s, rss del padre bytes)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage, doc, page=None):
+        start, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            ev = (stage, doc, page, threading.current_thread().name, start - self.t0, end - start,
+                  time.thread_time() - cpu, current_rss())
+            with self._lock:
+                self.events.append(ev)
+
+    def summary(self):
+        """
+        {etapa: {files, wall_p50, wall_p95, wall_max, cpu_p50, cpu_p95, total, parent_rss_max}} (segundos, bytes).
+        parent_rss_max es la mayor muestra de RSS del proceso principal al cerrar un tramo.
+        """
+        per_doc = defaultdict(lambda: [0.0, 0.0, 0])
+        with self._lock:
+            events = list(self.events)
+        for stage, doc, _page, _lane, _start, dur, cpu, rss in events:
+            acc = per_doc[(stage, doc)]
+            acc[0] += dur
+            acc[1] += cpu
+            acc[2] = max(acc[2], rss)
+        by_stage = defaultdict(list)
+        for (stage, _doc), acc in per_doc.items():
+            by_stage[stage].append(acc)
+        out = {}
+        for stage in sorted(by_stage, key=lambda st: PROFILE_STAGES.index(st) if st in PROFILE_STAGES else 99):
+            wall = np.array([a[0] for a in by_stage[stage]])
+            cpu = np.array([a[1] for a in by_stage[stage]])
+            out[stage] = {"files": len(wall), "wall_p50": float(np.percentile(wall, 50)),
+                          "wall_p95": float(np.percentile(wall, 95)), "wall_max": float(wall.max()),
+                          "cpu_p50": float(np.percentile(cpu, 50)), "cpu_p95": float(np.percentile(cpu, 95)),
+                          "total": float(wall.sum()), "parent_rss_max": max(a[2] for a in by_stage[stage])}
+        return out
+
+    def format_summary(self):
+        """Tabla de texto de summary() (tiempos por archivo, en ms)."""
+        lines = [f"{'Etapa':<14}{'archivos':>9}{'p50 ms':>10}{'p95 ms':>10}{'máx ms':>10}"
+                 f"{'CPU p50':>10}{'CPU p95':>10}{'total s':>10}{'RSS padre MB':>15}"]
+        for stage, st in self.summary().items():
+            lines.append(f"{stage:<14}{st['files']:>9}{st['wall_p50'] * 1000:>10.1f}{st['wall_p95'] * 1000:>10.1f}"
+                         f"{st['wall_max'] * 1000:>10.1f}{st['cpu_p50'] * 1000:>10.1f}{st['cpu_p95'] * 1000:>10.1f}"
+                         f"{st['total']:>10.2f}{st['parent_rss_max'] / 2**20:>15.0f}")
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        """Escribe el formato Trace Event de Chrome (eventos 'X' en microsegundos, un tid por hilo)."""
+        with self._lock:
+            events = list(self.events)
+        pid = os.getpid()
+        lanes = {}
+        trace = []
+        for stage, doc, page, lane, start, dur, cpu, rss in events:
+            if lane not in lanes:
+                lanes[lane] = len(lanes) + 1
+                trace.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": lanes[lane], "args": {"name": lane}})
+            args = {"doc": os.path.basename(str(doc)), "cpu_ms": round(cpu * 1000, 3), "parent_rss_mb": round(rss / 2**20, 1)}
+            if page is not None:
+                args["page"] = page
+            trace.append({"name": stage, "cat": "etapa", "ph": "X", "pid": pid, "tid": lanes[lane],
+                          "ts": round(start * 1e6), "dur": max(1, round(dur * 1e6)), "args": args})
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+        return path
+
+def write_profile_report(profiler, output_file):
+    """Guarda junto al Excel <nombre>_perfil.txt (tabla) y <nombre>_trace.json. Devuelve (tabla, ruta del trace)."""
+    base = os.path.splitext(output_file)[0]
+    table = profiler.format_summary()
+    with open(base + "_perfil.txt", "w", encoding="utf-8") as f:
+        f.write(table + "\n")
+    return table, profiler.export_chrome_trace(base + "_trace.json")
+
+
+# ---------- Métricas en vivo ----------
+# Para corridas desatendidas (nodos, cola de trabajos): contadores y estado de las etapas,
+# expuestos como texto Prometheus en http://127.0.0.1:METRICS_PORT/metrics y volcados cada
+# METRICS_INTERVAL_S segundos como JSON lines en METRICS_DIR (ver start_metrics).
+METRICS_PORT = 9464
+METRICS_INTERVAL_S = 30
+METRICS_WINDOW_S = 60   # ventana de las tasas páginas/s y documentos/s
+METRICS_DIR = os.path.join(BASE, "logs")
+
+def is_timeout_error(e):
+    # TimeoutError propio, PDFPopplerTimeoutError de pdf2image, RuntimeError de pytesseract
+    return isinstance(e, TimeoutError) or "timeout" in type(e).__name__.lower() or "timeout" in str(e).lower()
+
+class _NullMetrics:
+    def inc(self, name, n=1, **labels):
+        pass
+
+    def mark(self, name, n=1, **labels):
+        pass
+
+    def attach(self, stages):
+        return None
+
+    def detach(self, key):
+        pass
+
+NULL_METRICS = _NullMetrics()
+
+class BatchMetrics:
+    """
+    Métricas del proceso, acumuladas entre lotes (run_batch(metrics=...)):
+      - contadores: inc(nombre, n, etiqueta=valor); mark() además alimenta la tasa por segundo
+      - etapas: attach(stages) registra las PipelineStage de un lote para leer profundidad
+        de cola, hilos ocupados y segundos ocupados (utilización)
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = defaultdict(float)   # (nombre, ((etiqueta, valor), ...)) -> valor
+        self._recent = defaultdict(deque)    # nombre -> instantes (monotonic) de las últimas marcas
+        self._batches = {}
+        self._retired_busy = defaultdict(float)   # segundos ocupados de lotes ya terminados
+        self._lock = threading.Lock()
+
+    def inc(self, name, n=1, **labels):
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += n
+
+    def mark(self, name, n=1, **labels):
+        now = time.monotonic()
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += n
+            self._recent[name].extend([now] * int(n))
+
+    def attach(self, stages):
+        key = object()
+        with self._lock:
+            self._batches[key] = stages
+        return key
+
+    def detach(self, key):
+        with self._lock:
+            for st in self._batches.pop(key, ()):
+                self._retired_busy[st.name] += st.busy_seconds()
+
+    def total(self, name):
+        with self._lock:
+            return sum(v for (n, _), v in self.counters.items() if n == name)
+
+    def rate(self, name):
+        """Marcas por segundo en los últimos METRICS_WINDOW_S segundos (o desde el arranque)."""
+        now = time.monotonic()
+        with self._lock:
+            recent = self._recent[name]
+            while recent and recent[0] < now - METRICS_WINDOW_S:
+                recent.popleft()
+            count = len(recent)
+        return count / max(1e-6, min(METRICS_WINDOW_S, time.time() - self.started))
+
+    def snapshot(self):
+        """Estado actual como dict (lo que se vuelca en JSON lines)."""
+        stages = defaultdict(lambda: {"queue": 0, "workers": 0, "busy": 0, "busy_seconds": 0.0})
+        with self._lock:
+            batches = list(self._batches.values())
+            for name, secs in self._retired_busy.items():
+                stages[name]["busy_seconds"] += secs
+            counters = dict(self.counters)
+        for batch in batches:
+            for st in batch:
+                agg = stages[st.name]
+                agg["queue"] += st.inq.qsize()
+                agg["workers"] += st.workers
+                agg["busy"] += len(st.busy)
+                agg["busy_seconds"] += st.busy_seconds()
+        grouped = defaultdict(dict)
+        for (name, labels), value in counters.items():
+            grouped[name][",".join(f"{k}={v}" for k, v in labels) or "total"] = value
+        hits, misses = self.total("cache_hits"), self.total("cache_misses")
+        return {"ts": datetime.now().isoformat(timespec="seconds"), "uptime_s": round(time.time() - self.started, 1),
+                "pages_per_s": round(self.rate("pages"), 3), "documents_per_s": round(self.rate("documents"), 3),
+                "cache_hit_ratio": round(hits / (hits + misses), 3) if hits + misses else None,
+                "counters": dict(grouped), "stages": dict(stages)}
+
+    def prometheus_text(self):
+        """Formato de exposición de Prometheus (text/plain; version=0.0.4)."""
+        snap = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP extractor_{name} {help_text}")
+            lines.append(f"# TYPE extractor_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"extractor_{name}{{{label_text}}} {value}" if label_text else f"extractor_{name} {value}")
+
+        with self._lock:
+            counters = dict(self.counters)
+        by_name = defaultdict(list)
+        for (name, labels), value in counters.items():
+            by_name[name].append((labels, value))
+        for name in sorted(by_name):
+            metric(f"{name}_total", "counter", f"Total de {name}", sorted(by_name[name]))
+        metric("pages_per_second", "gauge", f"Páginas por segundo (ventana {METRICS_WINDOW_S} s)", [((), snap["pages_per_s"])])
+        metric("documents_per_second", "gauge", f"Documentos por segundo (ventana {METRICS_WINDOW_S} s)",
+               [((), snap["documents_per_s"])])
+        if snap["cache_hit_ratio"] is not None:
+            metric("cache_hit_ratio", "gauge", "Aciertos de caché / consultas", [((), snap["cache_hit_ratio"])])
+        stages = sorted(snap["stages"].items())
+        metric("queue_depth", "gauge", "Elementos esperando en la cola de entrada de la etapa",
+               [((("stage", n),), st["queue"]) for n, st in stages])
+        metric("stage_workers", "gauge", "Hilos de la etapa", [((("stage", n),), st["workers"]) for n, st in stages])
+        metric("stage_busy_workers", "gauge", "Hilos de la etapa trabajando ahora",
+               [((("stage", n),), st["busy"]) for n, st in stages])
+        metric("stage_busy_seconds_total", "counter", "Segundos-hilo ocupados (rate() / workers = utilización)",
+               [((("stage", n),), round(st["busy_seconds"], 3)) for n, st in stages])
+        metric("uptime_seconds", "gauge", "Segundos desde el arranque", [((), snap["uptime_s"])])
+        return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass   # sin una línea por cada scrape
+
+def start_metrics(metrics, port=METRICS_PORT, log_dir=METRICS_DIR, interval=METRICS_INTERVAL_S, logger=None):
+    """
+    Arranca el endpoint (solo 127.0.0.1) y el volcado a <log_dir>/metricas-AAAAMMDD.jsonl,
+    con la utilización de cada etapa en el intervalo. Devuelve stop(), que escribe una última línea.
+    Si el puerto está ocupado se sigue solo con el volcado.
+    """
+    server = None
+    if port:
+        try:
+            server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+            server.daemon_threads = True
+            server.metrics = metrics
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+            if logger:
+                logger(f"📈 Métricas en http://127.0.0.1:{port}/metrics")
+        except OSError as e:
+            server = None
+            if logger:
+                logger(f"⚠️ No se pudo abrir el puerto de métricas {port}: {e}")
+    done = threading.Event()
+    previous = {}
+
+    def dump():
+        snap = metrics.snapshot()
+        for name, st in snap["stages"].items():
+            last = previous.get(name, (snap["uptime_s"] - interval, st["busy_seconds"]))
+            elapsed = max(1e-6, snap["uptime_s"] - last[0])
+            st["utilization"] = round((st["busy_seconds"] - last[1]) / (elapsed * max(1, st["workers"])), 3)
+            previous[name] = (snap["uptime_s"], st["busy_seconds"])
+        try:
+            os.makedirs(log_dir, exist_ok=True)
+            path = os.path.join(log_dir, f"metricas-{datetime.now():%Y%m%d}.jsonl")
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(snap, ensure_ascii=False) + "\n")
+        except OSError:
+            pass   # sin carpeta de logs: queda el endpoint
+
+    def writer():
+        while not done.wait(interval):
+            dump()
+
+    threading.Thread(target=writer, name="metrics-log", daemon=True).start()
+
+    def stop():
+        done.set()
+        dump()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    return stop
+
+
+# ---------- Pipeline por etapas con presupuesto de memoria ----------
+# render -> preprocesado -> OCR -> parseo, unidas por colas acotadas. El render reserva
+# en PixelBudget los bytes de la página antes de rasterizar y el OCR los libera al
+# terminar: si el OCR se atrasa, el render se bloquea en vez de acumular páginas.
+DEFAULT_MEMORY_BUDGET_MB = 1024   # bytes de píxeles en vuelo entre render y OCR
+PREPROCESS_WIDTH = 4000           # ancho al que image_preprocess reescala páginas pequeñas
+_END = object()                   # centinela de fin de cola
+
+class PixelBudget:
+    """Semáforo por bytes para las páginas rasterizadas que están en vuelo."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max(1, int(max_bytes))
+        self.in_use = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes, stop_event=None):
+        """
+        Reserva nbytes (bloquea mientras no haya espacio). Una página más grande que
+        todo el presupuesto pasa sola cuando no hay nada más en vuelo.
+        Devuelve False si se canceló mientras esperaba.
+        """
+        with self._cond:
+            while self.in_use and self.in_use + nbytes > self.max_bytes:
+                if stop_event is not None and stop_event.is_set():
+                    return False
+                self._cond.wait(0.2)
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+        return True
+
+    def release(self, nbytes):
+        with self._cond:
+            self.in_use = max(0, self.in_use - nbytes)
+            self._cond.notify_all()
+
+def estimate_page_bytes(page_size, dpi):
+    """
+    Bytes de una página en vuelo: render en grises de poppler + copia reescalada
+    por image_preprocess. page_size en puntos PDF (ancho, alto).
+    Devuelve (bytes_render, bytes_preprocesado).
+    """
+    w_pt, h_pt = page_size or (612, 792)
+    w, h = int(w_pt / 72 * dpi), int(h_pt / 72 * dpi)
+    pre_w = max(w, PREPROCESS_WIDTH)
+    return w * h, pre_w * int(h * pre_w / max(1, w))
+
+def shared_slot_bytes(page_size, dpi):
+    """Bytes que necesita un segmento compartido: página en grises o binarizada empaquetada (1 bit)."""
+    w_pt, h_pt = page_size or (612, 792)
+    w, h = int(w_pt / 72 * dpi), int(h_pt / 72 * dpi)
+    pre_w = max(w, PREPROCESS_WIDTH)
+    return max(w * h, (pre_w + 7) // 8 * int(h * pre_w / max(1, w)))
+
+class SharedPageBuffers:
+    """
+    Segmentos de memoria compartida reutilizables para pasar páginas al proceso de
+    preprocesado y de vuelta sin serializar la imagen: por la cola y el pool solo viaja
+    un handle (nombre, modo, tamaño, bytes). Los segmentos se crean una vez por lote.
+    """
+
+    def __init__(self, slot_bytes, slots):
+        self.slot_bytes = max(1, int(slot_bytes))
+        self._segments = [shared_memory.SharedMemory(create=True, size=self.slot_bytes)
+                          for _ in range(max(1, slots))]
+        self._free = queue.Queue()
+        for shm in self._segments:
+            self._free.put(shm)
+
+    def acquire(self, stop_event=None, block=True):
+        """Un segmento libre; None si se canceló (o si no hay y block=False)."""
+        while True:
+            try:
+                return self._free.get(timeout=0.2) if block else self._free.get_nowait()
+            except queue.Empty:
+                if not block or (stop_event is not None and stop_event.is_set()):
+                    return None
+
+    def release(self, shm):
+        if shm is not None:
+            self._free.put(shm)
+
+    def close(self):
+        for shm in self._segments:
+            # close() lanza BufferError si queda una vista viva del segmento: igual se desvincula
+            try:
+                shm.close()
+            except Exception:
+                pass
+            finally:
+                try:
+                    shm.unlink()
+                except Exception:
+                    pass
 
+def write_shared_page(shm, img):
+    """Copia los píxeles de img al segmento. Devuelve el handle o None si no cabe."""
+    if img.mode != "L":
+        data = img.tobytes()   # otros modos (binarizada, color): se serializan y se copian
+        if len(data) > shm.size:
+            return None
+        shm.buf[:len(data)] = data
+        return (shm.name, img.mode, img.size, len(data))
+    n = img.width * img.height
+    if n > shm.size:
+        return None
+    # gris (el render del pipeline): una sola copia, paste escribe en una imagen que vive sobre el segmento
+    view = shm.buf[:n]
+    dst = Image.frombuffer("L", img.size, view, "raw", "L", 0, 1)
+    dst.readonly = 0   # frombuffer la marca de solo lectura; el segmento es nuestro
+    dst.paste(img)
+    del dst
+    view.release()
+    return (shm.name, img.mode, img.size, n)
+
+def read_shared_page(shm, handle):
+    """Imagen PIL que lee los píxeles directamente del segmento (sin copia)."""
+    _, mode, size, n = handle
+    return Image.frombuffer(mode, size, shm.buf[:n], "raw", mode, 0, 1)
+
+_ATTACHED_SHM = {}   # en el proceso hijo: nombre -> segmento ya abierto
+
+def _attach_shared(name):
+    shm = _ATTACHED_SHM.get(name)
+    if shm is None:
+        # el segmento es del proceso padre (el hijo comparte su resource_tracker): solo se abre
+        shm = shared_memory.SharedMemory(name=name)
+        _ATTACHED_SHM[name] = shm
+    return shm
+
+def preprocess_shared(src_handle, dst_name, angle=0.0):
+    """
+    Corre en el proceso de preprocesado: lee la página del segmento de src_handle y deja
+    el resultado (girada angle grados y preprocesada) en el segmento dst_name. Devuelve el handle de salida, o la imagen
+    (serializada, como antes) si no hay segmento de salida o no cabe.
+    """
+    img = read_shared_page(_attach_shared(src_handle[0]), src_handle)
+    out = preprocess_page(img, angle)
+    del img
+    if dst_name is None:
+        return out
+    return write_shared_page(_attach_shared(dst_name), out) or out
+
+class PipelineStage:
+    """
+    Etapa con N hilos: toma elementos de inq, aplica fn (que devuelve un iterable de
+    salidas) y las deja en outq. Cuando termina el último hilo propaga _END a la
+    siguiente etapa (una vez por cada hilo de esa etapa).
+    """
+
+    def __init__(self, name, fn, inq, outq, workers=1, downstream_workers=1, logger=None):
+        self.name = name
+        self.fn = fn
+        self.logger = logger
+        self.inq = inq
+        self.outq = outq
+        self.workers = max(1, workers)
+        self.downstream_workers = downstream_workers
+        self._alive = self.workers
+        self._lock = threading.Lock()
+        self.busy = {}   # hilo -> (elemento en curso, inicio); lo mira el watchdog de run_batch
+        self._busy_time = 0.0   # segundos-hilo con un elemento en curso (incluye esperas a la cola de salida)
+        self.threads = [threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+                        for i in range(self.workers)]
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+        return self
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+
+    def busy_seconds(self):
+        """Segundos-hilo ocupados hasta ahora, contando los elementos en curso."""
+        now = time.monotonic()
+        with self._lock:
+            return self._busy_time + sum(now - start for _, start in list(self.busy.values()))
+
+    def _run(self):
+        while True:
+            item = self.inq.get()
+            if item is _END:
+                break
+            start = time.monotonic()
+            self.busy[threading.current_thread()] = (item, start)
+            try:
+                for out in self.fn(item):
+                    if self.outq is not None:
+                        self.outq.put(out)
+            except Exception as e:
+                # un fallo inesperado no debe dejar la etapa sin propagar _END (bloquearía el lote)
+                if self.logger:
+                    self.logger(f"Etapa {self.name}: error inesperado: {e}")
+            finally:
+                self.busy.pop(threading.current_thread(), None)
+                with self._lock:
+                    self._busy_time += time.monotonic() - start
+        with self._lock:
+            self._alive -= 1
+            last = self._alive == 0
+        if last and self.outq is not None:
+            for _ in range(self.downstream_workers):
+                self.outq.put(_END)
+
+def terminate_pool(pool):
+    """ProcessPoolExecutor no tiene terminate: mata sus procesos (atributo interno) y lo cierra."""
+    for proc in list((getattr(pool, "_processes", None) or {}).values()):
+        try:
+            proc.terminate()
+        except Exception:
+            pass
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def wait_future(fut, timeout, stop_event):
+    """
+    Resultado de fut esperando en tramos cortos para responder a stop_event.
+    Lanza TimeoutError si pasa timeout y RuntimeError si se cancela.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return fut.result(timeout=0.2)
+        except FuturesTimeout:
+            if stop_event.is_set():
+                fut.cancel()
+                raise RuntimeError("cancelado")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"más de {timeout} s")
+
+def extract_selectable_pages(pdf_path, selectable_text_min_chars=50, first_page=None, last_page=None, logger=None):
+    """
+    Texto seleccionable (pdfplumber) por página del rango: {página: texto}, o None si
+    en total no alcanza el mínimo de caracteres.
+    """
+    try:
+        first = first_page or 1
+        text_pages = {}
+        source = pdf_path if is_plain_path(pdf_path) else io.BytesIO(
+            pdf_path if isinstance(pdf_path, bytes) else read_pdf_bytes(pdf_path))
+        with pdfplumber.open(source) as pdf:
+            for i, page in enumerate(pdf.pages[first - 1:last_page]):
+                text_pages[first + i] = page.extract_text() or ""
+        total = sum(len(re.sub(r'\s+', '', t)) for t in text_pages.values())
+        if total >= selectable_text_min_chars:
+            return text_pages
+    except Exception as e:
+        if logger:
+            logger(f"pdfplumber fallo para {os.path.basename(pdf_input_name(pdf_path))}: {e}. Se intentará OCR.")
+    return None
+
+def extract_selectable_text(pdf_path, selectable_text_min_chars=50, first_page=None, last_page=None, logger=None):
+    """Texto seleccionable (pdfplumber) del rango de páginas, o None si no alcanza el mínimo."""
+    pages = extract_selectable_pages(pdf_path, selectable_text_min_chars, first_page, last_page, logger)
+    if pages is None:
+        return None
+    return "\n\n".join(t for _, t in sorted(pages.items()) if t).strip()
+
+def is_network_path(path):
+    """True para rutas UNC (\\\\servidor\\recurso o //servidor/recurso)."""
+    p = os.path.abspath(path)
+    return p.startswith("\\\\") or p.startswith("//")
+
+def prefetch_pdf(pdf_path, spool_dir=None, hasher=None):
+    """
+    Etapa de E/S: lee el PDF completo antes de que llegue al render.
+      - con spool_dir lo copia a disco local y devuelve esa ruta (poppler y pdfplumber
+        dejan de leer del recurso de red página por página)
+      - sin spool_dir lo recorre en bloques de 1 MB para dejarlo en la caché del sistema
+    Con hasher (p. ej. hashlib.sha256()) cada bloque leído también se pasa por el hash.
+    """
+    dst = None
+    if spool_dir:
+        fd, local = tempfile.mkstemp(suffix=".pdf", dir=spool_dir)
+        dst = os.fdopen(fd, "wb")
+    with open(pdf_path, "rb") as f, (dst or nullcontext()):
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            if hasher is not None:
+                hasher.update(chunk)
+            if dst is not None:
+                dst.write(chunk)
+    return local if spool_dir else pdf_path
+
+# ---------- Planificación: trabajo más costoso primero (LPT) ----------
+SPLIT_MIN_PAGES = 4   # solo se dividen en tareas por páginas los escaneados con al menos estas páginas
+MIN_CHUNK_PAGES = 2   # tamaño mínimo de una tarea parcial (cada tarea abre el PDF y lanza poppler)
+
+def schedule_tasks(plan, workers):
+    """
+    Convierte el plan en tareas ordenadas para el pool:
+      - con un solo worker se respeta el orden del plan (digitales primero, resultados tempranos)
+      - con varios, orden LPT (más costoso primero) y los escaneados que superan la carga
+        objetivo por tarea se parten en rangos de páginas, para que el makespan se acerque
+        a trabajo_total / workers
+    Cada tarea: {item, path, first_page, last_page, cost, has_text}.
+    """
+    items = plan["items"]
+    total = sum(it["eta"] for it in items)
+    target = total / max(1, workers * 2)
+    tasks = [t for it in items for t in item_tasks(it, workers, target)]
+    if workers > 1:
+        tasks.sort(key=lambda t: t["cost"], reverse=True)
+    return tasks
+
+def item_tasks(it, workers, target=None):
+    """
+    Tareas de un item: el documento entero o, si es un escaneado que supera la carga
+    objetivo 'target' (segundos), rangos de páginas. Sin target (plan en streaming, no se
+    conoce el total) un escaneado largo se reparte en 'workers' rangos.
+    """
+    whole = {"item": it, "path": it["path"], "first_page": None, "last_page": None,
+             "cost": it["eta"], "has_text": it["has_text"]}
+    if workers <= 1 or it["has_text"] or it["pages"] < SPLIT_MIN_PAGES or (target is not None and it["eta"] <= target):
+        return [whole]
+    page_cost = it["eta"] / it["pages"]
+    if target is None:
+        chunk = max(MIN_CHUNK_PAGES, -(-it["pages"] // workers))
+    else:
+        chunk = max(MIN_CHUNK_PAGES, int(target // page_cost))
+    tasks = []
+    for first in range(1, it["pages"] + 1, chunk):
+        last = min(it["pages"], first + chunk - 1)
+        tasks.append({**whole, "first_page": first, "last_page": last,
+                      "cost": (last - first + 1) * page_cost})
+    return tasks
+
+def run_batch(plan, on_document, workers=DEFAULT_WORKERS, dpi=DEFAULT_DPI, lang=DEFAULT_LANG,
+              tesseract_config="--psm 6", save_ocr_text=False, ocr_text_dir=None,
+              logger=None, stop_event=None, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+              use_processes=True, spool_network=True, ocr_threads=DEFAULT_OCR_THREADS,
+              doc_timeout=DOC_TIMEOUT_S, split_pages=False, warm_pool=None, profiler=None, metrics=None,
+              skip_ocr_on_barcode=False, pool_share=1.0, hash_content=False):
+    """
+    Ejecuta las tareas de schedule_tasks (o las de plan["stream"], a medida que se triagean)
+    en el pipeline
+    lectura -> render -> preprocesado -> OCR -> parseo, con etapas solapadas:
+      - lectura (hilos): trae el PDF del disco/red mientras otros se procesan
+        (los de recursos de red se copian a un temporal local si spool_network)
+      - render y OCR (hilos): esperan a los subprocesos de poppler y tesseract
+      - preprocesado (procesos, si use_processes): trabajo de CPU puro con PIL; las páginas
+        van y vuelven por segmentos de memoria compartida (SharedPageBuffers), no por pickle
+      - parseo (un hilo): une partes y llama a on_document
+    Las páginas se rasterizan de una en una y el total de píxeles en vuelo queda acotado por
+    memory_budget_mb (PixelBudget). Las partes de un documento dividido se unen en orden de página.
+    Cada tesseract corre con OMP_THREAD_LIMIT=ocr_threads (ver tune_ocr_parallelism).
+    Límites de tiempo: poppler y tesseract reciben timeout por página (RENDER_TIMEOUT_S,
+    OCR_TIMEOUT_S) y un watchdog mata sus subprocesos si el documento pasa doc_timeout o
+    si se activa stop_event (la cancelación corta en menos de un segundo). Un preprocesado
+    colgado reinicia el pool de procesos. Los documentos vencidos terminan con error.
+    Orientación: cada documento se endereza con el giro estimado en su primera página
+    (estimate_page_correction, en baja resolución); si el primer OCR sale mal se busca el
+    giro de 180° (OSD o comparación de calidad) y se aplica al resto de páginas.
+    on_document(item, text, error) se llama una vez por documento desde el hilo colector;
+    item["blank_pages"] trae cuántas páginas se omitieron por estar en blanco (is_blank_page).
+    Con split_pages (PDFs con un cupón por página) item["page_texts"] trae {página: texto},
+    cada página con su propio código de barras, para extract_coupon_records.
+    El código de barras se decodifica del mismo render de la página (reducido a BARCODE_DPI),
+    sin otro paso de poppler. Con skip_ocr_on_barcode, cuando el código es GS1 válido esa
+    página no pasa por OCR y, sin split_pages, tampoco el resto del documento: solo quedan
+    los campos del código (referencia, importe, fecha, GLN).
+    Con warm_pool (WarmPool) el preprocesado usa ese pool de procesos ya arrancado, que
+    puede estar compartido con otros lotes simultáneos, y no se cierra al terminar; el lote
+    tiene a lo sumo pool_share de sus procesos con páginas suyas a la vez. Si el pool se
+    reinicia (timeout de otra página u otro lote), las páginas en vuelo se reintentan una
+    vez en el pool nuevo.
+    Con hash_content la etapa de lectura deja en item["hash"] el SHA-256 del PDF, calculado
+    sobre los mismos bytes que ya lee (ResultStore lo usa como clave de contenido).
+    Con profiler (StageProfiler) se mide cada etapa por documento y página; la etapa
+    'parseo' incluye on_document (extracción de campos del llamador).
+    Con metrics (BatchMetrics) se cuentan páginas, documentos, errores, timeouts y la caché
+    de lectura (partes de un documento que reusan la copia ya leída) y se exponen las etapas.
+    Devuelve el PixelBudget usado (peak = máximo de bytes en vuelo).
+    """
+    stop_event = stop_event or threading.Event()
+    prof = profiler or NULL_PROFILER
+    meter = metrics or NULL_METRICS
+    budget = PixelBudget(memory_budget_mb * 1024 * 1024)
+    workers = max(1, workers)
+    render_workers = max(1, workers // 2)
+    depth = workers * 2
+    task_q = queue.Queue(maxsize=depth * 4 if "stream" in plan else 0)
+    render_q = queue.Queue(maxsize=render_workers * 2)   # lectura anticipada acotada
+    pre_q = queue.Queue(maxsize=depth)
+    ocr_q = queue.Queue(maxsize=depth)
+    parse_q = queue.Queue()
+    if warm_pool is not None:
+        pool = warm_pool.get()
+        # parte del pool compartido que puede ocupar este lote (el resto es de los otros trabajos)
+        pool_slots = threading.BoundedSemaphore(max(1, int(warm_pool.workers * pool_share)))
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers) if use_processes else None
+    shared = None
+    if pool is not None:
+        ocr_items = [it for it in plan["items"] if not it.get("has_text")]
+        if ocr_items or "stream" in plan:
+            # en streaming no se conocen los tamaños: carta; las páginas mayores van por pickle
+            slot_bytes = max([shared_slot_bytes(it.get("page_size"), dpi) for it in ocr_items] or
+                             [shared_slot_bytes(None, dpi)])
+            # los segmentos cuentan dentro del presupuesto: como mínimo uno de entrada y uno de salida
+            slots = max(2, min(depth * 2, memory_budget_mb * 1024 * 1024 // slot_bytes))
+            try:
+                shared = SharedPageBuffers(slot_bytes, slots)
+            except Exception as e:
+                if logger:
+                    logger(f"Sin memoria compartida ({e}): las páginas irán serializadas al preprocesado")
+    spool_dir = tempfile.mkdtemp(prefix="extractor_spool_")   # copias locales (red, ZIP, buffers)
+    archive = OcrTextArchive(ocr_text_dir) if save_ocr_text and ocr_text_dir else None
+    sources = {}   # ruta original -> ruta local (copia en spool o la misma)
+    sources_lock = threading.Lock()
+    deadlines = {}  # ruta -> instante límite del documento (desde que empieza su primera parte)
+    expired = set()  # documentos que pasaron doc_timeout
+    corrections = {}  # ruta -> giro (grados) que endereza sus páginas (estimate_page_correction + OCR)
+    orientation_checked = set()  # documentos a los que ya se les buscó el giro de 180°
+    barcode_docs = {}  # ruta -> True si su código es GS1 válido (sin split_pages se lee una vez por documento)
+    corrections_lock = threading.Lock()
+    pool_lock = threading.Lock()
+
+    def current_pool():
+        # el pool compartido pudo ser reiniciado por otro lote
+        return warm_pool.get() if warm_pool is not None else pool
+
+    def recycle_pool(old):
+        # un proceso de preprocesado colgado: se mata el pool entero y se crea otro
+        nonlocal pool
+        if warm_pool is not None:
+            warm_pool.recycle(old, logger=logger)
+            return
+        with pool_lock:
+            if pool is old:
+                terminate_pool(old)
+                pool = ProcessPoolExecutor(max_workers=workers)
+                if logger:
+                    logger("♻️ Pool de preprocesado reiniciado (proceso colgado)")
+
+    def run_in_pool(fn, *args):
+        # Un timeout mata el pool entero (recycle_pool): las demás páginas en vuelo en ese pool,
+        # de este lote o de otro que lo comparte, fallan con BrokenProcessPool sin culpa propia
+        # y se reintentan una vez en el pool nuevo.
+        with pool_slots if warm_pool is not None else nullcontext():
+            for attempt in (1, 2):
+                current = current_pool()
+                try:
+                    return wait_future(current.submit(fn, *args), PREPROCESS_TIMEOUT_S, stop_event)
+                except TimeoutError:
+                    # el hijo puede seguir escribiendo en su segmento de salida: se mata antes de seguir
+                    recycle_pool(current)
+                    raise
+                except BrokenProcessPool:
+                    if attempt == 2 or stop_event.is_set():
+                        raise
+                    recycle_pool(current)   # sin efecto si quien lo rompió ya lo reemplazó
+
+    def read(task):
+        path = task["path"]
+        if stop_event.is_set():
+            return
+        with sources_lock:
+            src = sources.get(path)
+        meter.inc("cache_misses" if src is None else "cache_hits", cache="lectura")
+        if src is None:
+            try:
+                with prof.span("lectura", path):
+                    if "data" in task["item"] or is_zip_member(path):
+                        # buffer o miembro de ZIP: queda en memoria (pdfplumber lo lee así); poppler
+                        # necesita un archivo, así que solo los escaneados van una vez al spool
+                        src = task["item"].get("data") or read_pdf_bytes(path)
+                        if hash_content:
+                            task["item"]["hash"] = hashlib.sha256(src).hexdigest()
+                        if not task["has_text"]:
+                            src = materialize_pdf(src, spool_dir)
+                    else:
+                        hasher = hashlib.sha256() if hash_content else None
+                        src = prefetch_pdf(path, spool_dir if spool_network and is_network_path(path) else None,
+                                           hasher=hasher)
+                        if hasher is not None:
+                            task["item"]["hash"] = hasher.hexdigest()
+            except Exception as e:
+                if logger:
+                    logger(f"Lectura anticipada fallo para {os.path.basename(path)}: {e}")
+                src = task["item"].get("data", path)
+            with sources_lock:
+                if sources.setdefault(path, src) is not src:
+                    # otra parte del mismo documento ya lo trajo
+                    if isinstance(src, str) and src != path:
+                        os.remove(src)
+                    src = sources[path]
+        yield {**task, "src": src}
+
+    def render(task):
+        # registros de salida: {task, page, count, text, img, shm, handle, nbytes, barcode, blank, angle, error}
+        # (la página va en img, o en el segmento shm descrito por handle)
+        item = task["item"]
+        first = task["first_page"] or 1
+        last = task["last_page"] or item["pages"]
+        base = {"task": task, "img": None, "shm": None, "handle": None, "nbytes": 0, "blank": False,
+                "angle": 0.0, "text": None, "barcode": None, "error": None}
+        if stop_event.is_set():
+            return
+        page_list = range(first, last + 1)
+        if task["has_text"]:
+            with prof.span("texto", task["path"]):
+                pages = extract_selectable_pages(task["src"], first_page=task["first_page"],
+                                                 last_page=task["last_page"], logger=logger)
+            if pages is not None:
+                if logger:
+                    logger(f"Usando texto seleccionable de: {os.path.basename(task['path'])}")
+                # el triage solo muestrea las primeras páginas: las que no traen capa de texto
+                # (hojas escaneadas intercaladas) siguen al OCR como las de un escaneo
+                page_list = [p for p in page_list if not pages.get(p, "").strip()]
+                text_pages = [p for p in range(first, last + 1) if p not in page_list]
+                if split_pages:
+                    for page_no in text_pages:
+                        yield {**base, "page": page_no, "count": 1, "text": pages[page_no]}
+                else:
+                    text = "\n\n".join(pages[p] for p in text_pages).strip()
+                    yield {**base, "page": text_pages[0], "count": len(text_pages), "text": text}
+                if not page_list:
+                    return
+                if logger:
+                    logger(f"{len(page_list)} página(s) sin capa de texto en {os.path.basename(task['path'])}: "
+                           f"se procesan con OCR")
+        deadlines.setdefault(task["path"], time.monotonic() + doc_timeout)
+        render_bytes, pre_bytes = estimate_page_bytes(item.get("page_size"), dpi)
+        for i, page_no in enumerate(page_list):
+            if task["path"] in expired:
+                # el resto de páginas no se rasteriza: cuentan como hechas y el documento sale con error
+                yield {**base, "page": page_no, "count": len(page_list) - i,
+                       "error": TimeoutError(f"documento excedió {doc_timeout} s")}
+                return
+            if skip_ocr_on_barcode and not split_pages and barcode_docs.get(task["path"]):
+                # el código ya dio los campos del documento: el resto de páginas no se rasteriza
+                yield {**base, "page": page_no, "count": len(page_list) - i, "text": ""}
+                return
+            nbytes = render_bytes + pre_bytes
+            if stop_event.is_set() or not budget.acquire(nbytes, stop_event):
+                return
+            try:
+                with prof.span("render", task["path"], page_no):
+                    img = render_pdf_pages(task["src"], dpi=dpi, first_page=page_no, last_page=page_no,
+                                           grayscale=True, timeout=RENDER_TIMEOUT_S)[0]
+            except Exception as e:
+                budget.release(nbytes)
+                meter.inc("errors", stage="render")
+                if is_timeout_error(e):
+                    meter.inc("timeouts", stage="render")
+                yield {**base, "page": page_no, "count": 1, "error": e}
+                continue
+            with prof.span("analisis", task["path"], page_no):
+                blank = is_blank_page(img)
+            if blank:
+                # reverso vacío de un escaneo dúplex: sin preprocesado ni OCR
+                budget.release(nbytes)
+                del img
+                yield {**base, "page": page_no, "count": 1, "text": "", "blank": True}
+                continue
+            # orientación/inclinación: se estima en la primera página con tinta y vale para todo el documento
+            with corrections_lock:
+                angle = corrections.get(task["path"])
+            if angle is None:
+                with prof.span("analisis", task["path"], page_no):
+                    angle = estimate_page_correction(img)
+                with corrections_lock:
+                    angle = corrections.setdefault(task["path"], angle)
+            rec = {**base, "page": page_no, "count": 1, "img": img, "nbytes": nbytes, "angle": angle}
+            if split_pages or task["path"] not in barcode_docs:
+                # del mismo render, reducido; con split_pages cada página (cupón) trae el suyo
+                with prof.span("codigo_barras", task["path"], page_no):
+                    rec["barcode"] = decode_barcode_from_image(img.reduce(max(1, dpi // BARCODE_DPI)))
+                valid = bool(rec["barcode"]) and gs1_fields(rec["barcode"])[1]
+                if rec["barcode"] and not split_pages:
+                    barcode_docs[task["path"]] = valid
+                if rec["barcode"] and logger:
+                    logger(f"Código de barras decodificado en {os.path.basename(task['path'])}: {rec['barcode']}")
+                if valid and skip_ocr_on_barcode:
+                    budget.release(nbytes)
+                    del img
+                    yield {**rec, "img": None, "nbytes": 0, "text": ""}
+                    continue
+            if shared is not None:
+                shm = shared.acquire(stop_event)
+                if shm is None:
+                    budget.release(nbytes)
+                    return
+                handle = write_shared_page(shm, img)
+                if handle is None:
+                    shared.release(shm)   # página más grande que el segmento: va por pickle
+                else:
+                    rec.update(img=None, shm=shm, handle=handle)
+                del img
+            yield rec
+
+    def preprocess(rec):
+        if rec["shm"] is None and rec["img"] is None:
+            yield rec
+            return
+        with prof.span("preprocesado", rec["task"]["path"], rec["page"]):
+            _preprocess(rec)
+        yield rec
+
+    def _preprocess(rec):
+        if (rec["shm"] is not None or rec["img"] is not None) and \
+                (stop_event.is_set() or rec["task"]["path"] in expired):
+            # cancelado o documento vencido: la página se descarta sin preprocesar
+            if rec["shm"] is not None:
+                shared.release(rec["shm"])
+            budget.release(rec["nbytes"])
+            rec.update(img=None, shm=None, handle=None, nbytes=0, text="")
+        if rec["shm"] is not None:
+            # sin bloquear: si no hay segmento de salida libre, el resultado vuelve serializado
+            out_shm = shared.acquire(block=False)
+            try:
+                res = run_in_pool(preprocess_shared, rec["handle"], out_shm and out_shm.name, rec["angle"])
+            except Exception as e:
+                meter.inc("errors", stage="preprocess")
+                if isinstance(e, TimeoutError):
+                    meter.inc("timeouts", stage="preprocess")
+                if logger and not stop_event.is_set():
+                    logger(f"Preprocesado fallo en página {rec['page']} de {os.path.basename(rec['task']['path'])}: {e}")
+                res = None
+                rec["text"] = ""
+            shared.release(rec["shm"])
+            rec.update(shm=None, handle=None)
+            if isinstance(res, tuple):
+                rec.update(shm=out_shm, handle=res)
+            else:
+                shared.release(out_shm)
+                rec["img"] = res
+            render_bytes, _ = estimate_page_bytes(rec["task"]["item"].get("page_size"), dpi)
+            budget.release(render_bytes)
+            rec["nbytes"] -= render_bytes
+        elif rec["img"] is not None:
+            try:
+                if current_pool() is not None:
+                    rec["img"] = run_in_pool(preprocess_page, rec["img"], rec["angle"])
+                else:
+                    rec["img"] = preprocess_page(rec["img"], rec["angle"])
+            except Exception as e:
+                meter.inc("errors", stage="preprocess")
+                if isinstance(e, TimeoutError):
+                    meter.inc("timeouts", stage="preprocess")
+                # si falla en una página, seguir con las demás
+                if logger and not stop_event.is_set():
+                    logger(f"Preprocesado fallo en página {rec['page']} de {os.path.basename(rec['task']['path'])}: {e}")
+                rec["img"], rec["text"] = None, ""
+            # el render ya no existe: solo queda reservada la copia preprocesada
+            render_bytes, _ = estimate_page_bytes(rec["task"]["item"].get("page_size"), dpi)
+            budget.release(render_bytes)
+            rec["nbytes"] -= render_bytes
+
+    def ocr_upright(rec, img):
+        path = rec["task"]["path"]
+        with corrections_lock:
+            # giro descubierto después de rasterizar esta página (por otra página del documento)
+            delta = (corrections.get(path, rec["angle"]) - rec["angle"]) % 360
+        if delta:
+            img = apply_page_correction(img, delta)
+        text = pytesseract.image_to_string(img, lang=lang, config=tesseract_config, timeout=OCR_TIMEOUT_S)
+        with corrections_lock:
+            check = path not in orientation_checked
+            orientation_checked.add(path)
+        if not check:
+            return text
+        # primer OCR del documento: si sale mal, ¿está girada 180° (o 90° al revés)?
+        fixed, rot = recheck_upright(img, text, lang, tesseract_config)
+        if not rot:
+            return text
+        with corrections_lock:
+            corrections[path] = (corrections.get(path, rec["angle"]) + rot) % 360
+        if logger:
+            logger(f"🔄 {os.path.basename(path)}: página girada {rot}°, se corrige el documento")
+        return fixed
+
+    def ocr(rec):
+        if rec["img"] is not None or rec["shm"] is not None:
+            try:
+                if not stop_event.is_set() and rec["task"]["path"] not in expired:
+                    img = rec["img"] if rec["img"] is not None else read_shared_page(rec["shm"], rec["handle"])
+                    with prof.span("ocr", rec["task"]["path"], rec["page"]), ocr_thread_limit(ocr_threads):
+                        rec["text"] = ocr_upright(rec, img)
+                    meter.inc("ocr_pages")
+                    del img
+            except Exception as e:
+                if not stop_event.is_set():
+                    meter.inc("errors", stage="ocr")
+                    if is_timeout_error(e):
+                        meter.inc("timeouts", stage="ocr")
+                if logger and not stop_event.is_set():
+                    logger(f"OCR fallo en página {rec['page']} de {os.path.basename(rec['task']['path'])}: {e}")
+                rec["text"] = ""
+            finally:
+                if rec["shm"] is not None:
+                    shared.release(rec["shm"])
+                rec.update(img=None, shm=None, handle=None)
+        # también si el preprocesado falló: su copia seguía reservada
+        budget.release(rec["nbytes"])
+        rec["nbytes"] = 0
+        yield rec
+
+    pages_done = defaultdict(int)
+    blank_pages = defaultdict(int)
+    texts = defaultdict(dict)
+    barcodes = {}
+    errors = {}
+
+    def collect(rec):
+        task = rec["task"]
+        item = task["item"]
+        path = task["path"]
+        text = rec["text"]
+        if split_pages and rec["barcode"]:
+            text = (text or "") + "\n" + rec["barcode"]
+        elif rec["barcode"]:
+            barcodes[path] = rec["barcode"]
+        texts[path][rec["page"]] = text
+        pages_done[path] += rec["count"]
+        blank_pages[path] += rec["blank"]
+        meter.mark("pages", rec["count"])
+        if rec["blank"]:
+            meter.inc("blank_pages")
+        if rec["error"] is not None:
+            errors[path] = rec["error"]
+        if pages_done[path] < item["pages"]:
+            return ()
+        if stop_event.is_set():
+            # cancelado: un documento a medio procesar no se entrega
+            texts.pop(path, None)
+            del pages_done[path]
+            blank_pages.pop(path, None)
+            with sources_lock:
+                src = sources.pop(path, path)
+            if isinstance(src, str) and src != path:
+                os.remove(src)
+            return ()
+        parts = texts.pop(path)
+        del pages_done[path]
+        with corrections_lock:
+            corrections.pop(path, None)
+            orientation_checked.discard(path)
+        barcode_docs.pop(path, None)
+        item["blank_pages"] = blank_pages.pop(path, 0)   # estadística por archivo
+        deadlines.pop(path, None)
+        if path in expired:
+            expired.discard(path)
+            errors.setdefault(path, TimeoutError(f"documento excedió {doc_timeout} s"))
+        with sources_lock:
+            src = sources.pop(path, path)
+        if isinstance(src, str) and src != path:
+            os.remove(src)
+        full_text = None
+        barcode_hri = barcodes.pop(path, None)
+        if path not in errors:
+            full_text = "\n\n".join(parts[k] for k in sorted(parts) if parts[k])
+            if barcode_hri:
+                full_text += "\n" + barcode_hri
+            if split_pages:
+                item["page_texts"] = {k: v for k, v in parts.items() if v}
+            if save_ocr_text and ocr_text_dir and not task["has_text"]:
+                save_ocr_text_file(path, full_text, ocr_text_dir, logger=logger, archive=archive)
+        error = errors.pop(path, None)
+        meter.mark("documents", result="ok" if error is None else "timeout" if is_timeout_error(error) else "error")
+        with prof.span("parseo", path):
+            on_document(item, full_text, error)
+        item.pop("data", None)   # el buffer del triage ya no se necesita
+        return ()
+
+    stages = [
+        PipelineStage("read", read, task_q, render_q, 2, downstream_workers=render_workers, logger=logger),
+        PipelineStage("render", render, render_q, pre_q, render_workers, downstream_workers=workers, logger=logger),
+        PipelineStage("preprocess", preprocess, pre_q, ocr_q, workers, downstream_workers=workers, logger=logger),
+        PipelineStage("ocr", ocr, ocr_q, parse_q, workers, downstream_workers=1, logger=logger),
+        PipelineStage("parse", collect, parse_q, None, 1, logger=logger),
+    ]
+    stage_threads = [t for st in stages for t in st.threads]
+
+    def watchdog():
+        # mata los poppler/tesseract de los hilos afectados: el hilo recibe el error y sigue
+        while any(t.is_alive() for t in stage_threads):
+            if stop_event.is_set():
+                kill_subprocesses(stage_threads)
+            else:
+                now = time.monotonic()
+                for st in stages:
+                    for th, (elem, _) in list(st.busy.items()):
+                        path = elem["path"] if "path" in elem else elem["task"]["path"]
+                        if now > deadlines.get(path, now + 1):
+                            if path not in expired and logger:
+                                logger(f"⏱️ {os.path.basename(path)} excedió {doc_timeout} s: se corta")
+                            expired.add(path)
+                            kill_subprocesses([th])
+            time.sleep(0.2)
+
+    metrics_key = meter.attach(stages)
+    for st in stages:
+        st.start()
+    threading.Thread(target=watchdog, name="watchdog", daemon=True).start()
+    try:
+        if "stream" in plan:
+            # se triagea mientras se descubre; la cola acotada frena el recorrido si el OCR va detrás
+            for it in plan["stream"]:
+                for t in item_tasks(it, workers):
+                    task_q.put(t)
+        else:
+            for t in schedule_tasks(plan, workers):
+                task_q.put(t)
+    finally:
+        for _ in range(stages[0].workers):
+            task_q.put(_END)
+    try:
+        for st in stages:
+            st.join()
+    finally:
+        meter.detach(metrics_key)
+        if pool is not None and warm_pool is None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        if shared is not None:
+            shared.close()
+        if spool_dir:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+        close_zips()
+        if archive is not None:
+            archive.close()
+    return budget
+
+
+# ---------- Cola de trabajos y pool compartido ----------
+# Varios trabajos carpeta -> Excel, cada uno con su configuración, que corren uno tras otro
+# o intercalados sobre un mismo pool de procesos ya arrancado (sin recrearlo por trabajo).
+JOB_PRIORITIES = {"alta": 0, "normal": 1, "baja": 2}
+JOB_AGING_S = 600   # cada 10 min en espera un trabajo sube un nivel de prioridad (no se posterga para siempre)
+
+class WarmPool:
+    """ProcessPoolExecutor que sobrevive entre lotes; se crea al primer uso."""
+
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def recycle(self, old, logger=None):
+        """Mata el pool si sigue siendo 'old' (proceso colgado); el próximo get crea otro."""
+        with self._lock:
+            if self._pool is not old:
+                return   # otro lote ya lo reinició
+            terminate_pool(old)
+            self._pool = None
+        if logger:
+            logger("♻️ Pool de preprocesado reiniciado (proceso colgado)")
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+class JobQueue:
+    """
+    Trabajos en espera con prioridad (JOB_PRIORITIES) y envejecimiento (JOB_AGING_S).
+    Cada trabajo es un dict con id, priority, state ('en cola', 'procesando', 'listo',
+    'error', 'cancelado'), added y la configuración que necesite quien lo ejecuta.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self._lock = threading.Lock()
+        self._seq = 0
+
+    def add(self, job, priority="normal"):
+        with self._lock:
+            self._seq += 1
+            job.update(id=self._seq, priority=priority, state="en cola", added=time.monotonic())
+            self.jobs.append(job)
+        return job
+
+    def remove(self, job_id):
+        """Quita un trabajo que todavía no empezó. False si ya está corriendo o terminó."""
+        with self._lock:
+            for job in self.jobs:
+                if job["id"] == job_id and job["state"] == "en cola":
+                    self.jobs.remove(job)
+                    return True
+        return False
+
+    def pending(self):
+        with self._lock:
+            return [j for j in self.jobs if j["state"] == "en cola"]
+
+    def next_job(self):
+        """El trabajo en espera de mayor prioridad efectiva (a igualdad, el más antiguo)."""
+        with self._lock:
+            now = time.monotonic()
+            pending = [j for j in self.jobs if j["state"] == "en cola"]
+            if not pending:
+                return None
+            job = min(pending, key=lambda j: (JOB_PRIORITIES[j["priority"]] - (now - j["added"]) / JOB_AGING_S, j["id"]))
+            job["state"] = "procesando"
+            return job
+
+    def run(self, execute, parallel=1, stop_event=None, on_change=None):
+        """
+        Ejecuta los trabajos hasta vaciar la cola: execute(job, share) con hasta 'parallel'
+        a la vez; share (1/parallel) es la fracción de workers y memoria que le toca a cada uno.
+        execute devuelve el estado final. Los trabajos agregados mientras corre también se toman.
+        """
+        stop_event = stop_event or threading.Event()
+        parallel = max(1, parallel)
+        slots = threading.Semaphore(parallel)
+        threads = []
+
+        def work(job):
+            try:
+                job["state"] = execute(job, 1 / parallel) or "listo"
+            except Exception:
+                job["state"] = "error"
+            finally:
+                slots.release()
+                if on_change:
+                    on_change()
+
+        while not stop_event.is_set():
+            if not slots.acquire(timeout=0.5):
+                continue
+            job = self.next_job()
+            if job is None:
+                slots.release()
+                if not any(t.is_alive() for t in threads):
+                    break
+                time.sleep(0.5)
+                continue
+            if on_change:
+                on_change()
+            t = threading.Thread(target=work, args=(job,), name=f"job-{job['id']}", daemon=True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+
+# ---------- Perfiles de OCR ----------
+# Combinaciones con nombre de modelos, idiomas y motor de tesseract, elegibles por trabajo.
+# "models" es la carpeta de traineddata junto a tesseract: tessdata (la que trae el paquete:
+# modelos LSTM "fast", sin componentes del motor legacy), tessdata_fast o tessdata_best
+# (float, más lentos y algo más precisos). Si la carpeta o el idioma no están, se usa tessdata.
+# oem: 0 = motor legacy, 1 = LSTM, 3 = el que haya (por defecto de tesseract). oem 0 necesita
+# modelos con componentes legacy; si no los tienen se usa LSTM. Cada respaldo queda en la
+# clave del perfil (columna PerfilOCR) y en "fallback".
+# "extra": opciones -c de tesseract; "rapido" usa los mismos modelos (ya son los "fast") pero
+# omite la segunda pasada que busca texto claro sobre fondo oscuro (los cupones no lo tienen).
+OCR_PROFILES = {
+    "estandar": {"lang": "spa", "oem": 3, "psm": 6, "models": "tessdata"},
+    "rapido": {"lang": "spa", "oem": 1, "psm": 6, "models": "tessdata", "extra": "-c tessedit_do_invert=0"},
+    "preciso": {"lang": "spa", "oem": 1, "psm": 6, "models": "tessdata_best"},
+    "spa+eng": {"lang": "spa+eng", "oem": 3, "psm": 6, "models": "tessdata"},
+    "antiguo": {"lang": "spa_old", "oem": 3, "psm": 6, "models": "tessdata"},
+    "legacy": {"lang": "spa", "oem": 0, "psm": 6, "models": "tessdata"},
+}
+DEFAULT_OCR_PROFILE = "estandar"
+TESSDATA_INTTEMP = 3   # índice en la tabla de componentes del .traineddata: plantillas del motor legacy
+
+def tessdata_dir(models):
+    """Carpeta de modelos junto al tesseract configurado (None si no existe)."""
+    d = os.path.join(os.path.dirname(pytesseract.pytesseract.tesseract_cmd or ""), models)
+    return d if os.path.isdir(d) else None
+
+def has_legacy_model(path):
+    """
+    True si el .traineddata trae los componentes del motor legacy (oem 0). Lee solo la
+    cabecera: cantidad de componentes y sus offsets (-1 = ausente). None si no se puede leer.
+    """
+    try:
+        with open(path, "rb") as f:
+            (count,) = struct.unpack("<i", f.read(4))
+            if not TESSDATA_INTTEMP < count <= 64:
+                return None
+            offsets = struct.unpack(f"<{count}q", f.read(8 * count))
+    except (OSError, struct.error):
+        return None
+    return offsets[TESSDATA_INTTEMP] >= 0
+
+def resolve_ocr_profile(name=DEFAULT_OCR_PROFILE, lang=None, logger=None):
+    """
+    Perfil listo para usar: {name, lang, oem, psm, models, config, key, fallback}.
+    lang, si se da, reemplaza los idiomas del perfil. config es la línea de opciones
+    para pytesseract y key identifica el perfil efectivo (para cachés y la salida).
+    fallback describe lo que se reemplazó por no estar en el equipo (None si nada).
+    """
+    prof = dict(OCR_PROFILES.get(name) or OCR_PROFILES[DEFAULT_OCR_PROFILE])
+    prof["name"] = name if name in OCR_PROFILES else DEFAULT_OCR_PROFILE
+    if name not in OCR_PROFILES and logger:
+        logger(f"Perfil OCR desconocido '{name}', se usa '{prof['name']}'")
+    if lang:
+        prof["lang"] = lang
+    d = tessdata_dir(prof["models"])
+    missing = d is None or not all(os.path.isfile(os.path.join(d, f"{l}.traineddata"))
+                                   for l in prof["lang"].split("+"))
+    fallback = []
+    models_key, oem_key = prof["models"], str(prof["oem"])
+    if prof["models"] != "tessdata" and missing:
+        fallback.append(f"no están los modelos {prof['models']}, se usan los de tessdata")
+        models_key = f"tessdata(sin {prof['models']})"
+        prof["models"] = "tessdata"
+        d = tessdata_dir("tessdata")
+    if prof["oem"] == 0 and d and not all(has_legacy_model(os.path.join(d, f"{l}.traineddata"))
+                                          for l in prof["lang"].split("+")):
+        # con modelos solo LSTM, --oem 0 hace fallar cada página
+        fallback.append("los modelos no traen el motor legacy, se usa LSTM (oem 1)")
+        prof["oem"] = 1
+        oem_key = "1(sin legacy)"
+    prof["fallback"] = "; ".join(fallback) or None
+    if prof["fallback"] and logger:
+        logger(f"⚠️ Perfil OCR '{prof['name']}' ({prof['lang']}): {prof['fallback']}")
+    config = f"--oem {prof['oem']} --psm {prof['psm']}"
+    if d and prof["models"] != "tessdata":
+        config += f' --tessdata-dir "{d}"'
+    if prof.get("extra"):
+        config += f" {prof['extra']}"
+    prof["config"] = config
+    prof["key"] = f"{prof['name']}:{prof['lang']}:oem{oem_key}:psm{prof['psm']}:{models_key}"
+    return prof
+
+# ---------- Paralelismo de Tesseract (OMP_THREAD_LIMIT) ----------
+# Tesseract usa OpenMP: N workers x M hilos por encima de los núcleos reales se pisan
+# y el rendimiento cae. Se elige la combinación midiendo páginas/segundo en la máquina
+# con una página real del lote, y el resultado se guarda por equipo en OCR_TUNING_FILE.
+OCR_TUNING_FILE = os.path.join(BASE, "ocr_tuning.json")
+TUNING_THREAD_OPTIONS = (1, 2, 4)   # hilos por tesseract a probar (workers = núcleos // hilos)
+TUNING_ROUNDS = 2                   # páginas por worker en cada prueba
+TUNING_PEEK_FILES = 50              # en streaming: entradas que se triagean por adelantado buscando un escaneado
+
+@contextmanager
+def ocr_thread_limit(threads):
+    """
+    Limita los hilos OpenMP de los tesseract que lance el hilo actual: OMP_THREAD_LIMIT va
+    en el entorno de cada subproceso (_TrackedPopen), sin tocar os.environ, así lotes
+    simultáneos con límites distintos no se pisan.
+    """
+    prev = getattr(_SUBPROCESS_ENV, "vars", None)
+    _SUBPROCESS_ENV.vars = {**(prev or {}), "OMP_THREAD_LIMIT": str(max(1, int(threads)))}
+    try:
+        yield
+    finally:
+        _SUBPROCESS_ENV.vars = prev
+
+def tuning_key(profile_key):
+    """Clave del perfil: equipo, núcleos, versión de tesseract y perfil OCR."""
+    try:
+        version = str(pytesseract.get_tesseract_version())
+    except Exception:
+        version = "?"
+    return f"{platform.node()}|{os.cpu_count()}|{version}|{profile_key}"
+
+def load_tuning_profile(profile_key, path=None):
+    """(workers, hilos) guardados para este equipo, o None si no hay perfil."""
+    try:
+        with open(path or OCR_TUNING_FILE, encoding="utf-8") as f:
+            prof = json.load(f).get(tuning_key(profile_key))
+        if prof:
+            return int(prof["workers"]), int(prof["threads"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def save_tuning_profile(profile_key, workers, threads, pages_per_sec, path=None):
+    path = path or OCR_TUNING_FILE
+    try:
+        with open(path, encoding="utf-8") as f:
+            profiles = json.load(f)
+    except (OSError, ValueError):
+        profiles = {}
+    profiles[tuning_key(profile_key)] = {"workers": workers, "threads": threads,
+                                  "pages_per_sec": round(pages_per_sec, 3),
+                                  "fecha": datetime.now().isoformat(timespec="seconds")}
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(profiles, f, indent=2)
+    except OSError:
+        pass   # carpeta de solo lectura: se vuelve a medir la próxima vez
+
+def peek_stream_items(plan, limit=TUNING_PEEK_FILES):
+    """
+    Plan en streaming: triagea entradas del frente hasta el primer escaneado (o limit) y
+    las devuelve al principio de plan["stream"], para que run_batch las procese igual.
+    """
+    stream = plan["stream"]
+    peeked = []
+    for item in stream:
+        peeked.append(item)
+        if not item["has_text"] or len(peeked) >= limit:
+            break
+    plan["stream"] = itertools.chain(peeked, stream)
+    return peeked
+
+def sample_page_for_tuning(plan, dpi):
+    """Primera página de un documento escaneado del plan, ya preprocesada (None si no hay)."""
+    # en streaming todavía no hay items: se miran las primeras entradas del stream
+    items = peek_stream_items(plan) if "stream" in plan else plan["items"]
+    for item in items:
+        if item.get("has_text"):
+            continue
+        try:
+            img = render_pdf_pages(item.get("data", item["path"]), dpi=dpi, first_page=1, last_page=1,
+                                   grayscale=True, timeout=RENDER_TIMEOUT_S)[0]
+            return image_preprocess(img)
+        except Exception:
+            continue
+    return None
+
+def tune_ocr_parallelism(sample_img, lang=DEFAULT_LANG, tesseract_config="--psm 6",
+                         cores=None, logger=None, stop_event=None):
+    """
+    Mide páginas/segundo de tesseract sobre sample_img con varias combinaciones
+    workers x hilos (workers * hilos = núcleos) y devuelve (workers, hilos, páginas/s)
+    de la más rápida.
+    """
+    cores = cores or os.cpu_count() or 1
+    best = (max(1, cores), 1, 0.0)
+    tried = set()
+    for threads in TUNING_THREAD_OPTIONS:
+        workers = max(1, cores // threads)
+        if threads > cores or (workers, threads) in tried:
+            continue
+        if stop_event is not None and stop_event.is_set():
+            break
+        tried.add((workers, threads))
+        pages = workers * TUNING_ROUNDS
+
+        def run(_, threads=threads):
+            with ocr_thread_limit(threads):
+                return pytesseract.image_to_string(sample_img, lang=lang, config=tesseract_config,
+                                                   timeout=OCR_TIMEOUT_S)
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(run, range(pages)))
+        pps = pages / max(1e-6, time.perf_counter() - t0)
+        if logger:
+            logger(f"  {workers} workers x {threads} hilos: {pps:.2f} páginas/s")
+        if pps > best[2]:
+            best = (workers, threads, pps)
+    return best
+
+def resolve_ocr_parallelism(plan, dpi, profile=None, logger=None, stop_event=None, retune=False):
+    """
+    (workers, hilos) para el lote: el perfil guardado del equipo o, si no hay (o retune),
+    una medición con una página del lote que se guarda para las próximas corridas.
+    Se mide con el perfil OCR del trabajo (resolve_ocr_profile) y se guarda por perfil.
+    Con un plan en streaming la página sale de sus primeras entradas (peek_stream_items).
+    Sin páginas OCR o si la medición falla: (DEFAULT_WORKERS, DEFAULT_OCR_THREADS).
+    """
+    profile = profile or resolve_ocr_profile()
+    if not retune:
+        prof = load_tuning_profile(profile["key"])
+        if prof:
+            return prof
+    if "stream" not in plan and not plan["ocr_pages"]:
+        return DEFAULT_WORKERS, DEFAULT_OCR_THREADS
+    sample = sample_page_for_tuning(plan, dpi)
+    if sample is None:
+        return DEFAULT_WORKERS, DEFAULT_OCR_THREADS
+    if logger:
+        logger("⚙️ Midiendo rendimiento de OCR en este equipo (solo la primera vez)...")
+    try:
+        workers, threads, pps = tune_ocr_parallelism(sample, lang=profile["lang"], tesseract_config=profile["config"],
+                                                     logger=logger, stop_event=stop_event)
+    except Exception as e:
+        if logger:
+            logger(f"No se pudo medir el OCR ({e}); se usan valores por defecto")
+        return DEFAULT_WORKERS, DEFAULT_OCR_THREADS
+    if stop_event is None or not stop_event.is_set():
+        save_tuning_profile(profile["key"], workers, threads, pps)
+    return workers, threads
+
+# ---------- Registros en columnas ----------
+# Con millones de cupones, una lista de dicts (~17 claves cada uno) pesa gigas y
+# pd.DataFrame(rows) la copia entera al final. RecordColumns acumula por columna: una lista
+# por campo y, en los campos que se repiten mucho (RECORD_CATEGORICAL), un código entero
+# de 4 bytes por fila contra una tabla de valores únicos. Pasa a DataFrame (categóricas
+# incluidas) o a Arrow sin armar un dict por fila; iterarla sí entrega dicts, de a uno.
+RECORD_CATEGORICAL = ("TipoCupon", "PerfilOCR", "GLNEmpresa", "ValidoHasta")
+
+class RecordColumns:
+    """Filas de resultados guardadas por columna (append/extend con dicts, como una lista)."""
+
+    __slots__ = ("_cols", "_cats", "_n")
+
+    def __init__(self, rows=()):
+        self._cols = {}   # columna -> lista de valores, o array('i') de códigos (-1 = vacío)
+        self._cats = {}   # columna categórica -> (valores únicos, {valor: código})
+        self._n = 0
+        self.extend(rows)
+
+    def _new_column(self, name):
+        if name in RECORD_CATEGORICAL:
+            self._cats[name] = ([], {})
+            col = array("i", [-1]) * self._n
+        else:
+            col = [None] * self._n
+        self._cols[name] = col
+        return col
+
+    def _code(self, name, value):
+        if value is None:
+            return -1
+        values, index = self._cats[name]
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(values)
+            values.append(value)
+        return code
+
+    def append(self, row):
+        n = self._n
+        for name, value in row.items():
+            col = self._cols[name] if name in self._cols else self._new_column(name)
+            col.append(self._code(name, value) if name in self._cats else value)
+        self._n += 1
+        for col in self._cols.values():   # campos que esta fila no trae
+            if len(col) == n:
+                col.append(-1 if isinstance(col, array) else None)
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def prepend(self, rows):
+        """Agrega rows al principio (p. ej. los archivos en cuarentena, que se conocen al final)."""
+        front = RecordColumns(rows)
+        for name in front._cols:
+            if name not in self._cols:
+                self._new_column(name)
+        for name, col in self._cols.items():
+            head = front.column(name)
+            col[:0] = array("i", (self._code(name, v) for v in head)) if name in self._cats else head
+        self._n += front._n
+
+    def column(self, name):
+        """Valores de una columna (None donde la fila no lo trae)."""
+        col = self._cols.get(name)
+        if col is None:
+            return [None] * self._n
+        if name in self._cats:
+            values = self._cats[name][0]
+            return [values[c] if c >= 0 else None for c in col]
+        return list(col)
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        names = list(self._cols)
+        decoded = {name: self._cats[name][0] for name in self._cats}
+        for i in range(self._n):
+            row = {}
+            for name in names:
+                v = self._cols[name][i]
+                if name in decoded:
+                    v = decoded[name][v] if v >= 0 else None
+                row[name] = v
+            yield row
+
+    def to_dataframe(self):
+        data = {}
+        for name, col in self._cols.items():
+            if name in self._cats:
+                data[name] = pd.Categorical.from_codes(np.frombuffer(col, dtype=np.intc) if self._n else [],
+                                                       categories=self._cats[name][0])
+            else:
+                data[name] = col
+        return pd.DataFrame(data, index=pd.RangeIndex(self._n))
+
+    def to_arrow(self):
+        """pyarrow.Table con las categóricas como diccionario (pyarrow solo hace falta si se llama)."""
+        import pyarrow as pa
+        arrays = {}
+        for name, col in self._cols.items():
+            if name in self._cats:
+                codes = np.frombuffer(col, dtype=np.intc) if self._n else np.zeros(0, dtype=np.intc)
+                arrays[name] = pa.DictionaryArray.from_arrays(pa.array(codes, mask=codes < 0),
+                                                              pa.array(self._cats[name][0]))
+            else:
+                arrays[name] = pa.array(col)
+        return pa.table(arrays)
+
+def results_frame(rows):
+    """DataFrame de una lista de dicts o de un RecordColumns."""
+    return rows.to_dataframe() if isinstance(rows, RecordColumns) else pd.DataFrame(rows)
+
+def benchmark_record_memory(n=200_000, seed=1234):
+    """
+    Memoria (MB, tracemalloc) de acumular n registros de cupón como lista de dicts y como
+    RecordColumns, y el pico al convertirlos a DataFrame. Devuelve {método: (acumulado, pico)}.
+    """
+    import tracemalloc
+    rng = np.random.default_rng(seed)
+    templates = []
+    for i in range(2000):
+        fields, _lines = synthetic_coupon(rng)
+        fields.update({"CodigoBarraLimpio": clean_barcode(fields["CodigoBarraRaw"]), "Pagina": 1, "CuponEnPagina": 1,
+                       "_file": f"cupon_{i:06d}.pdf", "PerfilOCR": "estandar:spa:oem3:psm6:tessdata",
+                       "PaginasEnBlanco": 0})
+        templates.append(fields)
+
+    def records():
+        # cadenas nuevas en cada fila, como las que arma el parser
+        for i in range(n):
+            yield {k: (v + " ")[:-1] if isinstance(v, str) else v for k, v in templates[i % len(templates)].items()}
+
+    results = {}
+    for name, make in (("lista de dicts", list), ("RecordColumns", RecordColumns)):
+        tracemalloc.start()
+        acc = make()
+        for row in records():
+            acc.append(row)
+        held = tracemalloc.get_traced_memory()[0]
+        df = results_frame(acc)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del acc, df
+        results[name] = (held / 2**20, peak / 2**20)
+    return results
 
 # ---------- Worker: procesa una carpeta ----------
-def process_all_pdfs(input_folder, output_excel, dpi, lang, tesseract_cmd, save_ocr_text, ocr_text_dir, progress_queue, log_queue, stop_event):
+# orden de columnas del Excel (las que no están aquí van al final)
+RESULT_COLUMNS = ["_file", "Pagina", "CuponEnPagina", "Cliente", "Contrato", "Identificacion", "NoSolicitud",
+                  "TipoCupon", "ValorAPagar", "NoRefPago", "DirCliente", "ValidoHasta",
+                  "CodigoBarraRaw", "CodigoBarraLimpio", "GLNEmpresa", "DiscrepanciaCodigo", "PaginasEnBlanco",
+                  "PerfilOCR", "error"]
+
+NO_COUPONS_ERROR = "ningún cupón reconocido (ninguna página trae campos clave)"
+
+def document_records(item, text, error, profile_key, logger=None, root=None):
+    """
+    Registros (uno por cupón) de un documento terminado por run_batch; relanza su error.
+    root: carpeta de entrada, para la ruta relativa de _file (ver result_file_name).
+    """
+    if error is not None:
+        raise error
+    if item.get("page_texts") is not None:
+        records = extract_coupon_records(item["page_texts"], logger=logger)
+        if not records:
+            raise ValueError(NO_COUPONS_ERROR)
+    else:
+        records = [extract_fields_timed(text, logger=logger)[0]]
+    for fields in records:
+        fields["_file"] = result_file_name(item["path"], root)
+        fields["PerfilOCR"] = "" if item["has_text"] else profile_key
+        fields["PaginasEnBlanco"] = item.get("blank_pages", 0)
+    return records
+
+def append_results_excel(rows, output_file):
+    """Escribe las filas (dicts o RecordColumns) en output_file (agrega al final si ya existe). True si agregó."""
+    df = results_frame(rows)
+    cols = [c for c in RESULT_COLUMNS if c in df.columns] + [c for c in df.columns if c not in RESULT_COLUMNS]
+    df = df[cols]
+    if os.path.exists(output_file):
+        existing_df = pd.read_excel(output_file)
+        pd.concat([existing_df, df], ignore_index=True).to_excel(output_file, index=False)
+        return True
+    df.to_excel(output_file, index=False)
+    return False
+
+def process_all_pdfs(input_folder, output_excel, dpi, lang, tesseract_cmd, save_ocr_text, ocr_text_dir, progress_queue, log_queue, stop_event,
+                     workers=DEFAULT_WORKERS, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, ocr_threads=DEFAULT_OCR_THREADS,
+                     ocr_profile=DEFAULT_OCR_PROFILE, split_pages=False, recursive=False,
+                     include=DEFAULT_INCLUDE, exclude=(), modified_after=None, profile_stages=False,
+                     results_db=False, skip_ocr_on_barcode=False):
     try:
+        profiler = StageProfiler() if profile_stages else None
         if tesseract_cmd:
             pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
-
-        files = [os.path.join(input_folder, f) for f in os.listdir(input_folder) if f.lower().endswith(".pdf")]
-        total = len(files)
-        if total == 0:
-            log_queue.put("No se encontraron archivos PDF en la carpeta seleccionada.")
-            progress_queue.put(("done", 0, 0))
-            return
+        profile = resolve_ocr_profile(ocr_profile, lang=lang, logger=log_queue.put)
+
+        # con subcarpetas el lote arranca mientras se recorren (plan en streaming, sin ETA global)
+        files = iter_input_files(input_folder, include=include, exclude=exclude, recursive=recursive,
+                                 modified_after=modified_after, stop_event=stop_event, logger=log_queue.put)
+        if not recursive:
+            files = list(files)
+            if not files:
+                log_queue.put("No se encontraron archivos PDF en la carpeta seleccionada.")
+                progress_queue.put(("done", 0, 0))
+                return
 
         if save_ocr_text:
             os.makedirs(ocr_text_dir, exist_ok=True)
 
-        rows = []
-        for idx, pdf in enumerate(files, start=1):
-            if stop_event.is_set():
-                log_queue.put("Proceso cancelado por el usuario.")
-                break
-            log_queue.put(f"Procesando: {os.path.basename(pdf)} ({idx}/{total}) ...")
+        plan = build_work_plan(files, dpi, logger=log_queue.put, stop_event=stop_event, stream=recursive,
+                               profiler=profiler)
+        if not recursive:
+            log_queue.put(describe_plan(plan, workers))
+        rows = RecordColumns()
+        done = len(plan["quarantined"])
+
+        def on_document(item, text, error):
+            nonlocal done
+            pdf = item["path"]
+            done += 1
+            log_queue.put(f"Procesando: {os.path.basename(pdf)} ({done}/{plan['files']}) ...")
             try:
-                text = extract_text_from_pdf(pdf, dpi=dpi, lang=lang, tesseract_config="--psm 6", save_ocr_text=save_ocr_text, ocr_text_dir=ocr_text_dir)
-                fields = extract_fields_from_text(text)
-                fields["_file"] = os.path.basename(pdf)
-                rows.append(fields)
-                log_queue.put(f"  -> OK")
+                records = document_records(item, text, error, profile["key"], logger=log_queue.put,
+                                           root=input_folder)
+                if results_db:
+                    for r in records:
+                        r["_hash"] = item.get("hash")
+                rows.extend(records)
+                log_queue.put(f"  -> OK ({len(records)} cupones)" if split_pages else "  -> OK")
             except Exception as e:
                 log_queue.put(f"  -> ERROR: {e}")
-                rows.append({"_file": os.path.basename(pdf), "error": str(e)})
-            progress_queue.put(("progress", idx, total))
-
-        # Guardar Excel (append if exists)
-        df = pd.DataFrame(rows)
-        # ordenar columnas
-        cols_order = ["_file", "Cliente", "Contrato", "Identificacion", "NoSolicitud",
-                      "TipoCupon", "ValorAPagar", "NoRefPago", "DirCliente", "ValidoHasta",
-                      "CodigoBarraRaw", "CodigoBarraLimpio", "error"]
-        cols = [c for c in cols_order if c in df.columns] + [c for c in df.columns if c not in cols_order]
-        df = df[cols]
+                rows.append({"_file": result_file_name(pdf, input_folder), "error": str(e)})
+            progress_queue.put(("progress", done, plan["files"]))
+
+        budget = run_batch(plan, on_document, workers=workers, dpi=dpi, lang=profile["lang"],
+                           tesseract_config=profile["config"], save_ocr_text=save_ocr_text,
+                           ocr_text_dir=ocr_text_dir, stop_event=stop_event, logger=log_queue.put,
+                           memory_budget_mb=memory_budget_mb, ocr_threads=ocr_threads, split_pages=split_pages,
+                           profiler=profiler, skip_ocr_on_barcode=skip_ocr_on_barcode, hash_content=results_db)
+        log_queue.put(f"Memoria máxima de páginas en vuelo: {budget.peak / 2**20:.0f} MB (presupuesto {memory_budget_mb} MB)")
+        if stop_event.is_set():
+            log_queue.put("Proceso cancelado por el usuario.")
+        elif not plan["files"]:
+            log_queue.put("No se encontraron archivos PDF en la carpeta seleccionada.")
+            progress_queue.put(("done", 0, 0))
+            return
+        rows.prepend({"_file": result_file_name(q["path"], input_folder), "error": f"cuarentena: {q['error']}"}
+                     for q in plan["quarantined"])
 
-        if os.path.exists(output_excel):
-            # Load existing data and append
-            existing_df = pd.read_excel(output_excel)
-            combined_df = pd.concat([existing_df, df], ignore_index=True)
-            combined_df.to_excel(output_excel, index=False)
+        # Guardar Excel (append if exists), o upsert en la base y Excel regenerado sin duplicados
+        with (profiler or NULL_PROFILER).span("excel", output_excel):
+            if results_db:
+                inserted, replaced, total = store_results(rows, output_excel)
+            else:
+                appended = append_results_excel(rows, output_excel)
+        if results_db:
+            log_queue.put(f"Base {results_db_path(output_excel)}: {inserted} nuevos, {replaced} reemplazados; "
+                          f"Excel regenerado con {total} registros")
+        elif appended:
             log_queue.put(f"Datos agregados al Excel existente: {output_excel}")
         else:
-            df.to_excel(output_excel, index=False)
             log_queue.put(f"Excel creado en: {output_excel}")
+        if profiler is not None:
+            table, trace = write_profile_report(profiler, output_excel)
+            log_queue.put(table)
+            log_queue.put(f"Línea de tiempo (chrome://tracing, ui.perfetto.dev): {trace}")
 
-        progress_queue.put(("done", total, total))
+        progress_queue.put(("done", plan["files"], plan["files"]))
     except Exception as e:
         log_queue.put(f"Fallo inesperado: {e}")
         progress_queue.put(("done", 0, 0))
 
+# ---------- Almacén de resultados (SQLite) ----------
+# Opcional: en vez de agregar filas al Excel a ciegas, los registros van a <salida>.db con
+# upsert por dos claves: huella del PDF + página + cupón (el mismo archivo reprocesado) y
+# NoRefPago + Contrato (el mismo cupón escaneado dos veces). El Excel se regenera desde la
+# base, sin duplicados, y las búsquedas son consultas por índice (ver ResultStore.find).
+# Si el Excel ya existe y la base está vacía (primer uso, o la .db se movió o borró), sus
+# filas entran primero a la base: regenerarlo nunca pierde lo que ya tenía.
+STORE_FIELDS = {"NoRefPago": "no_ref_pago", "Contrato": "contrato", "Identificacion": "identificacion",
+                "Cliente": "cliente", "_file": "archivo"}   # campos con columna e índice propios
+STORE_BATCH = 500
+
+def results_db_path(output_file):
+    return os.path.splitext(output_file)[0] + ".db"
+
+class ResultStore:
+    """
+    Registros de cupones por clave de contenido y de negocio. INSERT OR REPLACE borra
+    cualquier fila que choque con alguna de las dos claves únicas, así que un registro
+    nuevo reemplaza a la versión anterior del mismo archivo y a la del mismo cupón
+    (conserva la fecha en que se vio por primera vez). La clave de negocio compara con
+    COALESCE: un cupón sin contrato (o sin referencia) también se reemplaza en vez de
+    duplicarse (en SQLite dos NULL nunca chocan en un UNIQUE); sin ninguna de las dos no aplica.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=DELETE")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS results (
+            content_hash TEXT NOT NULL, pagina INTEGER NOT NULL DEFAULT 0, cupon INTEGER NOT NULL DEFAULT 0,
+            no_ref_pago TEXT, contrato TEXT, identificacion TEXT, cliente TEXT, archivo TEXT,
+            data TEXT NOT NULL, first_seen TEXT, updated TEXT,
+            UNIQUE (content_hash, pagina, cupon))""")
+        for col in ("contrato", "identificacion", "cliente", "archivo"):
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS results_{col} ON results ({col})")
+        if not self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'results_negocio'").fetchone():
+            # bases anteriores: se quedan con la versión más reciente de cada cupón antes del índice
+            self._db.execute("DELETE FROM results WHERE (no_ref_pago IS NOT NULL OR contrato IS NOT NULL) AND rowid "
+                             "NOT IN (SELECT MAX(rowid) FROM results WHERE no_ref_pago IS NOT NULL OR contrato "
+                             "IS NOT NULL GROUP BY COALESCE(no_ref_pago, ''), COALESCE(contrato, ''))")
+            self._db.execute("CREATE UNIQUE INDEX results_negocio ON results "
+                             "(COALESCE(no_ref_pago, ''), COALESCE(contrato, '')) "
+                             "WHERE no_ref_pago IS NOT NULL OR contrato IS NOT NULL")
+
+    @staticmethod
+    def _keys(row):
+        h = row.get("_hash") or "archivo:" + str(row.get("_file"))
+        return h, int(row.get("Pagina") or 0), int(row.get("CuponEnPagina") or 0)
+
+    def upsert(self, rows):
+        """
+        Guarda las filas (con '_hash' = SHA-256 del PDF, ver hash_content en run_batch).
+        Las filas sin huella (errores, cuarentena, las traídas de un Excel con seed_from_file)
+        quedan con la clave 'archivo:<_file>' (ruta relativa, ver result_file_name) y se borran
+        todas, de cualquier página, cuando ese archivo vuelve con huella.
+        Devuelve (nuevas, reemplazos).
+        """
+        inserted = replaced = 0
+        now = datetime.now().isoformat(timespec="seconds")
+        rows = iter(rows)   # lista de dicts o RecordColumns (arma los dicts de a uno)
+        with self._lock:
+            while True:
+                batch = list(itertools.islice(rows, STORE_BATCH))
+                if not batch:
+                    break
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    for row in batch:
+                        h, pagina, cupon = self._keys(row)
+                        legacy = "archivo:" + str(row.get("_file"))
+                        cols = {col: (str(row[f]) if row.get(f) not in (None, "") else None)
+                                for f, col in STORE_FIELDS.items()}
+                        ref, contrato = cols["no_ref_pago"], cols["contrato"]
+                        n, first = self._db.execute(
+                            "SELECT COUNT(*), MIN(first_seen) FROM results WHERE (content_hash = ? AND pagina = ? "
+                            "AND cupon = ?) OR content_hash = ? OR (? AND no_ref_pago IS ? AND contrato IS ?)",
+                            (h, pagina, cupon, legacy if h != legacy else None,
+                             ref is not None or contrato is not None, ref, contrato)).fetchone()
+                        if h != legacy:
+                            self._db.execute("DELETE FROM results WHERE content_hash = ?", (legacy,))
+                        data = json.dumps({k: v for k, v in row.items() if k != "_hash"}, ensure_ascii=False, default=str)
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO results (content_hash, pagina, cupon, no_ref_pago, contrato, "
+                            "identificacion, cliente, archivo, data, first_seen, updated) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                            (h, pagina, cupon, *cols.values(), data, first or now, now))
+                        replaced += n > 0
+                        inserted += n == 0
+                    self._db.execute("COMMIT")
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+        return inserted, replaced
+
+    def find(self, **criteria):
+        """Registros que cumplen campo=valor (campos de STORE_FIELDS), p. ej. find(NoRefPago="3201456")."""
+        where = [f"{STORE_FIELDS[f]} = ?" for f in criteria]
+        sql = "SELECT data FROM results" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY archivo, pagina, cupon"
+        with self._lock:
+            return [json.loads(d) for (d,) in self._db.execute(sql, [str(v) for v in criteria.values()])]
+
+    def count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def seed_from_file(self, output_file):
+        """Carga las filas de un Excel/CSV de resultados ya existente (sin huella). Devuelve cuántas."""
+        keys = {f: str for f in STORE_FIELDS}   # sin que pandas los lea como números (3201456.0)
+        if output_file.lower().endswith(".csv"):
+            df = pd.read_csv(output_file, dtype=keys, encoding="utf-8-sig")
+        else:
+            df = pd.read_excel(output_file, dtype=keys)
+        rows = [{k: v for k, v in r.items() if not pd.isna(v)} for r in df.to_dict("records")]
+        self.upsert(rows)
+        return len(rows)
+
+    def export(self, output_file):
+        """Escribe todos los registros a .csv (UTF-8 con BOM, abre bien en Excel) o .xlsx. Devuelve cuántos."""
+        df = pd.DataFrame(self.find())
+        cols = [c for c in RESULT_COLUMNS if c in df.columns] + [c for c in df.columns if c not in RESULT_COLUMNS]
+        df = df[cols]
+        if output_file.lower().endswith(".csv"):
+            df.to_csv(output_file, index=False, encoding="utf-8-sig")
+        else:
+            df.to_excel(output_file, index=False)
+        return len(df)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def store_results(rows, output_file):
+    """
+    Upsert de las filas en <salida>.db y Excel regenerado desde la base. Si la base está
+    vacía y el Excel ya existe, sus filas se cargan antes (ver ResultStore.seed_from_file).
+    Devuelve (nuevas, reemplazos, total).
+    """
+    store = ResultStore(results_db_path(output_file))
+    try:
+        if os.path.exists(output_file) and store.count() == 0:
+            store.seed_from_file(output_file)
+        inserted, replaced = store.upsert(rows)
+        total = store.export(output_file)
+    finally:
+        store.close()
+    return inserted, replaced, total
+
+# ---------- Modo distribuido: libro de trabajo compartido ----------
+# Varios equipos procesan el mismo lote contra una carpeta compartida. Se coordinan con un
+# archivo SQLite en el recurso compartido (el "ledger"): cada nodo reclama archivos con un
+# lease que renueva mientras trabaja; si un nodo se cae, su lease vence y otro lo retoma.
+# Cada nodo escribe sus resultados en su propio shard (JSON lines) y al final se unen en
+# un Excel (merge_shards). Las claves son rutas relativas a la carpeta de entrada, así
+# Windows (\\servidor\recurso) y Linux (/mnt/recurso) comparten el mismo ledger.
+LEASE_SECONDS = 300      # vigencia de un lease; se renueva cada LEASE_SECONDS / 3
+LEASE_MAX_ATTEMPTS = 3   # reclamos por archivo antes de darlo por fallido (nodos que se caen con él)
+LEDGER_BATCH = 500       # archivos por transacción al registrar el lote
+REGISTRATION_POLL_S = 5  # espera de un nodo sin trabajo mientras otro termina de registrar la carpeta
+
+def ledger_key(path, root):
+    """Clave del archivo en el ledger: ruta relativa a root con '/' (el miembro de ZIP se conserva)."""
+    member = ""
+    if is_zip_member(path):
+        path, member = path.split(ZIP_MEMBER_SEP, 1)
+        member = ZIP_MEMBER_SEP + member
+    return os.path.relpath(path, root).replace(os.sep, "/") + member
+
+def ledger_local_path(key, root):
+    path, sep, member = key.partition(ZIP_MEMBER_SEP)
+    return os.path.join(root, *path.split("/")) + sep + member
+
+class WorkLedger:
+    """
+    Reparto de archivos entre nodos con leases sobre SQLite.
+    Estados: pending -> leased (node, lease_until) -> done | failed. Un lease vencido vuelve
+    a ser reclamable. Se usa el journal clásico (no WAL: WAL no funciona sobre SMB/NFS) y
+    transacciones IMMEDIATE para que dos nodos no reclamen el mismo archivo.
+    Los relojes de los nodos deben estar razonablemente sincronizados (lease >> desfase).
+    """
+
+    def __init__(self, path, node=None, lease_s=LEASE_SECONDS):
+        self.path = path
+        self.node = node or f"{platform.node()}-{os.getpid()}"
+        self.lease_s = lease_s
+        self.held = set()   # claves con lease de este nodo (las renueva el heartbeat)
+        self.registering = False   # este nodo tiene el lease de registro (meta 'registering')
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=DELETE")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS files (
+            key TEXT PRIMARY KEY, state TEXT NOT NULL DEFAULT 'pending', node TEXT,
+            lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT, updated REAL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS files_state ON files (state, lease_until)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+
+    def _tx(self, fn):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._db)
+                self._db.execute("COMMIT")
+                return result
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def add(self, keys):
+        """Registra claves nuevas (las ya conocidas se ignoran). Devuelve cuántas se agregaron."""
+        added, batch = 0, []
+        def flush(db):
+            before = db.total_changes
+            db.executemany("INSERT OR IGNORE INTO files (key, updated) VALUES (?, ?)",
+                           [(k, time.time()) for k in batch])
+            added = db.total_changes - before
+            if self.registering:
+                self._renew_registration(db)   # el recorrido sigue vivo
+            return added
+        for key in keys:
+            batch.append(key)
+            if len(batch) >= LEDGER_BATCH:
+                added += self._tx(flush)
+                batch = []
+        if batch:
+            added += self._tx(flush)
+        return added
+
+    def get_meta(self, name):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, name, value):
+        self._tx(lambda db: db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value)))
+
+    def _renew_registration(self, db):
+        db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('registering', ?)",
+                   (f"{self.node}|{time.time() + self.lease_s}",))
+
+    def begin_registration(self):
+        """
+        Lease de registro: True si este nodo debe recorrer la carpeta (nadie la terminó de
+        registrar ni tiene el lease vigente). Se toma en la misma transacción en que se mira,
+        así un nodo que arranca a mitad del recorrido de otro no vuelve a recorrer todo.
+        """
+        def fn(db):
+            meta = dict(db.execute("SELECT name, value FROM meta WHERE name IN ('registered', 'registering')"))
+            if "registered" in meta:
+                return False
+            if "registering" in meta:
+                holder, until = meta["registering"].rsplit("|", 1)
+                if holder != self.node and float(until) > time.time():
+                    return False
+            self._renew_registration(db)
+            return True
+        self.registering = self._tx(fn)
+        return self.registering
+
+    def end_registration(self, finished=True):
+        """Suelta el lease de registro; con finished la carpeta queda registrada para todos."""
+        if not self.registering:
+            return
+        self.registering = False
+        def fn(db):
+            db.execute("DELETE FROM meta WHERE name = 'registering' AND value LIKE ?", (f"{self.node}|%",))
+            if finished:
+                db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('registered', ?)", (self.node,))
+        self._tx(fn)
+
+    def shards(self):
+        """{nodo: nombre del archivo de shard} tal como cada nodo lo anotó al arrancar."""
+        with self._lock:
+            rows = self._db.execute("SELECT name, value FROM meta WHERE name LIKE 'shard:%'").fetchall()
+        return {name[len("shard:"):]: value for name, value in rows}
+
+    def claim(self, n=1):
+        """Reclama hasta n archivos pendientes o con lease vencido. Devuelve [(clave, reintento)]."""
+        def fn(db):
+            now = time.time()
+            rows = db.execute(
+                "SELECT key, state FROM files WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+                "ORDER BY state = 'leased', key LIMIT ?", (now, n)).fetchall()
+            failed = []
+            claimed = []
+            for key, state in rows:
+                attempts = db.execute("SELECT attempts FROM files WHERE key = ?", (key,)).fetchone()[0]
+                if attempts >= LEASE_MAX_ATTEMPTS:
+                    failed.append(key)
+                    continue
+                claimed.append((key, state == "leased"))
+            db.executemany("UPDATE files SET state = 'failed', node = NULL, error = ?, updated = ? WHERE key = ?",
+                           [(f"abandonado tras {LEASE_MAX_ATTEMPTS} leases vencidos", now, k) for k in failed])
+            db.executemany("UPDATE files SET state = 'leased', node = ?, lease_until = ?, attempts = attempts + 1, "
+                           "updated = ? WHERE key = ?",
+                           [(self.node, now + self.lease_s, now, k) for k, _ in claimed])
+            return claimed
+        claimed = self._tx(fn)
+        self.held.update(k for k, _ in claimed)
+        return claimed
+
+    def renew(self):
+        """Extiende los leases de este nodo. Devuelve las claves que perdió (otro nodo las tomó)."""
+        keys = list(self.held)
+        if not keys:
+            return []
+        def fn(db):
+            now = time.time()
+            lost = []
+            for key in keys:
+                cur = db.execute("UPDATE files SET lease_until = ?, updated = ? "
+                                 "WHERE key = ? AND node = ? AND state = 'leased'",
+                                 (now + self.lease_s, now, key, self.node))
+                if cur.rowcount == 0:
+                    lost.append(key)
+            return lost
+        lost = self._tx(fn)
+        self.held.difference_update(lost)
+        return lost
+
+    def complete(self, key, error=None):
+        """Marca el archivo como terminado (o fallido). False si el lease ya no era de este nodo."""
+        self.held.discard(key)
+        state = "failed" if error else "done"
+        return self._tx(lambda db: db.execute(
+            "UPDATE files SET state = ?, error = ?, lease_until = NULL, updated = ? "
+            "WHERE key = ? AND node = ? AND state = 'leased'",
+            (state, error, time.time(), key, self.node)).rowcount == 1)
+
+    def release(self, keys=None):
+        """Devuelve a pendientes los archivos reclamados y no terminados (cancelación)."""
+        keys = list(self.held if keys is None else keys)
+        self.held.difference_update(keys)
+        self._tx(lambda db: db.executemany(
+            "UPDATE files SET state = 'pending', node = NULL, lease_until = NULL, attempts = attempts - 1 "
+            "WHERE key = ? AND node = ? AND state = 'leased'", [(k, self.node) for k in keys]))
+
+    def owners(self):
+        """{clave: nodo} de los archivos terminados: qué shard tiene el resultado válido."""
+        with self._lock:
+            return dict(self._db.execute("SELECT key, node FROM files WHERE state IN ('done', 'failed')"))
+
+    def abandoned(self):
+        """[(clave, error)] de los archivos fallidos sin nodo (ningún shard tiene su fila)."""
+        with self._lock:
+            return self._db.execute("SELECT key, error FROM files WHERE state = 'failed' AND node IS NULL").fetchall()
+
+    def counts(self):
+        with self._lock:
+            rows = self._db.execute("SELECT state, COUNT(*) FROM files GROUP BY state").fetchall()
+        return {"pending": 0, "leased": 0, "done": 0, "failed": 0, **dict(rows)}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def shard_dir_for(ledger_path):
+    return ledger_path + ".shards"
+
+def append_shard_rows(shard_path, rows):
+    """Agrega filas al shard del nodo (JSON lines) y las baja a disco antes de cerrar el lease."""
+    with open(shard_path, "a", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def run_node(ledger_path, input_folder, dpi=DEFAULT_DPI, workers=DEFAULT_WORKERS, ocr_profile=DEFAULT_OCR_PROFILE,
+             node=None, split_pages=False, discovery=None, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+             ocr_threads=DEFAULT_OCR_THREADS, logger=None, stop_event=None, metrics=None):
+    """
+    Un nodo del lote distribuido: registra los archivos de input_folder en el ledger (solo
+    si nadie terminó de hacerlo ni lo está haciendo: lease de registro), y reclama tandas de
+    workers*2 archivos hasta que no quede nada, procesándolas con run_batch. Un hilo renueva
+    los leases cada lease/3. Sin trabajo mientras otro nodo registra, espera y reintenta (y
+    retoma el registro si ese nodo se cayó).
+    Los resultados van a <ledger>.shards/<nodo>.jsonl; el nombre queda anotado en el ledger
+    (meta 'shard:<nodo>') para merge_shards. Devuelve los contadores del ledger.
+    """
+    stop_event = stop_event or threading.Event()
+    log = logger or (lambda msg: None)
+    ledger = WorkLedger(ledger_path, node=node)
+    profile = resolve_ocr_profile(ocr_profile, logger=logger)
+    os.makedirs(shard_dir_for(ledger_path), exist_ok=True)
+    shard_name = re.sub(r"[^\w.-]", "_", ledger.node) + ".jsonl"
+    shard = os.path.join(shard_dir_for(ledger_path), shard_name)
+    ledger.set_meta(f"shard:{ledger.node}", shard_name)
+
+    def register():
+        try:
+            files = iter_input_files(input_folder, stop_event=stop_event, logger=logger, **(discovery or {}))
+            added = ledger.add(ledger_key(f, input_folder) for f in files)
+        finally:
+            ledger.end_registration(finished=not stop_event.is_set())
+        log(f"🗃️ {added} archivos nuevos en el ledger")
+
+    try:
+        if ledger.begin_registration():
+            register()
+        log(f"🖧 Nodo {ledger.node}: {ledger.counts()}")
+
+        def heartbeat(done):
+            while not done.wait(ledger.lease_s / 3):
+                try:
+                    lost = ledger.renew()
+                except sqlite3.Error as e:
+                    log(f"⚠️ No se pudieron renovar los leases: {e}")
+                    continue
+                for key in lost:
+                    log(f"⚠️ Lease perdido (otro nodo lo retomó): {key}")
+
+        while not stop_event.is_set():
+            claimed = ledger.claim(max(1, workers) * 2)
+            if not claimed:
+                if ledger.get_meta("registered") is not None:
+                    break
+                # otro nodo sigue recorriendo la carpeta: se espera a que agregue más (o se retoma
+                # el registro si su lease venció)
+                if ledger.begin_registration():
+                    register()
+                else:
+                    stop_event.wait(REGISTRATION_POLL_S)
+                continue
+            for key, retry in claimed:
+                if retry:
+                    log(f"♻️ Lease vencido retomado: {key}")
+            keys = {ledger_local_path(k, input_folder): k for k, _ in claimed}
+            plan = build_work_plan(list(keys), dpi, logger=logger, stop_event=stop_event)
+            for q in plan["quarantined"]:
+                row = {"_file": keys[q["path"]], "error": f"cuarentena: {q['error']}", "_key": keys[q["path"]]}
+                append_shard_rows(shard, [row])
+                ledger.complete(keys[q["path"]], error=q["error"])
+
+            def on_document(item, text, error):
+                key = keys[item["path"]]
+                try:
+                    rows = document_records(item, text, error, profile["key"], logger=logger, root=input_folder)
+                    err = None
+                except Exception as e:
+                    rows, err = [{"_file": key, "error": str(e)}], str(e)
+                for row in rows:
+                    row["_key"] = key
+                append_shard_rows(shard, rows)
+                if not ledger.complete(key, error=err):
+                    log(f"⚠️ {key}: el lease había vencido; se usará el resultado del otro nodo")
+
+            done = threading.Event()
+            threading.Thread(target=heartbeat, args=(done,), name="lease-heartbeat", daemon=True).start()
+            try:
+                run_batch(plan, on_document, workers=workers, dpi=dpi, lang=profile["lang"],
+                          tesseract_config=profile["config"], stop_event=stop_event, logger=logger,
+                          memory_budget_mb=memory_budget_mb, ocr_threads=ocr_threads, split_pages=split_pages,
+                          metrics=metrics)
+            finally:
+                done.set()
+        if ledger.held:
+            ledger.release()   # cancelado: lo no terminado queda libre para otros nodos
+        counts = ledger.counts()
+        log(f"🖧 Nodo {ledger.node} terminado: {counts}")
+        return counts
+    finally:
+        ledger.close()
+
+def merge_shards(ledger_path, output_excel, logger=None):
+    """
+    Une los shards de todos los nodos en un Excel. De cada archivo se toman solo las filas
+    del nodo que lo cerró en el ledger (si un lease venció, el otro nodo pudo procesarlo también).
+    """
+    ledger = WorkLedger(ledger_path, node="merge")
+    try:
+        owners = ledger.owners()
+        shards = ledger.shards()
+        abandoned = ledger.abandoned()
+        counts = ledger.counts()
+    finally:
+        ledger.close()
+    rows = RecordColumns()
+    folder = shard_dir_for(ledger_path)
+    for node, name in sorted(shards.items()):
+        path = os.path.join(folder, name)
+        if not os.path.exists(path):
+            continue   # nodo que no llegó a escribir filas
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                if owners.get(row.get("_key")) == node:
+                    rows.append(row)
+    rows.extend({"_file": key, "error": error} for key, error in abandoned)
+    df = rows.to_dataframe().drop(columns=["_key"], errors="ignore")
+    cols = [c for c in RESULT_COLUMNS if c in df.columns] + [c for c in df.columns if c not in RESULT_COLUMNS]
+    df[cols].to_excel(output_excel, index=False)
+    if logger:
+        pending = counts["pending"] + counts["leased"]
+        logger(f"📊 {len(rows)} registros de {len(owners)} archivos en {output_excel}"
+               + (f" (faltan {pending} archivos por procesar)" if pending else ""))
+    return len(rows)
+
+# ---------- Benchmarks: corpus sintético ----------
+# Cupones generados localmente (sin datos de clientes) con la verdad de cada campo en
+# manifest.json: variantes con capa de texto y escaneadas (ruido, inclinación, varias
+# páginas, páginas en blanco). run_benchmark mide cada etapa con StageProfiler y compara
+# contra la línea base guardada por equipo en BENCH_BASELINE_FILE.
+BENCH_BASELINE_FILE = os.path.join(BASE, "bench_baseline.json")
+BENCH_CORPUS_DIR = os.path.join(BASE, "bench_corpus")
+BENCH_DOCS = 24               # documentos del corpus por defecto
+BENCH_SCAN_DPI = 200          # resolución de las páginas escaneadas sintéticas
+BENCH_REGRESSION_PCT = 20     # % de empeoramiento tolerado antes de marcar regresión
+BENCH_MIN_DELTA_S = 0.005     # diferencias por debajo de esto son ruido (etapas de microsegundos)
+
+_BENCH_NOMBRES = ["MARIA", "JOSE", "LUIS", "ANA", "CARLOS", "SANDRA", "JORGE", "LUZ", "ANDRES", "PAOLA",
+                  "FERNANDO", "DIANA", "JULIAN", "CAROLINA", "MIGUEL", "ANGELA"]
+_BENCH_APELLIDOS = ["LOPEZ", "GARCIA", "RODRIGUEZ", "MARTINEZ", "GOMEZ", "PEREZ", "SANCHEZ", "RAMIREZ",
+                    "TORRES", "MUÑOZ", "ROJAS", "DIAZ", "MORENO", "JIMENEZ", "CASTRO", "VARGAS"]
+_BENCH_VIAS = ["KR", "CL", "AV", "TV", "DG"]
+
+def synthetic_coupon(rng):
+    """(campos esperados, líneas del cupón) con el formato que espera extract_fields_from_text."""
+    cliente = " ".join(list(rng.choice(_BENCH_NOMBRES, rng.integers(1, 3), replace=False))
+                       + list(rng.choice(_BENCH_APELLIDOS, 2, replace=False)))
+    ident = str(rng.integers(10_000_000, 1_999_999_999))
+    contrato = str(rng.integers(1_000_000, 9_999_999))
+    direccion = f"{rng.choice(_BENCH_VIAS)} {rng.integers(1, 200)} # {rng.integers(1, 120)}-{rng.integers(1, 99)}"
+    if rng.random() < 0.5:
+        direccion += f" APTO {rng.integers(101, 1500)}"
+    ref = str(rng.integers(1_000_000, 9_999_999))
+    solicitud = str(rng.integers(1_000_000_000, 9_999_999_999))
+    tipo = "CA" if rng.random() < 0.2 else "FA"
+    valor = int(rng.integers(50, 5000)) * 100
+    fecha = datetime(2025, 1, 1) + timedelta(days=int(rng.integers(0, 365)))
+    gln = str(rng.integers(770_000_000_000, 770_999_999_999))
+    gln += next(d for d in "0123456789" if gs1_check_digit_ok(gln + d))
+    valido = f"{fecha.day:02d}-{MESES_ES[fecha.month - 1]}-{fecha.year}"
+    raw = f"(415){gln}(8020){ref.zfill(10)}(3900){valor}(96){fecha:%Y%m%d}"
+    fields = {"Cliente": cliente, "Identificacion": ident, "Contrato": contrato, "DirCliente": direccion,
+              "NoSolicitud": solicitud, "NoRefPago": ref, "TipoCupon": tipo,
+              "ValidoHasta": valido, "ValorAPagar": str(valor), "CodigoBarraRaw": raw, "GLNEmpresa": gln}
+    lines = ["EMPRESA DE SERVICIOS PUBLICOS S.A. E.S.P.",
+             f"Cliente: {cliente} Identificacion: {ident}",
+             f"Contrato: {contrato}",
+             f"Dir. Cliente: {direccion}",
+             f"No. Ref. Pago: {ref} No. Solicitud {solicitud}",
+             f"Tipo de Cupon: {tipo}",
+             f"Valido hasta: {valido}",
+             f"Valor a pagar $ {valor:,}.00",
+             raw]
+    return fields, lines
+
+def _pdf_text_escape(s):
+    return s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def write_text_pdf(path, pages):
+    """PDF mínimo con capa de texto (Helvetica, WinAnsi): una lista de líneas por página ([] = en blanco)."""
+    n = len(pages)
+    objs = [b"<< /Type /Catalog /Pages 2 0 R >>",
+            ("<< /Type /Pages /Kids [" + " ".join(f"{4 + 2 * i} 0 R" for i in range(n))
+             + f"] /Count {n} >>").encode(),
+            b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"]
+    for i, lines in enumerate(pages):
+        stream = "BT /F1 10 Tf 14 TL 54 740 Td " + " ".join(f"({_pdf_text_escape(ln)}) Tj T*" for ln in lines) + " ET"
+        stream = stream.encode("cp1252", errors="replace") if lines else b""
+        objs.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> "
+                    f"/Contents {5 + 2 * i} 0 R >>".encode())
+        objs.append(f"<< /Length {len(stream)} >>\nstream\n".encode() + stream + b"\nendstream")
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for k, body in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += f"{k} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{o:010d} 00000 n \n" for o in offsets).encode()
+    out += f"trailer\n<< /Size {len(objs) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(out)
+
+def render_scan_page(lines, rng, dpi=BENCH_SCAN_DPI, skew=0.0, noise=0.0):
+    """Página carta en gris como la entregaría un escáner: texto a 10 pt, inclinación y ruido."""
+    from PIL import ImageDraw
+    img = Image.new("L", (int(8.5 * dpi), int(11 * dpi)), 255)
+    size = round(10 / 72 * dpi)
+    draw = ImageDraw.Draw(img)
+    y = int(0.9 * dpi)
+    for ln in lines:
+        draw.text((int(0.75 * dpi), y), ln, fill=0, font_size=size)
+        y += int(size * 1.5)
+    if skew:
+        img = img.rotate(skew, resample=Image.BICUBIC, fillcolor=255)
+    if noise:
+        arr = np.asarray(img, dtype=np.float32) + rng.normal(0, noise, (img.height, img.width))
+        specks = rng.random((img.height, img.width)) < noise / 20000   # motas de polvo
+        arr[specks] = 0
+        img = Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8))
+    return img
+
+def generate_bench_corpus(folder=BENCH_CORPUS_DIR, docs=BENCH_DOCS, seed=1234, dpi=BENCH_SCAN_DPI, logger=None):
+    """
+    Genera el corpus en folder y escribe manifest.json con los campos esperados por archivo
+    (un cupón por página, en orden). Mezcla: 1 de cada 3 con capa de texto, el resto escaneados;
+    cada 5º con varios cupones y cada 4º con una página en blanco al final.
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    files = {}
+    for i in range(docs):
+        kind = "texto" if i % 3 == 0 else "escaneo"
+        coupons = [synthetic_coupon(rng) for _ in range(int(rng.integers(2, 4)) if i % 5 == 4 else 1)]
+        pages = [lines for _fields, lines in coupons] + ([[]] if i % 4 == 3 else [])
+        name = f"cupon_{i + 1:03d}_{kind}.pdf"
+        entry = {"kind": kind, "pages": len(pages), "blank_pages": len(pages) - len(coupons),
+                 "coupons": [fields for fields, _lines in coupons]}
+        path = os.path.join(folder, name)
+        if kind == "texto":
+            write_text_pdf(path, pages)
+        else:
+            entry["skew"] = round(float(rng.uniform(-2, 2)), 2)
+            entry["noise"] = float(rng.choice([0, 8, 16]))
+            imgs = [render_scan_page(lines, rng, dpi, entry["skew"] if lines else 0.0, entry["noise"])
+                    for lines in pages]
+            imgs[0].save(path, "PDF", save_all=True, append_images=imgs[1:], resolution=dpi)
+        files[name] = entry
+    manifest = {"seed": seed, "dpi": dpi, "created": datetime.now().isoformat(timespec="seconds"), "files": files}
+    with open(os.path.join(folder, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    if logger:
+        logger(f"🧪 Corpus sintético: {docs} PDFs en {folder}")
+    return manifest
+
+def load_bench_manifest(folder=BENCH_CORPUS_DIR, logger=None):
+    """manifest.json del corpus; si no existe, genera el corpus por defecto en folder."""
+    try:
+        with open(os.path.join(folder, "manifest.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return generate_bench_corpus(folder, logger=logger)
+
+def bench_key(dpi, lang):
+    return tuning_key(f"bench|{dpi}|{lang}")
+
+def run_benchmark(folder=BENCH_CORPUS_DIR, dpi=DEFAULT_DPI, lang=DEFAULT_LANG, tesseract_config="--psm 6",
+                  logger=None):
+    """
+    Pasa el corpus por las funciones del lote, una a una y en este hilo para que los tiempos
+    sean comparables: extract_text_from_pdf (texto), image_preprocess por página escaneada
+    (render + preprocesado), parseo de cupones y escritura del Excel.
+    Devuelve {key, docs, pages, seconds, pages_per_sec, stages: StageProfiler.summary()}.
+    """
+    manifest = load_bench_manifest(folder, logger=logger)
+    prof = StageProfiler()
+    rows, pages = RecordColumns(), 0
+    t0 = time.perf_counter()
+    for name, entry in manifest["files"].items():
+        path = os.path.join(folder, name)
+        pages += entry["pages"]
+        with prof.span("texto", name):
+            text = extract_text_from_pdf(path, dpi=dpi, lang=lang, tesseract_config=tesseract_config)
+        if entry["kind"] == "escaneo":
+            with prof.span("render", name):
+                imgs = render_pdf_pages(path, dpi=dpi, grayscale=True, timeout=DOC_TIMEOUT_S)
+            for p, img in enumerate(imgs, 1):
+                with prof.span("preprocesado", name, p):
+                    image_preprocess(img)
+            del imgs
+        with prof.span("parseo", name):
+            records = extract_coupon_records({1: text})
+        for fields in records:
+            fields["_file"] = name
+        rows.extend(records)
+    with tempfile.TemporaryDirectory() as tmp:
+        with prof.span("excel", "lote"):
+            append_results_excel(rows, os.path.join(tmp, "bench.xlsx"))
+    seconds = time.perf_counter() - t0
+    return {"key": bench_key(dpi, lang), "fecha": datetime.now().isoformat(timespec="seconds"),
+            "docs": len(manifest["files"]), "pages": pages, "rows": len(rows), "seconds": round(seconds, 3),
+            "pages_per_sec": round(pages / seconds, 3) if seconds else 0.0, "stages": prof.summary(),
+            "table": prof.format_summary()}
+
+def load_bench_baseline(key, path=None):
+    try:
+        with open(path or BENCH_BASELINE_FILE, encoding="utf-8") as f:
+            return json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+
+def save_bench_baseline(result, path=None):
+    path = path or BENCH_BASELINE_FILE
+    try:
+        with open(path, encoding="utf-8") as f:
+            baselines = json.load(f)
+    except (OSError, ValueError):
+        baselines = {}
+    baselines[result["key"]] = {k: v for k, v in result.items() if k != "table"}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(baselines, f, indent=2)
+
+def compare_benchmark(result, baseline, pct=BENCH_REGRESSION_PCT, min_delta=BENCH_MIN_DELTA_S):
+    """Regresiones frente a la línea base: páginas/s más bajas o p50/p95 por etapa más altos que pct %."""
+    regressions = []
+    tol = pct / 100
+    if result["pages_per_sec"] < baseline["pages_per_sec"] * (1 - tol):
+        regressions.append(f"páginas/s {baseline['pages_per_sec']:.2f} → {result['pages_per_sec']:.2f}")
+    for stage, st in result["stages"].items():
+        base = baseline["stages"].get(stage)
+        if not base:
+            continue
+        for metric in ("wall_p50", "wall_p95"):
+            before, now = base[metric], st[metric]
+            if now > before * (1 + tol) and now - before > min_delta:
+                regressions.append(f"{stage} {metric[5:]} {before * 1000:.1f} → {now * 1000:.1f} ms")
+    return regressions
+
+# ---------- Evaluación precisión vs. velocidad ----------
+# Con la verdad del corpus sintético se prueba una rejilla de configuraciones de OCR sobre
+# los documentos escaneados y se mide el acierto por campo y las páginas/segundo. La tabla
+# marca el frente de Pareto (nadie es más rápido y más preciso a la vez) para elegir la
+# configuración más barata que mantiene la precisión, en vez de fijar 600 dpi y --psm 6 a ojo.
+EVAL_GRID = {"dpi": (200, 300, 400, 600), "psm": (4, 6), "preprocess": (True, False),
+             "profile": ("estandar", "rapido"), "zone": ("pagina", "texto")}
+EVAL_FIELDS = ("Cliente", "Identificacion", "Contrato", "DirCliente", "NoSolicitud", "NoRefPago",
+               "TipoCupon", "ValidoHasta", "ValorAPagar", "GLNEmpresa")
+EVAL_ACCURACY_TOL = 0.01   # la recomendada puede perder hasta 1 punto frente a la más precisa
+ZONE_MARGIN = 0.03         # margen alrededor del texto en el recorte por zona (fracción del ancho)
+
+def text_zone(img, margin=ZONE_MARGIN):
+    """Recorta la página al rectángulo con tinta (más un margen); la deja igual si casi no hay tinta."""
+    ys, xs = _ink_coords(img)
+    if len(ys) < 500:
+        return img
+    f = max(1, img.width // ORIENT_WIDTH)
+    pad = int(img.width * margin)
+    # percentiles en vez de mín/máx: las motas sueltas del escáner no estiran el recorte
+    y0, y1 = np.percentile(ys, (0.5, 99.5)) * f
+    x0, x1 = np.percentile(xs, (0.5, 99.5)) * f
+    return img.crop((max(0, int(x0) - pad), max(0, int(y0) - pad),
+                     min(img.width, int(x1) + pad), min(img.height, int(y1) + pad)))
+
+def score_records(records, coupons, fields=EVAL_FIELDS):
+    """(aciertos por campo, cupones con todos los campos bien) comparando en orden con la verdad."""
+    hits = dict.fromkeys(fields, 0)
+    exact = 0
+    for k, truth in enumerate(coupons):
+        got = records[k] if k < len(records) else {}
+        ok = [f for f in fields if str(got.get(f) or "").strip().upper() == str(truth.get(f) or "").strip().upper()]
+        for f in ok:
+            hits[f] += 1
+        exact += len(ok) == len(fields)
+    return hits, exact
+
+def pareto_front(rows, speed="pages_per_sec", quality="campos"):
+    """Marca row['pareto'] en las filas que ninguna otra supera a la vez en velocidad y precisión."""
+    for r in rows:
+        r["pareto"] = not any(o[speed] >= r[speed] and o[quality] >= r[quality]
+                              and (o[speed] > r[speed] or o[quality] > r[quality]) for o in rows)
+    return rows
+
+def evaluate_ocr_grid(folder=BENCH_CORPUS_DIR, grid=None, logger=None, stop_event=None):
+    """
+    Corre cada combinación de grid (EVAL_GRID con los valores que se pasen reemplazados)
+    sobre los PDFs escaneados del corpus. Cada documento se renderiza una vez por dpi; ese
+    tiempo, el detector de blancos y la estimación de inclinación se suman a todas las
+    configuraciones de ese dpi. Devuelve un DataFrame ordenado por precisión, con el acierto
+    por campo, 'campos' (promedio), 'cupones' (cupones perfectos) y 'pareto'; también queda
+    en eval_grid.csv dentro de folder.
+    """
+    manifest = load_bench_manifest(folder, logger=logger)
+    grid = {**EVAL_GRID, **(grid or {})}
+    docs = [(name, e) for name, e in manifest["files"].items() if e["kind"] == "escaneo"]
+    names = list(grid)
+    configs = [dict(zip(names, values)) for values in itertools.product(*(grid[n] for n in names))]
+    profiles = {name: resolve_ocr_profile(name, logger=logger) for name in grid["profile"]}
+    stats = [{"seconds": 0.0, "pages": 0, "coupons": 0, "exact": 0, "hits": dict.fromkeys(EVAL_FIELDS, 0)}
+             for _ in configs]
+    if logger:
+        logger(f"🧪 Evaluando {len(configs)} configuraciones sobre {len(docs)} PDFs escaneados")
+    for dpi in grid["dpi"]:
+        for name, entry in docs:
+            if stop_event is not None and stop_event.is_set():
+                return None
+            t0 = time.perf_counter()
+            pages = render_pdf_pages(os.path.join(folder, name), dpi=dpi, grayscale=True, timeout=DOC_TIMEOUT_S)
+            inked = [(p, page) for p, page in enumerate(pages, 1) if not is_blank_page(page)]
+            angle = estimate_page_correction(inked[0][1]) if inked else 0.0
+            inked = [(p, apply_page_correction(page, angle)) for p, page in inked]
+            shared = time.perf_counter() - t0
+            for cfg, st in zip(configs, stats):
+                if cfg["dpi"] != dpi:
+                    continue
+                prof = profiles[cfg["profile"]]
+                config = re.sub(r"--psm \d+", f"--psm {cfg['psm']}", prof["config"])
+                t0 = time.perf_counter()
+                page_texts = {}
+                for p, img in inked:
+                    if cfg["zone"] == "texto":
+                        img = text_zone(img)
+                    if cfg["preprocess"]:
+                        img = image_preprocess(img)
+                    try:
+                        page_texts[p] = pytesseract.image_to_string(img, lang=prof["lang"], config=config,
+                                                                    timeout=OCR_TIMEOUT_S)
+                    except Exception as e:
+                        if logger:
+                            logger(f"OCR fallo en {name} p{p} ({cfg}): {e}")
+                records = extract_coupon_records(page_texts)
+                st["seconds"] += shared + time.perf_counter() - t0
+                st["pages"] += len(pages)
+                hits, exact = score_records(records, entry["coupons"])
+                st["coupons"] += len(entry["coupons"])
+                st["exact"] += exact
+                for f, n in hits.items():
+                    st["hits"][f] += n
+            del pages, inked
+        if logger:
+            logger(f"  {dpi} dpi listo")
+    rows = []
+    for cfg, st in zip(configs, stats):
+        row = dict(cfg)
+        row["pages_per_sec"] = round(st["pages"] / st["seconds"], 3) if st["seconds"] else 0.0
+        acc = {f: st["hits"][f] / st["coupons"] if st["coupons"] else 0.0 for f in EVAL_FIELDS}
+        row.update({f: round(v, 3) for f, v in acc.items()})
+        row["campos"] = round(sum(acc.values()) / len(acc), 3)
+        row["cupones"] = round(st["exact"] / st["coupons"], 3) if st["coupons"] else 0.0
+        rows.append(row)
+    df = pd.DataFrame(pareto_front(rows)).sort_values(["campos", "pages_per_sec"], ascending=False, ignore_index=True)
+    df.to_csv(os.path.join(folder, "eval_grid.csv"), index=False)
+    return df
+
+def recommend_config(df, tol=EVAL_ACCURACY_TOL):
+    """La configuración más rápida cuya precisión queda a menos de tol de la mejor."""
+    ok = df[df["campos"] >= df["campos"].max() - tol]
+    return ok.sort_values("pages_per_sec", ascending=False).iloc[0].to_dict()
+
+def parse_grid_args(args):
+    """'dpi=300,400 zone=texto preprocess=no' -> {'dpi': (300, 400), 'zone': ('texto',), 'preprocess': (False,)}."""
+    grid = {}
+    for arg in args:
+        key, _, values = arg.partition("=")
+        if key not in EVAL_GRID or not values:
+            continue
+        vals = []
+        for v in values.split(","):
+            if key in ("dpi", "psm"):
+                vals.append(int(v))
+            elif key == "preprocess":
+                vals.append(v.lower() in ("1", "si", "sí", "true", "on"))
+            else:
+                vals.append(v)
+        grid[key] = tuple(vals)
+    return grid
+
 # ---------- Folder browser utilities (Toplevel) ----------
 def get_roots():
     system = platform.system().lower()
@@ -766,7 +4513,7 @@ class OCRGui:
     def __init__(self, root):
         self.root = root
         root.title("Extractor de Datos PDF → Excel v0.1.0")
-        root.geometry("800x650")
+        root.geometry("800x780")
         root.configure(bg="#f8f9fa")
 
         # Variables
@@ -775,6 +4522,28 @@ class OCRGui:
         self.dpi = IntVar(value=DEFAULT_DPI)
         self.lang = StringVar(value=DEFAULT_LANG)
         self.tesseract_cmd = StringVar(value="")
+        self.workers = IntVar(value=DEFAULT_WORKERS)
+        self.memory_budget_mb = IntVar(value=DEFAULT_MEMORY_BUDGET_MB)
+        self.ocr_profile = StringVar(value=DEFAULT_OCR_PROFILE)
+        self.ocr_profile_note = StringVar(value="")   # respaldo del perfil (ver resolve_ocr_profile)
+        self.auto_tune = BooleanVar(value=False)   # workers x hilos de tesseract según el perfil del equipo
+        self.split_pages = BooleanVar(value=False)   # PDFs con un cupón por página: un registro por cupón
+        self.recursive = BooleanVar(value=False)   # incluir subcarpetas (el lote arranca mientras se recorren)
+        self.include_patterns = StringVar(value=";".join(DEFAULT_INCLUDE))
+        self.exclude_patterns = StringVar(value="")
+        self.modified_after = StringVar(value="")   # AAAA-MM-DD, vacío = sin filtro
+        self.jobs = JobQueue()   # trabajos carpeta -> Excel en espera (ver create_queue_section)
+        self.job_priority = StringVar(value="normal")
+        self.parallel_jobs = IntVar(value=1)   # trabajos intercalados sobre el mismo pool
+        self.profile_stages = BooleanVar(value=False)   # tiempos por etapa + línea de tiempo junto al Excel
+        self.results_db = BooleanVar(value=False)   # upsert en <salida>.db y Excel regenerado sin duplicados
+        self.barcode_only = BooleanVar(value=False)   # si el código GS1 se lee, sin OCR de página (solo sus campos)
+        self.save_ocr_text = BooleanVar(value=False)   # texto OCR al archivo comprimido con búsqueda (OcrTextArchive)
+        self.ocr_text_dir = StringVar(value="")   # vacío = carpeta <salida>_ocr junto al Excel
+        self.expose_metrics = BooleanVar(value=False)   # endpoint Prometheus + JSON lines mientras se procesa
+        self.metrics = BatchMetrics()
+        self._stop_metrics = None
+        self.save_lock = threading.Lock()   # dos trabajos pueden escribir el mismo Excel
         self.is_processing = False
 
         # Queues and thread control
@@ -824,6 +4593,17 @@ class OCRGui:
         input_btn = ttk.Button(input_frame, text="🗂️ Examinar Carpeta", command=self.select_input_folder, style='Primary.TButton')
         input_btn.pack(anchor="w")
 
+        # Filtros de búsqueda (patrones separados por ';', fecha AAAA-MM-DD)
+        filter_frame = ttk.Frame(input_frame)
+        filter_frame.pack(fill=tk.X, pady=(5, 0))
+        ttk.Checkbutton(filter_frame, text="Incluir subcarpetas", variable=self.recursive).pack(side=tk.LEFT)
+        ttk.Label(filter_frame, text="Incluir:", font=('Helvetica', 9)).pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Entry(filter_frame, textvariable=self.include_patterns, width=12).pack(side=tk.LEFT, padx=(3, 0))
+        ttk.Label(filter_frame, text="Excluir:", font=('Helvetica', 9)).pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Entry(filter_frame, textvariable=self.exclude_patterns, width=12).pack(side=tk.LEFT, padx=(3, 0))
+        ttk.Label(filter_frame, text="Modificados desde:", font=('Helvetica', 9)).pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Entry(filter_frame, textvariable=self.modified_after, width=11).pack(side=tk.LEFT, padx=(3, 0))
+
     def create_output_section(self, parent):
         output_frame = ttk.LabelFrame(parent, text="💾 Paso 2: Guardar Archivo Excel", padding="10")
         output_frame.pack(fill=tk.X, pady=(0, 10))
@@ -833,23 +4613,68 @@ class OCRGui:
 
         output_btn = ttk.Button(output_frame, text="💾 Guardar Como...", command=self.select_output_file, style='Primary.TButton')
         output_btn.pack(anchor="w")
+        ttk.Checkbutton(output_frame, text="🗄️ Guardar también en base de datos (sin duplicados; el Excel se regenera desde ella)",
+                        variable=self.results_db).pack(anchor="w", pady=(5, 0))
+        ocr_text_frame = ttk.Frame(output_frame)
+        ocr_text_frame.pack(fill=tk.X, pady=(5, 0))
+        ttk.Checkbutton(ocr_text_frame, text="📝 Archivar el texto OCR (se busca con --ocr-search) en:",
+                        variable=self.save_ocr_text).pack(side=tk.LEFT)
+        ttk.Entry(ocr_text_frame, textvariable=self.ocr_text_dir, width=30).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Button(ocr_text_frame, text="📁", width=3, command=self.select_ocr_text_dir).pack(side=tk.LEFT, padx=(3, 0))
 
     def create_control_section(self, parent):
         control_frame = ttk.LabelFrame(parent, text="🚀 Paso 3: Procesar Archivos", padding="10")
         control_frame.pack(fill=tk.X, pady=(0, 10))
 
+        # Perfil OCR (modelos rápidos/precisos, idiomas, motor)
+        profile_frame = ttk.Frame(control_frame)
+        profile_frame.pack(fill=tk.X, pady=(0, 10))
+        ttk.Label(profile_frame, text="🔤 Perfil OCR:", font=('Helvetica', 9)).pack(side=tk.LEFT)
+        ttk.Combobox(profile_frame, textvariable=self.ocr_profile, values=list(OCR_PROFILES),
+                     state="readonly", width=12).pack(side=tk.LEFT, padx=(5, 0))
+        # respaldo del perfil elegido en este equipo (modelos o motor que no están)
+        ttk.Label(profile_frame, textvariable=self.ocr_profile_note, foreground="#b36b00",
+                  font=('Helvetica', 8)).pack(side=tk.LEFT, padx=(5, 0))
+        self.ocr_profile.trace_add("write", lambda *_: self._update_profile_note())
+        self._update_profile_note()
+        ttk.Checkbutton(profile_frame, text="📑 Un registro por página/cupón",
+                        variable=self.split_pages).pack(side=tk.LEFT, padx=(15, 0))
+        ttk.Checkbutton(profile_frame, text="⏱️ Perfilar etapas",
+                        variable=self.profile_stages).pack(side=tk.LEFT, padx=(15, 0))
+        ttk.Checkbutton(profile_frame, text="⚡ Solo código de barras",
+                        variable=self.barcode_only).pack(side=tk.LEFT, padx=(15, 0))
+
+        # Paralelismo: workers a mano, o medidos en el equipo (nunca más que el tope del selector)
+        workers_frame = ttk.Frame(control_frame)
+        workers_frame.pack(fill=tk.X, pady=(0, 10))
+        ttk.Label(workers_frame, text="⚙️ Workers:", font=('Helvetica', 9)).pack(side=tk.LEFT)
+        ttk.Spinbox(workers_frame, from_=1, to=MAX_WORKERS, textvariable=self.workers,
+                    width=3).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Checkbutton(workers_frame, text="Ajustar según el equipo (medición de OCR)",
+                        variable=self.auto_tune).pack(side=tk.LEFT, padx=(15, 0))
+
         # Botón de inicio
         self.start_button = ttk.Button(control_frame, text="▶️ Iniciar Extracción",
                                     command=self.start_processing,
                                     style='Success.TButton')
         self.start_button.pack(fill=tk.X, pady=(0, 10))
 
+        # Botón de cancelar (corta también el PDF en curso: mata poppler/tesseract)
+        self.cancel_button = ttk.Button(control_frame, text="⏹️ Cancelar",
+                                        command=self.cancel_processing,
+                                        style='Error.TButton', state="disabled")
+        self.cancel_button.pack(fill=tk.X, pady=(0, 10))
+
         # Barra de progreso
         self.progress_var = tk.DoubleVar()
         self.progress_bar = ttk.Progressbar(control_frame, variable=self.progress_var,
                                             maximum=100)
         self.progress_bar.pack(fill=tk.X, pady=(0, 10))
 
+        # Tiempo estimado (del triage previo)
+        self.eta_label = ttk.Label(control_frame, text="", foreground="gray", font=('Helvetica', 9))
+        self.eta_label.pack(anchor="w", pady=(0, 10))
+
         # Frame para botones secundarios
         button_frame = ttk.Frame(control_frame)
         button_frame.pack(fill=tk.X)
@@ -875,6 +4700,91 @@ class OCRGui:
         about_btn.pack(side=tk.LEFT)
         
 
+    def create_queue_section(self, parent):
+        queue_frame = ttk.LabelFrame(parent, text="🗂️ Cola de trabajos", padding="10")
+        queue_frame.pack(fill=tk.X, pady=(0, 10))
+
+        self.jobs_tree = ttk.Treeview(queue_frame, columns=("carpeta", "salida", "prioridad", "estado"),
+                                      show="headings", height=3)
+        for col, text, width in (("carpeta", "Carpeta", 240), ("salida", "Excel", 200),
+                                 ("prioridad", "Prioridad", 80), ("estado", "Estado", 90)):
+            self.jobs_tree.heading(col, text=text)
+            self.jobs_tree.column(col, width=width, anchor="w")
+        self.jobs_tree.pack(fill=tk.X, pady=(0, 5))
+
+        # Agrega la carpeta, el Excel y la configuración actuales como un trabajo
+        buttons = ttk.Frame(queue_frame)
+        buttons.pack(fill=tk.X)
+        ttk.Button(buttons, text="➕ Agregar a la cola", command=self.add_job).pack(side=tk.LEFT)
+        ttk.Combobox(buttons, textvariable=self.job_priority, values=list(JOB_PRIORITIES),
+                     state="readonly", width=8).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Button(buttons, text="🗑️ Quitar", command=self.remove_job).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Label(buttons, text="Simultáneos:", font=('Helvetica', 9)).pack(side=tk.LEFT, padx=(15, 0))
+        ttk.Spinbox(buttons, from_=1, to=4, textvariable=self.parallel_jobs, width=3).pack(side=tk.LEFT, padx=(5, 0))
+        self.queue_button = ttk.Button(buttons, text="⏭️ Ejecutar cola", command=self.run_queue,
+                                       style='Success.TButton')
+        self.queue_button.pack(side=tk.RIGHT)
+        ttk.Checkbutton(buttons, text="📈 Métricas", variable=self.expose_metrics).pack(side=tk.RIGHT, padx=(0, 10))
+
+    def add_job(self):
+        if not self.input_folder.get().strip() or not self.output_file.get().strip():
+            messagebox.showwarning("⚠️ Campos incompletos", "Por favor selecciona:\n• Carpeta con PDFs\n• Archivo Excel de salida")
+            return
+        job = self.job_settings()
+        if job is None:
+            return
+        self.jobs.add(job, priority=self.job_priority.get())
+        self.log_message(f"➕ En cola: {os.path.basename(job['folder'])} → {os.path.basename(job['output'])} "
+                         f"(prioridad {job['priority']})", "info")
+        self._refresh_jobs()
+
+    def remove_job(self):
+        for iid in self.jobs_tree.selection():
+            if not self.jobs.remove(int(iid)):
+                self.log_message("⚠️ Solo se pueden quitar trabajos que no empezaron", "warning")
+        self._refresh_jobs()
+
+    def _refresh_jobs(self):
+        self.jobs_tree.delete(*self.jobs_tree.get_children())
+        for job in list(self.jobs.jobs):
+            self.jobs_tree.insert("", tk.END, iid=str(job["id"]), values=(
+                job["folder"], os.path.basename(job["output"]), job["priority"], job["state"]))
+
+    def run_queue(self):
+        if self.is_processing:
+            return
+        if not self.jobs.pending():
+            messagebox.showinfo("🗂️ Cola vacía", "Agrega trabajos con '➕ Agregar a la cola'")
+            return
+        self.is_processing = True
+        self.stop_event.clear()
+        self.start_button.config(state="disabled")
+        self.queue_button.config(state="disabled")
+        self.cancel_button.config(state="normal")
+        self.progress_var.set(0)
+        parallel = max(1, int(self.parallel_jobs.get()))
+        self._start_metrics()
+        self.log_message(f"⏭️ Ejecutando cola: {len(self.jobs.pending())} trabajos, {parallel} a la vez", "info")
+        threading.Thread(target=self._run_queue_worker, args=(parallel,), daemon=True).start()
+
+    def _run_queue_worker(self, parallel):
+        # un solo pool de procesos para todos los trabajos: no se recrea entre carpetas
+        warm = WarmPool(max([j["workers"] for j in self.jobs.pending()] or [DEFAULT_WORKERS]))
+        try:
+            self.jobs.run(lambda job, share: self.process_files(job, warm_pool=warm, share=share),
+                          parallel=parallel, stop_event=self.stop_event,
+                          on_change=lambda: self.root.after(0, self._refresh_jobs))
+        finally:
+            warm.shutdown()
+            self.root.after(0, self._queue_finished)
+
+    def _queue_finished(self):
+        self._refresh_jobs()
+        self.queue_button.config(state="normal")
+        self._reset_ui()
+        pending = len(self.jobs.pending())
+        self.log_message("✅ Cola terminada" + (f" ({pending} trabajos sin empezar)" if pending else ""), "success")
+
     def create_log_section(self, parent):
         log_frame = ttk.LabelFrame(parent, text="📋 Registro de Actividad", padding="10")
         log_frame.pack(fill=tk.BOTH, expand=True, pady=(0, 10))
@@ -902,8 +4812,21 @@ class OCRGui:
         if folder:
             self.input_folder.set(folder)
             folder_name = os.path.basename(folder)
-            pdf_count = len([f for f in os.listdir(folder) if f.lower().endswith('.pdf')])
-            self.input_label.config(text=f"📁 {folder_name} ({pdf_count} PDFs)", foreground="black")
+            if self.recursive.get():
+                # no se recorre aquí: en un archivo grande tardaría; se cuenta mientras se procesa
+                self.input_label.config(text=f"📁 {folder_name} (con subcarpetas)", foreground="black")
+            else:
+                try:
+                    options = self.discovery_options()
+                except ValueError:
+                    # se avisa y la carpeta queda elegida; el conteo se ve al corregir la fecha
+                    messagebox.showwarning("⚠️ Fecha inválida", "La fecha de modificación debe tener el formato AAAA-MM-DD")
+                    options = None
+                if options is None:
+                    self.input_label.config(text=f"📁 {folder_name}", foreground="black")
+                else:
+                    pdf_count = sum(1 for _ in iter_input_files(folder, expand_zips=False, **options))
+                    self.input_label.config(text=f"📁 {folder_name} ({pdf_count} archivos)", foreground="black")
             self.log_message(f"📁 Carpeta seleccionada: {folder_name}", "success")
             self.check_ready_to_process()
 
@@ -921,6 +4844,15 @@ class OCRGui:
             self.check_ready_to_process()
 
 
+    def discovery_options(self):
+        """Filtros de iter_input_files tomados de la sección de entrada (ValueError si la fecha no es válida)."""
+        split = lambda v: tuple(p.strip() for p in v.split(";") if p.strip())
+        since = self.modified_after.get().strip()
+        return {"include": split(self.include_patterns.get()) or DEFAULT_INCLUDE,
+                "exclude": split(self.exclude_patterns.get()),
+                "recursive": self.recursive.get(),
+                "modified_after": datetime.strptime(since, "%Y-%m-%d") if since else None}
+
     def check_ready_to_process(self):
         if self.input_folder and self.output_file:
             self.log_message("✅ ¡Listo para procesar! Haz clic en 'Iniciar Extracción'", "success")
@@ -931,7 +4863,7 @@ class OCRGui:
             self.tesseract_cmd.set(f)
 
     def select_ocr_text_dir(self):
-        d = filedialog.askdirectory(title="📁 Seleccionar carpeta para guardar archivos OCR (.txt)")
+        d = filedialog.askdirectory(title="📁 Seleccionar carpeta del archivo de texto OCR")
         if d:
             self.ocr_text_dir.set(d)
 
@@ -945,104 +4877,244 @@ class OCRGui:
 
         if self.is_processing:
             return
+        job = self.job_settings()
+        if job is None:
+            return
 
         self.is_processing = True
+        self.stop_event.clear()
         self.start_button.config(text="⏳ Procesando...", state="disabled")
+        self.cancel_button.config(state="normal")
         self.progress_var.set(0)
 
         self.clear_log()
         self.log_message("🚀 Iniciando procesamiento...", "info")
         self.log_message(f"📂 Carpeta: {os.path.basename(input_folder)}", "info")
         self.log_message(f"📄 Archivo: {os.path.basename(output_file)}", "info")
+        self._start_metrics()
 
-        thread = threading.Thread(target=self.process_files, daemon=True)
+        thread = threading.Thread(target=self.process_files, args=(job,), daemon=True)
         thread.start()
 
-    def process_files(self):
+    def job_settings(self):
+        """Configuración actual de la ventana como trabajo (None si la fecha del filtro no es válida)."""
         try:
-            input_folder = self.input_folder.get().strip()
-            output_file = self.output_file.get().strip()
-            pdf_files = [os.path.join(input_folder, f) for f in os.listdir(input_folder) if f.lower().endswith('.pdf')]
-            if not pdf_files:
-                self.root.after(0, lambda: self.log_message("⚠️ No se encontraron archivos PDF", "warning"))
-                self.root.after(0, lambda: self._reset_ui())
-                return
-
-            total_files = len(pdf_files)
-            self.root.after(0, lambda: self.log_message(f"📄 Se encontraron {total_files} archivos PDF", "info"))
-
-            processed_count = 0
-            data_list = []
-            errors_count = 0
+            discovery = self.discovery_options()
+        except ValueError:
+            messagebox.showwarning("⚠️ Fecha inválida", "La fecha de modificación debe tener el formato AAAA-MM-DD")
+            return None
+        lang = self.lang.get().strip()
+        return {"folder": self.input_folder.get().strip(), "output": self.output_file.get().strip(),
+                "dpi": int(self.dpi.get()),
+                # el idioma escrito a mano solo reemplaza al del perfil si se cambió
+                "lang": lang if lang != DEFAULT_LANG else None,
+                "ocr_profile": self.ocr_profile.get(), "workers": max(1, int(self.workers.get())),
+                "auto_tune": self.auto_tune.get(), "split_pages": self.split_pages.get(),
+                "memory_budget_mb": int(self.memory_budget_mb.get()), "discovery": discovery,
+                "profile_stages": self.profile_stages.get(), "results_db": self.results_db.get(),
+                "barcode_only": self.barcode_only.get(), "save_ocr_text": self.save_ocr_text.get(),
+                "ocr_text_dir": self.ocr_text_dir.get().strip()}
+
+    def _update_profile_note(self):
+        """Muestra junto al selector el respaldo que usará el perfil OCR elegido en este equipo."""
+        fallback = resolve_ocr_profile(self.ocr_profile.get())["fallback"]
+        self.ocr_profile_note.set(f"⚠️ {fallback}" if fallback else "")
+
+    def process_files(self, job, warm_pool=None, share=1.0):
+        """
+        Procesa un trabajo (ver job_settings). Desde la cola (warm_pool) usa el pool compartido,
+        la fracción 'share' de workers y memoria, guarda sin diálogos y devuelve el estado final.
+        """
+        queued = warm_pool is not None
+        reset_ui = (lambda: None) if queued else self._reset_ui
+        try:
+            input_folder = job["folder"]
+            output_file = job["output"]
+            options = job["discovery"]
+            profiler = StageProfiler() if job.get("profile_stages") else None
+            stream = options["recursive"]
+            pdf_files = iter_input_files(input_folder, stop_event=self.stop_event,
+                                         logger=lambda msg: self.log_queue.put((msg, "warning")), **options)
+            if stream:
+                # con subcarpetas no se lista todo antes: los primeros archivos ya se procesan
+                self.log_queue.put(("🔎 Recorriendo subcarpetas mientras se procesa...", "info"))
+            else:
+                pdf_files = list(pdf_files)
+                if not pdf_files:
+                    self.root.after(0, lambda: self.log_message("⚠️ No se encontraron archivos PDF", "warning"))
+                    self.root.after(0, reset_ui)
+                    return "listo"
+                self.log_queue.put((f"📄 Se encontraron {len(pdf_files)} archivos PDF", "info"))
+
+            # Triage previo: páginas, capa de texto, archivos corruptos y tiempo estimado
+            # (los mensajes y el avance viajan por log_queue/progress_queue, ver _poll_queues)
+            # En streaming el triage ocurre dentro de run_batch y el plan se va llenando.
+            dpi = job["dpi"]
+            plan = build_work_plan(pdf_files, dpi, stop_event=self.stop_event, stream=stream, profiler=profiler,
+                                   logger=lambda msg: self.log_queue.put((msg, "warning")))
+            profile = resolve_ocr_profile(job["ocr_profile"], lang=job["lang"],
+                                          logger=lambda msg: self.log_queue.put((msg, "warning")))
+            self.log_queue.put((f"🔤 Perfil OCR: {profile['name']} ({profile['lang']}, {profile['config']})", "info"))
+            workers, ocr_threads = job["workers"], DEFAULT_OCR_THREADS
+            if job["auto_tune"]:
+                workers, ocr_threads = resolve_ocr_parallelism(
+                    plan, dpi, profile=profile, stop_event=self.stop_event,
+                    logger=lambda msg: self.log_queue.put((msg, "info")))
+                workers = min(workers, MAX_WORKERS)
+            # trabajos intercalados: cada uno con su parte del equipo
+            workers = max(1, int(workers * share))
+            self.log_queue.put((f"⚙️ OCR: {workers} workers x {ocr_threads} hilos", "info"))
+            if not stream:
+                self.log_queue.put((describe_plan(plan, workers), "info"))
+                self.progress_queue.put(("eta", plan["eta"] / workers))
+
+            quarantined_start = len(plan["quarantined"])
+            processed_count = quarantined_start
+            data_list = RecordColumns()
+            errors_count = quarantined_start
             scan_count = 0
+            remaining_eta = plan["eta"]
 
             def progress_callback(filename, text):
                 nonlocal processed_count, errors_count, scan_count
                 processed_count += 1
-                progress = (processed_count / total_files) * 100
+                self.log_queue.put((f"📖 ({processed_count}/{plan['files']}) Procesando: {filename}", "info"))
 
                 # Extract data in the worker thread
                 if text and text != "SCAN":
                     try:
-                        data = extract_fields_from_text(text)
-                        data["_file"] = filename
-                        data_list.append(data)
-                        # Schedule GUI update for success
-                        self.root.after(0, lambda: self._update_progress(filename, text, progress, processed_count, total_files))
+                        parse_log = lambda msg: self.log_queue.put((f"   {msg} ({filename})", "warning"))
+                        if page_texts_used is not None:
+                            # modo por página: un registro por cupón
+                            records = extract_coupon_records(page_texts_used, logger=parse_log)
+                            if not records:
+                                raise ValueError(NO_COUPONS_ERROR)
+                        else:
+                            records = [extract_fields_timed(text, logger=parse_log)[0]]
+                        for data in records:
+                            data["_file"] = filename
+                            data["PerfilOCR"] = profile_used
+                            data["PaginasEnBlanco"] = blank_used
+                            if hash_used:
+                                data["_hash"] = hash_used
+                        data_list.extend(records)
+                        self.log_queue.put((f"   ✅ Datos extraídos ({len(records)} cupones)"
+                                            if page_texts_used is not None else "   ✅ Datos extraídos", "success"))
                     except Exception as e:
                         errors_count += 1
-                        self.root.after(0, lambda fn=filename, p=progress, pc=processed_count, tf=total_files:
-                                      self._update_progress_error(fn, str(e), p, pc, tf))
+                        data_list.append({"_file": filename, "error": str(e)})
+                        self.log_queue.put((f"   ❌ Error: {e}", "error"))
                 elif text == "SCAN":
                     scan_count += 1
-                    # Schedule GUI update for scan
-                    self.root.after(0, lambda fn=filename, p=progress, pc=processed_count, tf=total_files:
-                                  self._update_progress_scan(fn, p, pc, tf))
+                    self.log_queue.put(("   📄 Archivo es un scan - procesando con OCR", "warning"))
                 else:
                     errors_count += 1
-                    # Schedule GUI update for empty text
-                    self.root.after(0, lambda fn=filename, p=progress, pc=processed_count, tf=total_files:
-                                  self._update_progress(fn, None, p, pc, tf))
-
-            # Process PDFs sequentially
-            for pdf in pdf_files:
-                if self.stop_event.is_set():
-                    self.root.after(0, lambda: self.log_message("Proceso cancelado por el usuario.", "warning"))
-                    break
-                try:
-                    text = extract_text_from_pdf(pdf, dpi=int(self.dpi.get()), lang=self.lang.get().strip() or DEFAULT_LANG,
-                                               save_ocr_text=False, ocr_text_dir=None)
-                    progress_callback(os.path.basename(pdf), text)
-                except Exception as e:
-                    progress_callback(os.path.basename(pdf), None)
+                    self.log_queue.put(("   ❌ Error extrayendo texto", "error"))
+                self.progress_queue.put(("progress", processed_count, plan["files"]))
+
+            profile_used = ""
+            blank_used = 0
+            blank_total = 0
+            page_texts_used = None
+            hash_used = None
+
+            def on_document(item, text, error):
+                nonlocal remaining_eta, profile_used, blank_used, blank_total, page_texts_used, hash_used
+                profile_used = "" if item["has_text"] else profile["key"]
+                if job.get("results_db") and error is None:
+                    hash_used = item.get("hash")
+                page_texts_used = item.get("page_texts")
+                blank_used = item.get("blank_pages", 0)
+                blank_total += blank_used
+                progress_callback(result_file_name(item["path"], input_folder), text if error is None else None)
+                remaining_eta -= item["eta"]
+                if not stream:
+                    self.progress_queue.put(("eta", remaining_eta / workers))
+
+            # texto OCR archivado junto al Excel salvo que se elija otra carpeta
+            ocr_text_dir = job.get("ocr_text_dir") or os.path.splitext(output_file)[0] + "_ocr"
+            if job.get("save_ocr_text"):
+                self.log_queue.put((f"📝 Texto OCR archivado en {ocr_text_dir}", "info"))
+
+            # Process PDFs en el pipeline por etapas, tareas más costosas primero (ver run_batch)
+            run_batch(plan, on_document, workers=workers, dpi=dpi, ocr_threads=ocr_threads,
+                      save_ocr_text=job.get("save_ocr_text", False), ocr_text_dir=ocr_text_dir,
+                      lang=profile["lang"], tesseract_config=profile["config"], stop_event=self.stop_event,
+                      split_pages=job["split_pages"], warm_pool=warm_pool, pool_share=share, profiler=profiler,
+                      skip_ocr_on_barcode=job.get("barcode_only", False), hash_content=job.get("results_db", False),
+                      metrics=self.metrics if self._stop_metrics is not None else None,
+                      memory_budget_mb=max(1, int(job["memory_budget_mb"] * share)),
+                      logger=lambda msg: self.log_queue.put((msg, "info")))
+            if blank_total:
+                self.log_queue.put((f"📄 Páginas en blanco omitidas (sin OCR): {blank_total}", "info"))
+            if self.stop_event.is_set():
+                self.log_queue.put(("Proceso cancelado por el usuario.", "warning"))
+            elif not plan["files"]:
+                self.root.after(0, lambda: self.log_message("⚠️ No se encontraron archivos PDF", "warning"))
+                self.root.after(0, reset_ui)
+                return "listo"
+            # en streaming la cuarentena se llena durante el lote
+            errors_count += len(plan["quarantined"]) - quarantined_start
+            data_list.prepend({"_file": result_file_name(q["path"], input_folder), "error": f"cuarentena: {q['error']}"}
+                              for q in plan["quarantined"])
+            total_files = plan["files"]
+
+            if queued:
+                # desde la cola: se guarda sin diálogos y sigue el próximo trabajo
+                if data_list:
+                    self._save_results(data_list, output_file, job.get("results_db"), profiler)
+                self._report_profile(profiler, output_file)
+                self.log_queue.put((f"🎉 {os.path.basename(input_folder)} → {os.path.basename(output_file)}: "
+                                    f"{len(data_list)} registros, {errors_count} con errores", "success"))
+                return "cancelado" if self.stop_event.is_set() else "listo"
 
             # Schedule final UI updates on main thread
-            self.root.after(0, lambda: self._finalize_processing(data_list, errors_count, scan_count, total_files, output_file))
+            self.root.after(0, lambda: self._finalize_processing(data_list, errors_count, scan_count, total_files,
+                                                                 output_file, profiler, job.get("results_db")))
+            return "listo"
 
         except Exception as e:
             self.root.after(0, lambda: self.log_message(f"❌ Error crítico: {str(e)}", "error"))
+            if queued:
+                return "error"
             self.root.after(0, lambda: messagebox.showerror("❌ Error", f"Error durante el procesamiento:\n\n{str(e)}"))
             self.root.after(0, lambda: self._reset_ui())
 
-    def _finalize_processing(self, data_list, errors_count, scan_count, total_files, output_file):
+    def _report_profile(self, profiler, output_file):
+        """Tabla de tiempos por etapa al log y archivos de perfil junto al Excel (si se perfiló)."""
+        if profiler is None:
+            return
+        try:
+            table, trace = write_profile_report(profiler, output_file)
+        except OSError as e:
+            self.log_queue.put((f"⚠️ No se pudo guardar el perfil: {e}", "warning"))
+            return
+        self.log_queue.put((f"⏱️ Tiempos por archivo y etapa ({os.path.basename(output_file)}):", "info"))
+        for line in table.splitlines():
+            self.log_queue.put((line, "info"))
+        self.log_queue.put((f"🧵 Línea de tiempo (chrome://tracing, ui.perfetto.dev): {trace}", "info"))
+
+    def _save_results(self, data_list, output_file, results_db=False, profiler=None):
+        """Agrega al Excel, o upsert en <salida>.db y Excel regenerado (ver store_results). True si había datos previos."""
+        with self.save_lock, (profiler or NULL_PROFILER).span("excel", output_file):
+            if not results_db:
+                return append_results_excel(data_list, output_file)
+            inserted, replaced, total = store_results(data_list, output_file)
+        self.log_queue.put((f"🗄️ Base de datos: {inserted} nuevos, {replaced} reemplazados (duplicados), "
+                            f"{total} registros en el Excel", "info"))
+        return total > inserted
+
+    def _finalize_processing(self, data_list, errors_count, scan_count, total_files, output_file, profiler=None,
+                             results_db=False):
         """Finalize processing and update UI on main thread."""
         try:
             if data_list:
                 # Save Excel
-                df = pd.DataFrame(data_list)
-                cols_order = ["_file", "Cliente", "Contrato", "Identificacion", "NoSolicitud",
-                              "TipoCupon", "ValorAPagar", "NoRefPago", "DirCliente", "ValidoHasta",
-                              "CodigoBarraRaw", "CodigoBarraLimpio", "error"]
-                cols = [c for c in cols_order if c in df.columns] + [c for c in df.columns if c not in cols_order]
-                df = df[cols]
-
-                if os.path.exists(output_file):
-                    existing_df = pd.read_excel(output_file)
-                    combined_df = pd.concat([existing_df, df], ignore_index=True)
-                    combined_df.to_excel(output_file, index=False)
+                appended = self._save_results(data_list, output_file, results_db, profiler)
+                self._report_profile(profiler, output_file)
+                if appended:
                     self.log_message(f"🎉 ¡Datos agregados exitosamente!", "success")
                 else:
-                    df.to_excel(output_file, index=False)
                     self.log_message(f"🎉 ¡Proceso completado exitosamente!", "success")
 
                 self.log_message(f"📊 Total de registros procesados: {len(data_list)}", "success")
@@ -1077,35 +5149,24 @@ class OCRGui:
         finally:
             self._reset_ui()
 
+    def _start_metrics(self):
+        if self.expose_metrics.get() and self._stop_metrics is None:
+            self._stop_metrics = start_metrics(self.metrics, logger=lambda msg: self.log_queue.put((msg, "info")))
+
     def _reset_ui(self):
         """Reset UI elements after processing."""
+        if self._stop_metrics is not None:
+            self._stop_metrics()
+            self._stop_metrics = None
         self.is_processing = False
         self.start_button.config(text="▶️ Iniciar Extracción", state="normal")
+        self.cancel_button.config(state="disabled")
         self.progress_var.set(0)
+        self.eta_label.config(text="")
 
-    def _update_progress_error(self, filename, error, progress, processed_count, total_files):
-        """Update progress bar and log for errors."""
-        self.progress_var.set(progress)
-        self.log_message(f"📖 ({processed_count}/{total_files}) Procesando: {filename}", "info")
-        self.log_message(f"   ❌ Error: {error}", "error")
-        self.root.update_idletasks()
-
-    def _update_progress_scan(self, filename, progress, processed_count, total_files):
-        """Update progress bar and log for scans."""
-        self.progress_var.set(progress)
-        self.log_message(f"📖 ({processed_count}/{total_files}) Procesando: {filename}", "info")
-        self.log_message("   📄 Archivo es un scan - procesando con OCR", "warning")
-        self.root.update_idletasks()
-
-    def _update_progress(self, filename, text, progress, processed_count, total_files):
-        """Update progress bar and log from main thread."""
-        self.progress_var.set(progress)
-        self.log_message(f"📖 ({processed_count}/{total_files}) Procesando: {filename}", "info")
-        if text:
-            self.log_message("   ✅ Datos extraídos", "success")
-        else:
-            self.log_message("   ❌ Error extrayendo texto", "error")
-        self.root.update_idletasks()
+    def _update_eta(self, seconds):
+        """Muestra el tiempo restante estimado según el plan de trabajo."""
+        self.eta_label.config(text=f"⏱️ Tiempo restante estimado: {format_duration(max(0, seconds))}")
 
     def open_output_folder(self):
         try:
@@ -1163,7 +5224,7 @@ class OCRGui:
         messagebox.showinfo("❓ Ayuda", help_text)
 
     def select_ocr_text_dir(self):
-        d = filedialog.askdirectory(title="📁 Seleccionar carpeta para guardar archivos OCR (.txt)")
+        d = filedialog.askdirectory(title="📁 Seleccionar carpeta del archivo de texto OCR")
         if d:
             self.ocr_text_dir.set(d)
 
@@ -1192,6 +5253,7 @@ class OCRGui:
     def cancel_processing(self):
         if messagebox.askyesno("Confirmar", "¿Deseas cancelar el proceso en curso?"):
             self.stop_event.set()
+            self.cancel_button.config(state="disabled")
             self.log_message("Cancelando... por favor espera.", "warning")
 
     def show_completion_dialog(self):
@@ -1247,8 +5309,8 @@ class OCRGui:
         try:
             while True:
                 item = self.log_queue.get_nowait()
-                self.logbox.insert("end", item + "\n")
-                self.logbox.see("end")
+                message, tipo = item if isinstance(item, tuple) else (item, "info")
+                self.log_message(message, tipo)
         except queue.Empty:
             pass
 
@@ -1257,17 +5319,11 @@ class OCRGui:
                 evt = self.progress_queue.get_nowait()
                 if evt[0] == "progress":
                     idx, total = evt[1], evt[2]
-                    pct = int((idx/total)*100) if total else 0
-                    self.progress['maximum'] = total
-                    self.progress['value'] = idx
+                    self.progress_var.set((idx / total) * 100 if total else 0)
+                elif evt[0] == "eta":
+                    self._update_eta(evt[1])
                 elif evt[0] == "done":
-                    self.progress['value'] = evt[1]
-                    self.start_btn.config(state="normal")
-                    self.cancel_btn.config(state="disabled")
-                    self.logbox.insert("end", "Proceso terminado.\n")
-                    self.logbox.see("end")
-                    # Show post-processing dialog
-                    self.show_completion_dialog()
+                    self.progress_var.set(100 if evt[2] else 0)
         except queue.Empty:
             pass
 
@@ -1284,6 +5340,7 @@ class OCRGui:
         self.create_input_section(main_frame)
         self.create_output_section(main_frame)
         self.create_control_section(main_frame)
+        self.create_queue_section(main_frame)
         self.create_log_section(main_frame)
         self.create_footer(main_frame)
 
@@ -1580,12 +5637,7 @@ def open_save_browser(parent, title="Guardar archivo", start_path=None, suggeste
 # ------------------------------------------------------------------
 #  Mini-GitHub updater  (public domain)
 # ------------------------------------------------------------------
-import shutil
 from pathlib import Path
-import zipfile
-import tempfile
-import subprocess
-import sys
 
 class GitHubUpdater:
     """
@@ -1676,9 +5728,148 @@ class GitHubUpdater:
 
 # ---------- Main ----------
 def main():
+    if "--bench-parser" in sys.argv:
+        # Benchmark de peor caso del parser (sin GUI)
+        for name, size, elapsed, ok in benchmark_parser_worst_case():
+            print(f"{name:<16} {size:>8} chars  {elapsed*1000:8.1f} ms  {'OK' if ok else 'EXCEDE PRESUPUESTO'}")
+        return
+    if "--bench-records" in sys.argv:
+        # Memoria de acumular registros: lista de dicts vs. RecordColumns
+        # uso: --bench-records [registros]
+        i = sys.argv.index("--bench-records")
+        n = int(sys.argv[i + 1]) if len(sys.argv) > i + 1 else 200_000
+        for name, (held, peak) in benchmark_record_memory(n).items():
+            print(f"{name:<16} {n:>9} registros  {held:8.1f} MB acumulados  {peak:8.1f} MB pico con DataFrame")
+        return
+    if "--bench-corpus" in sys.argv:
+        # uso: --bench-corpus <carpeta> [documentos]
+        i = sys.argv.index("--bench-corpus")
+        folder = sys.argv[i + 1] if len(sys.argv) > i + 1 else BENCH_CORPUS_DIR
+        docs = int(sys.argv[i + 2]) if len(sys.argv) > i + 2 else BENCH_DOCS
+        generate_bench_corpus(folder, docs=docs, logger=print)
+        return
+    if "--bench" in sys.argv:
+        # Benchmark del lote sobre el corpus sintético; sale con código 1 si hay regresiones
+        # uso: --bench [carpeta del corpus] [--save-baseline]
+        save = "--save-baseline" in sys.argv
+        if save:
+            sys.argv.remove("--save-baseline")
+        i = sys.argv.index("--bench")
+        folder = sys.argv[i + 1] if len(sys.argv) > i + 1 else BENCH_CORPUS_DIR
+        result = run_benchmark(folder, logger=print)
+        print(result["table"])
+        print(f"{result['docs']} documentos, {result['pages']} páginas, {result['rows']} cupones "
+              f"en {result['seconds']:.1f} s ({result['pages_per_sec']:.2f} páginas/s)")
+        baseline = load_bench_baseline(result["key"])
+        if save or baseline is None:
+            save_bench_baseline(result)
+            print(f"Línea base guardada en {BENCH_BASELINE_FILE}")
+            return
+        regressions = compare_benchmark(result, baseline)
+        for r in regressions:
+            print(f"⚠️ Regresión: {r}")
+        if not regressions:
+            print(f"✅ Sin regresiones frente a la línea base del {baseline.get('fecha', '?')}")
+        sys.exit(1 if regressions else 0)
+    if "--eval" in sys.argv:
+        # Precisión vs. velocidad sobre el corpus sintético
+        # uso: --eval [carpeta del corpus] [dpi=200,300 psm=4,6 preprocess=si,no profile=rapido zone=pagina,texto]
+        args = sys.argv[sys.argv.index("--eval") + 1:]
+        folder = args.pop(0) if args and "=" not in args[0] else BENCH_CORPUS_DIR
+        df = evaluate_ocr_grid(folder, grid=parse_grid_args(args), logger=print)
+        cols = list(EVAL_GRID) + ["pages_per_sec", "campos", "cupones", "pareto"]
+        print(df[cols].to_string(index=False))
+        best = recommend_config(df)
+        print("Recomendada: " + ", ".join(f"{k}={best[k]}" for k in cols[:-1]))
+        print(f"Detalle por campo en {os.path.join(folder, 'eval_grid.csv')}")
+        return
+    if "--tune" in sys.argv:
+        # Vuelve a medir workers x hilos de tesseract con los PDFs de una carpeta y guarda el perfil
+        # uso: --tune <carpeta> [perfil OCR]
+        i = sys.argv.index("--tune")
+        folder = sys.argv[i + 1] if len(sys.argv) > i + 1 else "."
+        plan = build_work_plan(iter_input_files(folder, logger=print), DEFAULT_DPI, logger=print)
+        profile = resolve_ocr_profile(sys.argv[i + 2] if len(sys.argv) > i + 2 else DEFAULT_OCR_PROFILE, logger=print)
+        workers, threads = resolve_ocr_parallelism(plan, DEFAULT_DPI, profile=profile, logger=print, retune=True)
+        print(f"Perfil: {workers} workers x {threads} hilos ({OCR_TUNING_FILE})")
+        return
+    if "--node" in sys.argv:
+        # Nodo de un lote distribuido; lanzar en cada equipo contra el mismo ledger
+        # uso: --node <ledger.db> <carpeta de entrada> [perfil OCR] [--metrics [puerto]]
+        metrics, stop_metrics = None, None
+        if "--metrics" in sys.argv:
+            j = sys.argv.index("--metrics")
+            port = METRICS_PORT
+            if len(sys.argv) > j + 1 and sys.argv[j + 1].isdigit():
+                port = int(sys.argv.pop(j + 1))
+            sys.argv.pop(j)   # el resto de argumentos queda en su posición
+            metrics = BatchMetrics()
+            stop_metrics = start_metrics(metrics, port=port, logger=print)
+        i = sys.argv.index("--node")
+        ledger_path, folder = sys.argv[i + 1], sys.argv[i + 2]
+        profile = sys.argv[i + 3] if len(sys.argv) > i + 3 else DEFAULT_OCR_PROFILE
+        # la muestra para medir (si no hay perfil guardado) sale de las primeras entradas de la carpeta
+        sample_plan = build_work_plan(iter_input_files(folder, recursive=True), DEFAULT_DPI, stream=True)
+        workers, threads = resolve_ocr_parallelism(sample_plan, DEFAULT_DPI,
+                                                   profile=resolve_ocr_profile(profile), logger=print)
+        try:
+            run_node(ledger_path, folder, workers=workers, ocr_threads=threads, ocr_profile=profile,
+                     discovery={"recursive": True}, logger=print, metrics=metrics)
+        finally:
+            if stop_metrics:
+                stop_metrics()
+        return
+    if "--merge" in sys.argv:
+        # uso: --merge <ledger.db> <salida.xlsx>
+        i = sys.argv.index("--merge")
+        merge_shards(sys.argv[i + 1], sys.argv[i + 2], logger=print)
+        return
+    if "--ocr-search" in sys.argv:
+        # uso: --ocr-search <carpeta de texto OCR> <palabras...>   (nombre, referencia, importe; 'pala*' = prefijo)
+        i = sys.argv.index("--ocr-search")
+        with OcrTextArchive(sys.argv[i + 1]) as arc:
+            t0 = time.perf_counter()
+            hits = arc.search(" ".join(sys.argv[i + 2:]))
+            for name, snippet in hits:
+                print(f"{name}: {snippet}")
+            print(f"🔎 {len(hits)} documentos ({(time.perf_counter() - t0) * 1000:.0f} ms)")
+        return
+    if "--ocr-export" in sys.argv:
+        # uso: --ocr-export <carpeta de texto OCR> <carpeta destino> [rutas o nombres de PDF...]
+        i = sys.argv.index("--ocr-export")
+        with OcrTextArchive(sys.argv[i + 1]) as arc:
+            arc.export(sys.argv[i + 2], names=sys.argv[i + 3:] or None, logger=print)
+        return
+    if "--db-export" in sys.argv:
+        # uso: --db-export <resultados.db> <salida.xlsx|salida.csv> [--force]
+        i = sys.argv.index("--db-export")
+        if os.path.exists(sys.argv[i + 2]) and "--force" not in sys.argv:
+            print(f"⚠️ {sys.argv[i + 2]} ya existe y se reemplazaría solo con lo que hay en la base; "
+                  f"use --force para sobrescribirlo")
+            return
+        store = ResultStore(sys.argv[i + 1])
+        try:
+            print(f"📊 {store.export(sys.argv[i + 2])} registros en {sys.argv[i + 2]}")
+        finally:
+            store.close()
+        return
+    if "--db-find" in sys.argv:
+        # uso: --db-find <resultados.db> NoRefPago=3201456 [Contrato=... Identificacion=... Cliente=... _file=...]
+        i = sys.argv.index("--db-find")
+        criteria = dict(arg.split("=", 1) for arg in sys.argv[i + 2:] if "=" in arg)
+        store = ResultStore(sys.argv[i + 1])
+        try:
+            for row in store.find(**{k: v for k, v in criteria.items() if k in STORE_FIELDS}):
+                print(json.dumps(row, ensure_ascii=False))
+        finally:
+            store.close()
+        return
     root = Tk()
     app = OCRGui(root)
     root.mainloop()
 
 if __name__ == "__main__":
+    # necesario para ProcessPoolExecutor en el .exe congelado (PyInstaller)
+    import multiprocessing
+    multiprocessing.freeze_support()
     main()